@@ -5,6 +5,12 @@ class AppSetting:
     ASGI_APP_HOST = "127.0.0.1"
     ASGI_APP_PORT = 8000
     ASGI_APP_RELOAD = True
+    ASGI_APP_WORKERS = 1
+    LOG_PATH = "logs"
+    LOG_JSON = False  # JSON lines instead of text in the log files
+    LOG_CONSOLE = True
+    LOG_MAX_BYTES = 16 * 1024 * 1024  # rotated and gzipped past this size
+    LOG_BACKUPS = 5
 
 
 config = AppSetting()
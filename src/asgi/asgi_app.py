@@ -7,16 +7,29 @@
     license: Apache License 2.0
 """
 
-from fastapi import FastAPI, Request,UploadFile,File
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Request,UploadFile,File,Form,HTTPException,BackgroundTasks
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+import asyncio
 import os
+import typing
 
-from utils.local_io import a_write_file
+from io_tools.capture import CaptureOverloaded
+from io_tools.shell import ShellBusy
+from utils.jobs import JobQueueFull
+from utils.lazy import lazy_import
 from .asgi_events import asgi_app_lifespan
-from .asgi_events import FileDB
-import uuid
+from . import file_store
+from . import file_serve
+from . import cv_jobs
+from . import shell_api
 from .asgi_config import config
 
+# imported by the first CV request
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+match = lazy_import("image_tools.match")
+
 """
 DevStatus: 
 1. get screenshot /// done
@@ -47,27 +60,65 @@ def get_screenshot(req: Request):
     return {"numbers": numbers}
 
 
+async def _capture(req: Request, max_age_ms: typing.Optional[float]):
+    capture = req.app.state.context.capture
+    try:
+        future = capture.capture(None if max_age_ms is None else max_age_ms / 1000)
+    except CaptureOverloaded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    return await asyncio.wrap_future(future)
+
+
 @app.get("/get/screen/infos")
-def get_screen_infos(req: Request):
-    infos = req.app.state.context.device.get_all_screen_info()
+async def get_screen_infos(req: Request, max_age_ms: typing.Optional[float] = None):
+    """
+    concurrent requests within `max_age_ms` (CAPTURE_FRESHNESS_MS by default) share one capture
+    """
+    frame = await _capture(req, max_age_ms)
     res = []
-    for info in infos:
+    for info in frame.screens:
         res.append(str(info))
     return {"infos": res}
 
 
 @app.get("/get/screen/{number}/screenshot")
-def get_screenshot_by_screen_id(req: Request, number: int):
-    infos = req.app.state.context.device.get_all_screen_info()
-    for info in infos:
-        if info.capture_screen_number == number:
-            req.app.state.tmpfile = True
-            pic_bytes = info.capture_picture
-            pic_path = os.path.join("tmp", f"{uuid.uuid4().hex}.png")
-            req.app.state.context.device.screenshot_to_png(
-                pic_bytes, save_path=pic_path
-            )
-            return FileResponse(pic_path)
+async def get_screenshot_by_screen_id(req: Request, number: int, max_age_ms: typing.Optional[float] = None):
+    """
+    concurrent requests within `max_age_ms` share one capture and one png encode
+    """
+    context = req.app.state.context
+    tmp_store = context.tmp_store
+
+    def encode_png(info):
+        # kept after the response, so the next request of the same frame reuses it
+        pic_path = tmp_store.allocate(".png", keep=True)
+        try:
+            context.device.screenshot_to_png(info.capture_picture, save_path=pic_path)
+            tmp_store.commit(pic_path)
+        finally:
+            tmp_store.release(pic_path)
+        return pic_path
+
+    frame = await _capture(req, max_age_ms)
+    for _ in range(2):
+        pic_path = await asyncio.wrap_future(context.capture.encode(frame, number, encode_png))
+        if pic_path is None:
+            raise HTTPException(status_code=404, detail=f"screen {number} not found")
+        if tmp_store.acquire(pic_path):
+            return FileResponse(pic_path, background=BackgroundTask(tmp_store.release, pic_path))
+        # evicted between the encode and now, encode again
+        context.capture.forget_encode(frame, number)
+    raise HTTPException(status_code=503, detail="screenshot evicted, retry")
+
+
+@app.get("/get/screen/capture/metrics")
+def get_capture_metrics(req: Request):
+    return req.app.state.context.capture.metrics()
+
+
+@app.get("/get/tmp/metrics")
+def get_tmp_metrics(req: Request):
+    return req.app.state.context.tmp_store.metrics()
 
 
 @app.get("/get/io/mouse/events")
@@ -90,38 +141,302 @@ def send_keyboard_position(req: Request):
     return {"status": "not implemented"}
 
 
-@app.post("/cv/find/image/scale")
-def find_image_on_screen_scale(req: Request):
-    return {"status": "not implemented"}
+def _submit_job(req: Request, func, kind: str, priority: int, timeout: typing.Optional[float]) -> dict:
+    try:
+        job = req.app.state.context.jobs.submit(func, kind=kind, priority=priority, timeout=timeout)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    return {"job_id": job.job_id, "status": job.status.value}
+
+
+async def _resolve_job_inputs(req: Request, template_id: str, source: cv_jobs.FrameSource):
+    try:
+        template_path = await cv_jobs.resolve_path(template_id)
+        load_frame = await cv_jobs.frame_loader(req.app.state.context, source)
+    except cv_jobs.MissingFile as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return template_path, load_frame
+
+
+@app.post("/cv/find/image/scale", status_code=202)
+async def find_image_on_screen_scale(req: Request, body: cv_jobs.FindScaleRequest):
+    """
+    queue a scale search of a stored template, poll /cv/jobs/{job_id} or stream /cv/jobs/{job_id}/events
+    """
+    template_path, load_frame = await _resolve_job_inputs(req, body.template_id, body.source)
+    return _submit_job(req, cv_jobs.find_scale_job(load_frame, template_path, body),
+                       "find_scale", body.priority, body.timeout)
+
+
+@app.post("/cv/find/image/position", status_code=202)
+async def find_image_on_screen_position(req: Request, body: cv_jobs.FindPositionRequest):
+    """
+    queue a search of the matches of a stored template, poll or stream the job like /cv/find/image/scale
+    """
+    template_path, load_frame = await _resolve_job_inputs(req, body.template_id, body.source)
+    return _submit_job(req, cv_jobs.find_position_job(load_frame, template_path, body),
+                       "find_position", body.priority, body.timeout)
+
+
+@app.post("/cv/autoclick/image", status_code=202)
+async def autoclick_image_on_screen(req: Request, body: cv_jobs.AutoclickRequest):
+    """
+    queue an autoclick run: wait for the template on a monitor and click it, the job result reports
+    p50/p99 capture-to-click latency
+    """
+    try:
+        template_path = await cv_jobs.resolve_path(body.template_id)
+    except cv_jobs.MissingFile as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return _submit_job(req, cv_jobs.autoclick_job(req.app.state.context, template_path, body),
+                       "autoclick", body.priority, body.timeout)
+
+
+@app.post("/cv/match/batch")
+async def match_batch(req: Request,
+                      templates: str = Form(...),
+                      frame: typing.Optional[UploadFile] = File(None),
+                      frame_id: typing.Optional[str] = Form(None),
+                      monitor: int = Form(0),
+                      max_age_ms: typing.Optional[float] = Form(None)):
+    """
+    match many stored templates in one frame, in parallel, and answer with every result
+
+    `templates` is a JSON list of {"template_id", "threshold", "roi": [x, y, w, h], "max_matches"}.
+    The frame is the uploaded `frame`, or the stored `frame_id`, or one capture of `monitor` otherwise.
+    """
+    context = req.app.state.context
+    try:
+        items = cv_jobs.parse_batch(templates)
+    except ValueError as e:  # pydantic's ValidationError is a ValueError too
+        raise HTTPException(status_code=422, detail=str(e))
+
+    offset, source = (0, 0), "upload"
+    if frame is not None:
+        data = np.frombuffer(await frame.read(), dtype=np.uint8)
+        gray = await asyncio.to_thread(cv2.imdecode, data, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise HTTPException(status_code=422, detail="can't decode the uploaded frame")
+    elif frame_id is not None:
+        source = "file"
+        meta = await file_store.resolve(frame_id)
+        if meta is None:
+            raise HTTPException(status_code=404, detail=f"file {frame_id} not found")
+        gray = await asyncio.to_thread(match.CV._as_image, meta.path, cv2.IMREAD_GRAYSCALE)
+    else:
+        source = "capture"
+        captured = await _capture(req, max_age_ms)
+        info = captured.screen(monitor)
+        if info is None:
+            raise HTTPException(status_code=404, detail=f"screen {monitor} not found")
+        gray = await asyncio.to_thread(match.CV._as_image, match.CV.screenshot_to_bgra(info.capture_picture),
+                                       cv2.IMREAD_GRAYSCALE)
+        offset = (info.screen_left, info.screen_top)
+
+    try:
+        results = await cv_jobs.match_batch(context, gray, offset, items)
+    except cv_jobs.MissingFile as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"source": source, "size": [gray.shape[1], gray.shape[0]], "results": results}
+
+
+@app.get("/cv/jobs/metrics")
+def get_cv_job_metrics(req: Request):
+    return req.app.state.context.jobs.metrics()
+
+
+def _job_or_404(req: Request, job_id: str):
+    job = req.app.state.context.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job
+
+
+@app.get("/cv/jobs/{job_id}")
+async def get_cv_job(req: Request, job_id: str, wait: float = 0):
+    """
+    `wait` seconds (at most 30) long-polls until the job is finished
+    """
+    job = _job_or_404(req, job_id)
+    deadline = asyncio.get_running_loop().time() + min(max(wait, 0), 30)
+    while not job.status.finished:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            break
+        await cv_jobs.wait_change(job, job.version, remaining)
+    return job.to_dict()
+
+
+@app.delete("/cv/jobs/{job_id}")
+def cancel_cv_job(req: Request, job_id: str):
+    job = _job_or_404(req, job_id)
+    return {"job_id": job_id, "cancelled": req.app.state.context.jobs.cancel(job_id), "status": job.status.value}
+
+
+@app.get("/cv/jobs/{job_id}/events")
+def stream_cv_job(req: Request, job_id: str):
+    """
+    server-sent events, one per status or progress change, the stream ends when the job is finished
+    """
+    job = _job_or_404(req, job_id)
+    return StreamingResponse(cv_jobs.job_events(job), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache"})
+
+
+@app.post("/process/watch/{pid}")
+def watch_process(req: Request, pid: int):
+    req.app.state.context.sampler.watch(pid)
+    return {"pid": pid, "watched": True}
+
+
+@app.post("/process/watch/name/{name}")
+def watch_process_by_name(req: Request, name: str):
+    context = req.app.state.context
+    context.process_snapshot.refresh()
+    pids = [process.pid for process in context.process_snapshot.by_name(name)]
+    if not pids:
+        raise HTTPException(status_code=404, detail=f"no process named {name}")
+    for pid in pids:
+        context.sampler.watch(pid)
+    return {"pids": pids, "watched": True}
+
+
+@app.delete("/process/watch/{pid}")
+def unwatch_process(req: Request, pid: int):
+    req.app.state.context.sampler.unwatch(pid)
+    return {"pid": pid, "watched": False}
+
+
+@app.get("/get/process/stats")
+def get_process_stats(req: Request, seconds: typing.Optional[float] = None):
+    """
+    avg, p95, last and trend per minute of cpu, memory and io of every watched process
+    """
+    resource_sampler = req.app.state.context.sampler
+    return {"processes": [resource_sampler.stats(pid, seconds) for pid in resource_sampler.watched()],
+            "sampler": resource_sampler.overhead()}
+
+
+@app.get("/get/process/{pid}/stats")
+def get_process_stats_by_pid(req: Request, pid: int, seconds: typing.Optional[float] = None):
+    stats = req.app.state.context.sampler.stats(pid, seconds)
+    if stats is None:
+        raise HTTPException(status_code=404, detail=f"process {pid} is not watched")
+    return stats
+
+
+def _shell_runner(req: Request):
+    if not config.SHELL_API_ENABLED:
+        raise HTTPException(status_code=403, detail="the shell API is disabled, see SHELL_API_ENABLED")
+    return req.app.state.context.shell
+
+
+def _shell_busy() -> HTTPException:
+    return HTTPException(status_code=503, detail="too many shell commands are waiting", headers={"Retry-After": "1"})
 
 
-@app.post("/cv/find/image/position")
-def find_image_on_screen_position(req: Request):
-    return {"status": "not implemented"}
+@app.post("/shell/run")
+async def run_shell_command(req: Request, body: shell_api.ShellRequest):
+    """
+    run a command and answer with its exit code and output, the output is capped, see /shell/run/stream
+    """
+    try:
+        return await _shell_runner(req).run(body.cmd, body.timeout, body.cwd)
+    except ShellBusy:
+        raise _shell_busy()
+
+
+@app.post("/shell/run/stream")
+async def stream_shell_command(req: Request, body: shell_api.ShellRequest):
+    """
+    run a command and stream its output as NDJSON: {"stream": "stdout"|"stderr", "data", "t"} objects while
+    it runs, then {"stream": "exit", "code", "timed_out", "t"}
+    """
+    try:
+        # admitted by this call, before the response starts: a busy runner is a 503, never a broken 200
+        events = _shell_runner(req).stream(body.cmd, body.timeout, body.cwd)
+    except ShellBusy:
+        raise _shell_busy()
+    return StreamingResponse(shell_api.ndjson(events), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache"})
 
 
-@app.post("/cv/autoclick/image")
-def autoclick_image_on_screen(req: Request):
-    return {"status": "not implemented"}
+@app.get("/shell/metrics")
+def get_shell_metrics(req: Request):
+    return req.app.state.context.shell.metrics()
+
+
+def _recorder(req: Request):
+    if not config.RECORDER_ENABLED:
+        raise HTTPException(status_code=404, detail="the flight recorder is disabled, see RECORDER_ENABLED")
+    return req.app.state.context.recorder
+
+
+@app.get("/recorder/frame")
+def get_recorded_frame(req: Request, ts: float):
+    """
+    the recorded screen nearest the unix time `ts`, as PNG, its own time is in the X-Frame-Timestamp header
+    """
+    found = _recorder(req).frame_at(ts)
+    if found is None:
+        raise HTTPException(status_code=404, detail="nothing recorded")
+    timestamp, frame = found
+    ok, png = cv2.imencode(".png", frame)
+    if not ok:
+        raise HTTPException(status_code=500, detail="can't encode the frame")
+    return Response(png.tobytes(), media_type="image/png", headers={"X-Frame-Timestamp": f"{timestamp:.3f}"})
+
+
+@app.get("/recorder/segments")
+def get_recorder_segments(req: Request):
+    return _recorder(req).segments()
+
+
+@app.get("/recorder/metrics")
+def get_recorder_metrics(req: Request):
+    return _recorder(req).metrics()
 
 
 @app.post("/upload/file")
 async def upload_file(req: Request, file: UploadFile = File(...)):
-    image_file = await file.read()  # bytes
-    filename = uuid.uuid4().hex     # str
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),config.STORAGE_PATH, filename)
-    await a_write_file(path, image_file)
-    await FileDB.create(path=path,filename=filename)
-    return {"id": filename}
+    # streamed to disk in chunks, stored under its sha256, an identical upload returns the existing id
+    row, duplicate = await file_store.store_upload(file)
+    return file_store.describe(row, duplicate)
+
+@app.post("/upload/files")
+async def upload_files(req: Request, files: typing.List[UploadFile] = File(...)):
+    results = []
+    for file in files:
+        row, duplicate = await file_store.store_upload(file)
+        results.append(file_store.describe(row, duplicate))
+    return {"files": results}
 
 @app.get("/get/file/all")
-async def get_all_file(req: Request):
-    files = await FileDB.all()
-    return files
-
-@app.get("/get/file/{id}")
-async def get_file_by_id(req: Request,fid: str):
-    file = await FileDB.filter(filename=fid).first()
-    return FileResponse(file.path,media_type="image/jpeg")
+async def get_all_file(req: Request, cursor: int = 0, limit: int = 100, fields: typing.Optional[str] = None):
+    """
+    paginated by id, pass `next_cursor` as `cursor` to get the next page,
+    `fields` is a comma separated projection, such as fields=filename,size
+    """
+    try:
+        return await file_store.list_files(cursor, limit, fields.split(",") if fields else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/get/file/{fid}")
+async def get_file_by_id(req: Request, fid: str, background_tasks: BackgroundTasks,
+                         variant: typing.Optional[str] = None):
+    """
+    supports If-None-Match and Range, `variant` is one of file_serve.VARIANTS (thumb, webp)
+    """
+    meta = await file_store.resolve(fid)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="file not found")
+    return file_serve.serve_file(req, meta, background_tasks, variant)
+
+@app.delete("/file/{fid}")
+async def delete_file_by_id(req: Request, fid: str):
+    if not await file_store.delete_file(fid):
+        raise HTTPException(status_code=404, detail="file not found")
+    return {"deleted": fid}
 
 asgi_application = app
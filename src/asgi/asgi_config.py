@@ -32,6 +32,36 @@ class Config:
 
     STORAGE_PATH: str = os.getenv('STORAGE_PATH', 'storage')
 
+    CACHE_DB_PATH: str = os.getenv('CACHE_DB_PATH', './cache.json')
+
+    CAPTURE_WORKERS: int = int(os.getenv('CAPTURE_WORKERS', 2))
+    CAPTURE_MAX_QUEUE: int = int(os.getenv('CAPTURE_MAX_QUEUE', 16))
+    CAPTURE_FRESHNESS_MS: float = float(os.getenv('CAPTURE_FRESHNESS_MS', 50))
+
+    CV_WORKERS: int = int(os.getenv('CV_WORKERS', 2))
+    CV_MAX_QUEUE: int = int(os.getenv('CV_MAX_QUEUE', 64))
+
+    SAMPLER_INTERVAL: float = float(os.getenv('SAMPLER_INTERVAL', 1.0))
+    SAMPLER_HISTORY: int = int(os.getenv('SAMPLER_HISTORY', 600))
+
+    # runs any command line the caller sends, only turn it on where the API is not reachable by others
+    SHELL_API_ENABLED: bool = os.getenv('SHELL_API_ENABLED', '').lower() in ('1', 'true', 'yes')
+    SHELL_MAX_CONCURRENT: int = int(os.getenv('SHELL_MAX_CONCURRENT', 4))
+    SHELL_TIMEOUT: float = float(os.getenv('SHELL_TIMEOUT', 60))
+
+    # a rolling on-disk history of the screen, see io_tools/recorder.py
+    RECORDER_ENABLED: bool = os.getenv('RECORDER_ENABLED', '').lower() in ('1', 'true', 'yes')
+    RECORDER_PATH: str = os.getenv('RECORDER_PATH', 'recordings')
+    RECORDER_MONITOR: int = int(os.getenv('RECORDER_MONITOR', 0))
+    RECORDER_INTERVAL: float = float(os.getenv('RECORDER_INTERVAL', 0.5))
+    RECORDER_MAX_BYTES: int = int(os.getenv('RECORDER_MAX_BYTES', 1024 * 1024 * 1024))
+    RECORDER_CPU_BUDGET: float = float(os.getenv('RECORDER_CPU_BUDGET', 0.1))
+
+    TMP_PATH: str = os.getenv('TMP_PATH', 'tmp')  # every worker process uses its own TMP_PATH/<pid>
+    TMP_MAX_FILES: int = int(os.getenv('TMP_MAX_FILES', 12))
+    TMP_MAX_BYTES: int = int(os.getenv('TMP_MAX_BYTES', 512 * 1024 * 1024))
+    TMP_MAX_AGE: float = float(os.getenv('TMP_MAX_AGE', 300))
+
     LOG_PATH: str = os.getenv('LOG_PATH', 'logs')
     
 config = Config()
\ No newline at end of file
@@ -8,22 +8,39 @@
     license: Apache License 2.0
 """
 
+import concurrent.futures
 import shutil
-import threading
+import typing
 import fastapi
 import contextlib
-from io_tools import device
+from io_tools.capture import CaptureService
+from io_tools.cache import CacheObject
+from io_tools.device_daemon import DeviceClient
+from io_tools.shared_cache import SharedCacheClient
 import os
 from tortoise.models import Model
 from tortoise import fields,Tortoise
-from utils.background import monitor_directory
+from utils.background import TempArtifactStore
+from utils.jobs import JobManager
+from utils.lazy import is_loaded, lazy_import, lazy_property
 from .asgi_config import config
 
+# pyautogui, pynput and mss are imported when the device is first used, not when the app is imported
+device = lazy_import("io_tools.device")
+sampler = lazy_import("io_tools.sampler")  # numpy and psutil
+processes = lazy_import("io_tools.processes")
+shell = lazy_import("io_tools.shell")
+recorder = lazy_import("io_tools.recorder")
+
 
 class FileDB(Model):
     id = fields.IntField(pk=True)
-    filename = fields.CharField(max_length=255)
+    filename = fields.CharField(max_length=255, index=True)
     path = fields.CharField(max_length=255)
+    sha256 = fields.CharField(max_length=64, default="", index=True)
+    size = fields.BigIntField(default=0)
+    origin_name = fields.CharField(max_length=255, default="")
+    content_type = fields.CharField(max_length=127, default="")
 
     class Meta:
         table = "filedb"
@@ -34,7 +51,10 @@ class AsgiContext:
     """
     AsgiContext is a singleton class that holds the context of the ASGI app.
 
-    It is used to store the device and input listener instances.
+    It is used to store the device, input listener, cache, temporary file store, capture and CV job instances.
+    When the server runs several workers, the cache is the keyspace shared through the cache coordinator,
+    and the device and input listener are clients of the device daemon, which owns the grabber and the hooks.
+    The device, the input listener and the CV workers are created on first use, so startup doesn't pay for them.
     """
     _instance = None
 
@@ -44,9 +64,143 @@ class AsgiContext:
         return AsgiContext._instance
 
     def __init__(self) -> None:
-        self.device = device.DeviceOperate()
-        self.input_listener = device.InputListener()
-        self.input_listener.start()
+        self.cache = SharedCacheClient.from_env()
+        if self.cache is None:
+            self.cache = CacheObject(config.CACHE_DB_PATH)
+        # a directory per process: workers serve their own temporary files, and delete only those at shutdown
+        self.tmp_store = TempArtifactStore(
+            os.path.join(config.TMP_PATH, str(os.getpid())),
+            max_files=config.TMP_MAX_FILES,
+            max_bytes=config.TMP_MAX_BYTES,
+            max_age=config.TMP_MAX_AGE,
+        )
+        self.capture = CaptureService(
+            lambda: self.device.get_all_screen_info(),
+            max_workers=config.CAPTURE_WORKERS,
+            max_queue=config.CAPTURE_MAX_QUEUE,
+            freshness=config.CAPTURE_FRESHNESS_MS / 1000,
+        )
+
+    @lazy_property
+    def device_client(self) -> typing.Optional[DeviceClient]:
+        return DeviceClient.from_env()
+
+    @lazy_property
+    def device(self):
+        if self.device_client is not None:
+            return self.device_client
+        return device.DeviceOperate()
+
+    @lazy_property
+    def input_listener(self):
+        if self.device_client is not None:
+            return self.device_client.input_listener
+        listener = device.InputListener()
+        listener.start()
+        return listener
+
+    @lazy_property
+    def jobs(self) -> JobManager:
+        return JobManager(workers=config.CV_WORKERS, max_queue=config.CV_MAX_QUEUE)
+
+    @lazy_property
+    def match_pool(self) -> concurrent.futures.ThreadPoolExecutor:
+        # short matches answered within the request, such as /cv/match/batch
+        return concurrent.futures.ThreadPoolExecutor(max_workers=config.CV_WORKERS, thread_name_prefix="match")
+
+    @lazy_property
+    def sampler(self):
+        resource_sampler = sampler.ResourceSampler(interval=config.SAMPLER_INTERVAL, capacity=config.SAMPLER_HISTORY)
+        resource_sampler.start()
+        return resource_sampler
+
+    @lazy_property
+    def process_snapshot(self):
+        return processes.ProcessSnapshot()
+
+    @lazy_property
+    def shell(self):
+        return shell.ShellRunner(max_concurrent=config.SHELL_MAX_CONCURRENT, timeout=config.SHELL_TIMEOUT)
+
+    @lazy_property
+    def recorder(self):
+        flight_recorder = recorder.FlightRecorder(
+            config.RECORDER_PATH,
+            monitor=config.RECORDER_MONITOR,
+            interval=config.RECORDER_INTERVAL,
+            max_bytes=config.RECORDER_MAX_BYTES,
+            cpu_budget=config.RECORDER_CPU_BUDGET,
+        )
+        # frames grabbed for requests are recorded too, the recorder asks for one when nobody else does
+        self.capture.add_listener(flight_recorder.feed)
+        flight_recorder.start(request=lambda: self.capture.capture(config.RECORDER_INTERVAL))
+        return flight_recorder
+
+    def close(self) -> None:
+        """
+        Stop what was started, subsystems that were never used are not created just to be stopped.
+        """
+        if is_loaded(self, "jobs"):
+            self.jobs.shutdown()
+        if is_loaded(self, "match_pool"):
+            self.match_pool.shutdown(wait=False, cancel_futures=True)
+        if is_loaded(self, "sampler"):
+            self.sampler.stop()
+        if is_loaded(self, "recorder"):
+            self.capture.remove_listener(self.recorder.feed)
+            self.recorder.stop()
+        self.capture.shutdown()
+        self.tmp_store.close()
+        if is_loaded(self, "input_listener"):
+            self.input_listener.stop()
+        if is_loaded(self, "device_client") and self.device_client is not None:
+            self.device_client.close()
+
+async def migrate_filedb():
+    """
+    generate_schemas only creates missing tables, add the columns that databases created by older versions
+    don't have yet. Runs before generate_schemas, whose indexes need the columns, see index_filedb.
+    """
+    table = FileDB._meta.db_table
+    conn = Tortoise.get_connection("default")
+    _, rows = await conn.execute_query(f"PRAGMA table_info({table})")
+    existing = {row["name"] for row in rows}
+    if not existing:
+        return  # a new database, generate_schemas creates the table
+    for name, ddl in (
+            ("sha256", "VARCHAR(64) NOT NULL DEFAULT ''"),
+            ("size", "BIGINT NOT NULL DEFAULT 0"),
+            ("origin_name", "VARCHAR(255) NOT NULL DEFAULT ''"),
+            ("content_type", "VARCHAR(127) NOT NULL DEFAULT ''"),
+    ):
+        if name not in existing:
+            await conn.execute_script(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
+
+async def index_filedb():
+    """
+    Add the indexes that databases created by older versions don't have yet, after generate_schemas.
+
+    sha256 is unique among hashed rows, so workers storing the same content at once can't both insert it,
+    see file_store._commit. Rows from before hashing have an empty sha256 and are left out of it.
+    """
+    table = FileDB._meta.db_table
+    conn = Tortoise.get_connection("default")
+    # duplicates inserted before the index existed: same content, same id (the id is the sha256), keep one
+    await conn.execute_script(f"DELETE FROM {table} WHERE sha256 != '' AND id NOT IN "
+                              f"(SELECT MIN(id) FROM {table} WHERE sha256 != '' GROUP BY sha256)")
+    await conn.execute_script(f"CREATE UNIQUE INDEX IF NOT EXISTS uidx_{table}_sha256 ON {table} (sha256) "
+                              f"WHERE sha256 != ''")
+    indexed = set()
+    _, indexes = await conn.execute_query(f"PRAGMA index_list({table})")
+    for index in indexes:
+        _, columns = await conn.execute_query(f"PRAGMA index_info({index['name']})")
+        if columns:
+            indexed.add(columns[0]["name"])
+    for name in ("filename", "sha256"):
+        if name not in indexed:
+            await conn.execute_script(f"CREATE INDEX IF NOT EXISTS idx_{table}_{name} ON {table} ({name})")
+
 
 @contextlib.asynccontextmanager
 async def asgi_app_lifespan(app: fastapi.FastAPI):
@@ -60,24 +214,26 @@ async def asgi_app_lifespan(app: fastapi.FastAPI):
         modules={'models': [__name__]}
     )
 
+    await migrate_filedb()
     await Tortoise.generate_schemas()
+    await index_filedb()
 
     # mount context to app
     app.state.context = context
+    if config.RECORDER_ENABLED:
+        context.recorder  # starts recording
     storage_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),config.STORAGE_PATH)
 
     if not os.path.exists(storage_path):
         os.mkdir(storage_path)
-    if not os.path.exists("tmp"):
-        os.mkdir("tmp")
-    # clean tmp directory
-    threading.Thread(target=monitor_directory, args=("tmp",), daemon=True).start()
 
     yield  # wait for app to finish
 
-    # in StreamResponse or FileResponse, the response will be closed automatically
-    # however we don't know when the response is closed, so we can't delete the tmp file immediately
-    shutil.rmtree('tmp')
-    context.input_listener.stop()
+    # temporary files are deleted by the background task of the response that streams them,
+    # what is left is deleted here
+    context.close()
+    shutil.rmtree(context.tmp_store.directory, ignore_errors=True)
+    with contextlib.suppress(OSError):
+        os.rmdir(config.TMP_PATH)  # fails while another worker still has its directory in it
     # close database connection
     await Tortoise.close_connections()
@@ -0,0 +1,239 @@
+"""
+    filename: asgi/cv_jobs.py
+    ~~~~~~~~~~~~~~~~~~~~
+    request models and job functions of the CV endpoints
+
+    A CV request is resolved (template and frame file ids) in the request, then submitted to the
+    job manager as a closure that runs on a worker thread, the endpoint answers with the job id right away.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import asyncio
+import json
+import typing
+
+from pydantic import BaseModel, Field
+
+from image_tools.autoclick import Autoclicker, TemplateLocator
+from utils.jobs import Job
+from utils.lazy import lazy_import
+from . import file_store
+
+match = lazy_import("image_tools.match")  # cv2 and numpy are imported by the first CV request
+
+Frame = typing.Tuple[typing.Any, typing.Tuple[int, int]]  # (BGR ndarray, (left, top) of the frame on the desktop)
+
+
+class FrameSource(BaseModel):
+    """Where the frame to search comes from, a live monitor (0 is all monitors) or a stored file."""
+    monitor: int = 0
+    file_id: typing.Optional[str] = None
+    max_age_ms: typing.Optional[float] = None
+
+
+class FindScaleRequest(BaseModel):
+    template_id: str
+    source: FrameSource = FrameSource()
+    scale_range: typing.Tuple[float, float] = (0.5, 2.0)
+    scale_step: float = Field(0.1, gt=0)
+    priority: int = 0
+    timeout: typing.Optional[float] = 30.0
+
+
+class FindPositionRequest(BaseModel):
+    template_id: str
+    source: FrameSource = FrameSource()
+    threshold: float = Field(0.9, ge=-1, le=1)
+    matches_count: int = Field(5, ge=1)
+    priority: int = 0
+    timeout: typing.Optional[float] = 30.0
+
+
+class AutoclickRequest(BaseModel):
+    template_id: str
+    monitor: int = 0
+    threshold: float = Field(0.9, ge=-1, le=1)
+    budget_ms: float = Field(100.0, gt=0)
+    max_clicks: int = Field(1, ge=1)
+    cooldown_ms: float = Field(500.0, ge=0)
+    priority: int = 0
+    timeout: typing.Optional[float] = 60.0
+
+
+class BatchTemplate(BaseModel):
+    template_id: str
+    threshold: float = Field(0.9, ge=-1, le=1)
+    roi: typing.Optional[typing.Tuple[int, int, int, int]] = None  # x, y, width, height in frame pixels
+    max_matches: int = Field(1, ge=1, le=100)
+
+
+BATCH_MAX_TEMPLATES = 64
+
+
+def parse_batch(templates: str) -> typing.List[BatchTemplate]:
+    """
+    Parse the JSON list of templates of a batch request, it comes as a form field next to the uploaded frame.
+    Raises:
+        ValueError: If the list is malformed or too long.
+    """
+    items = json.loads(templates)
+    if not isinstance(items, list) or not items:
+        raise ValueError("templates must be a non-empty JSON list")
+    if len(items) > BATCH_MAX_TEMPLATES:
+        raise ValueError(f"at most {BATCH_MAX_TEMPLATES} templates per batch")
+    return [BatchTemplate(**item) for item in items]
+
+
+class MissingFile(LookupError):
+    """Raised when a request refers to a file id that is not stored."""
+
+
+async def resolve_path(fid: str) -> str:
+    meta = await file_store.resolve(fid)
+    if meta is None:
+        raise MissingFile(f"file {fid} not found")
+    return meta.path
+
+
+async def frame_loader(context, source: FrameSource) -> typing.Callable[[], Frame]:
+    """
+    Resolve a frame source in the request, the returned loader does the capture or decode on the worker.
+    """
+    if source.file_id is not None:
+        path = await resolve_path(source.file_id)
+        return lambda: (match.CV._as_image(path), (0, 0))
+    max_age = None if source.max_age_ms is None else source.max_age_ms / 1000
+
+    def load() -> Frame:
+        frame = context.capture.capture(max_age).result()
+        info = frame.screen(source.monitor)
+        if info is None:
+            raise LookupError(f"screen {source.monitor} not found")
+        # a contiguous copy, the BGR slice of the BGRA view is strided
+        return match.CV.screenshot_to_bgr(info.capture_picture).copy(), (info.screen_left, info.screen_top)
+
+    return load
+
+
+async def match_batch(context, gray, offset: typing.Tuple[int, int], templates: typing.List[BatchTemplate]) -> list:
+    """
+    Match every template of a batch in the frame, in parallel on the match pool.
+    Args:
+        gray: The grayscale frame, shared by every match.
+        offset: (left, top) of the frame on the desktop, added to the centers as `screen`.
+    """
+    specs = [{"template": await resolve_path(item.template_id), "threshold": item.threshold,
+              "roi": item.roi, "max_matches": item.max_matches} for item in templates]
+    # match_many fans out on the match pool and blocks until every match is done,
+    # it waits on a thread of the default executor, not on the match pool it feeds
+    results = await asyncio.to_thread(match.CV.match_many, gray, specs, context.match_pool)
+    left, top = offset
+    for item, result in zip(templates, results):
+        result["template_id"] = item.template_id
+        for hit in result["matches"]:
+            x, y = hit["center"]
+            hit["center"] = [int(x), int(y)]
+            hit["screen"] = [int(x) + left, int(y) + top]
+    return results
+
+
+def find_scale_job(load_frame: typing.Callable[[], Frame], template_path: str, request: FindScaleRequest):
+    def run(job: Job) -> dict:
+        job.report(stage="capture")
+        image, (left, top) = load_frame()
+        template = match.CV._as_image(template_path)
+        job.report(stage="match")
+        scale, loc, score = match.CV.scan_scales(image, template, request.scale_range, request.scale_step,
+                                           should_stop=job.should_stop)
+        job.check()
+        if scale is None:
+            return {"found": False}
+        height, width = template.shape[:2]
+        # the location is in the scaled frame, map the center back to the frame
+        x = (loc[0] + width / 2) / scale
+        y = (loc[1] + height / 2) / scale
+        return {"found": True, "scale": float(scale), "score": float(score),
+                "center": [int(x), int(y)], "screen": [int(x) + left, int(y) + top]}
+
+    return run
+
+
+def find_position_job(load_frame: typing.Callable[[], Frame], template_path: str, request: FindPositionRequest):
+    def run(job: Job) -> dict:
+        job.report(stage="capture")
+        image, (left, top) = load_frame()
+        job.check()
+        job.report(stage="match")
+        matches = match.CV.find_image_matches(image, template_path, request.threshold, request.matches_count,
+                                              should_stop=job.should_stop)
+        job.check()
+        return {"matches": [{"center": [int(x), int(y)], "score": float(score), "screen": [int(x) + left, int(y) + top]}
+                            for (x, y), score in matches]}
+
+    return run
+
+
+def autoclick_job(context, template_path: str, request: AutoclickRequest):
+    def grab():
+        # max_age=0 asks for a new grab, concurrent callers still share it
+        frame = context.capture.capture(0).result()
+        info = frame.screen(request.monitor)
+        if info is None:
+            raise LookupError(f"screen {request.monitor} not found")
+        # the BGRA buffer as is, the locator converts it to grayscale in one pass
+        return match.CV.screenshot_to_bgra(info.capture_picture), (info.screen_left, info.screen_top), frame.captured_at
+
+    def run(job: Job) -> dict:
+        locator = TemplateLocator(template_path)
+        clicker = Autoclicker(grab, lambda x, y: context.device.mouse_click(x, y, button="left"), locator,
+                              threshold=request.threshold, budget_ms=request.budget_ms,
+                              max_clicks=request.max_clicks, cooldown_ms=request.cooldown_ms,
+                              min_scale=locator.min_scale())
+        # the job timeout ends the run through should_stop, the report of a partial run is still the result
+        return clicker.run(should_stop=job.should_stop, on_progress=lambda progress: job.report(**progress))
+
+    return run
+
+
+async def wait_change(job: Job, version: int, timeout: float) -> None:
+    """
+    Wait for a job to change without holding a thread, for long polling and streams.
+    The worker that changes the job wakes the loop, nothing is polled.
+    """
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def wake() -> None:
+        try:
+            loop.call_soon_threadsafe(changed.set)
+        except RuntimeError:  # the loop is closed
+            pass
+
+    job.watch(wake)  # before the check, a change in between still wakes us
+    try:
+        if job.version == version and not job.status.finished:
+            await asyncio.wait_for(changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        job.unwatch(wake)
+
+
+async def job_events(job: Job, heartbeat: float = 15.0) -> typing.AsyncIterator[str]:
+    """
+    Server-sent events of a job, one event per change, until it is finished.
+    """
+    version = -1
+    while True:
+        if job.version != version:
+            version = job.version
+            state = job.to_dict()
+            yield f"event: {state['status']}\ndata: {json.dumps(state)}\n\n"
+            if job.status.finished:
+                return
+        else:
+            yield ": keep-alive\n\n"
+        await wait_change(job, version, heartbeat)
@@ -0,0 +1,179 @@
+"""
+    filename: asgi/file_serve.py
+    ~~~~~~~~~~~~~~~~~~~~
+    conditional and range responses for stored files, and their thumbnail/webp variants
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import os
+import re
+import threading
+import typing
+
+from fastapi import BackgroundTasks, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+from utils.local_io import a_iter_file
+from .file_store import FileMeta
+
+VARIANTS = {
+    # name: (longest side in pixels or None to keep the size, webp quality)
+    "thumb": (256, 80),
+    "webp": (None, 90),
+}
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+_pending: typing.Set[str] = set()
+_pending_lock = threading.Lock()
+
+
+def etag_of(meta: FileMeta, variant: typing.Optional[str] = None) -> str:
+    """
+    A strong ETag from the content hash, files stored before hashing get a weak one from mtime and size.
+    """
+    if meta.sha256:
+        return f'"{meta.sha256}-{variant}"' if variant else f'"{meta.sha256}"'
+    stat = os.stat(variant_path(meta, variant) if variant else meta.path)
+    return f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison
+    if header.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+
+def _strong_match(if_range: str, etag: typing.Optional[str]) -> bool:
+    # If-Range uses the strong comparison, a weak validator on either side never matches
+    if_range = if_range.strip()
+    return etag is not None and not etag.startswith("W/") and not if_range.startswith("W/") and if_range == etag
+
+
+def parse_range(header: str, size: int) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    Parse a single byte range.
+    Returns:
+        (start, end): inclusive, None if the header is not a single byte range (the full file is sent).
+    Raises:
+        ValueError: If the range can't be satisfied.
+    """
+    match = _RANGE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:  # suffix range, the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+def variant_path(meta: FileMeta, variant: str) -> str:
+    return f"{meta.path}.{variant}.webp"
+
+
+def _generate_variant(meta: FileMeta, variant: str) -> None:
+    import cv2
+
+    target = variant_path(meta, variant)
+    try:
+        longest, quality = VARIANTS[variant]
+        image = cv2.imread(meta.path, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            return
+        if longest is not None:
+            scale = longest / max(image.shape[:2])
+            if scale < 1:
+                image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode(".webp", image, [cv2.IMWRITE_WEBP_QUALITY, quality])
+        if ok:
+            tmp_path = f"{target}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(encoded.tobytes())
+            os.replace(tmp_path, target)
+    finally:
+        with _pending_lock:
+            _pending.discard(target)
+
+
+def schedule_variant(meta: FileMeta, variant: str, background_tasks: BackgroundTasks) -> None:
+    """
+    Generate a variant once, after the current response, concurrent requests don't queue it twice.
+    """
+    target = variant_path(meta, variant)
+    with _pending_lock:
+        if target in _pending:
+            return
+        _pending.add(target)
+    background_tasks.add_task(_generate_variant, meta, variant)
+
+
+def serve_file(req: Request,
+               meta: FileMeta,
+               background_tasks: BackgroundTasks,
+               variant: typing.Optional[str] = None) -> Response:
+    """
+    Build the response for a stored file.
+
+    Handles If-None-Match (304), Range / If-Range (206 and 416) and variants.
+    A variant that is not generated yet is scheduled in the background and the original is sent meanwhile,
+    without a validator and not to be cached: the url is the variant's, caches must ask again.
+    """
+    path, media_type, tag, fallback = meta.path, meta.content_type, None, False
+    if variant is not None:
+        if variant not in VARIANTS:
+            return Response(status_code=400, content=f"unknown variant {variant!r}")
+        if os.path.exists(variant_path(meta, variant)):
+            path, media_type, tag = variant_path(meta, variant), "image/webp", variant
+        else:
+            schedule_variant(meta, variant, background_tasks)
+            fallback = True
+    etag = None if fallback else etag_of(meta, tag)
+    headers = {"Accept-Ranges": "bytes"}
+    if etag is not None:
+        headers["ETag"] = etag
+    # ids are content hashes, the content behind a url never changes
+    immutable = meta.filename == meta.sha256 and not fallback
+    headers["Cache-Control"] = "public, max-age=31536000, immutable" if immutable else "no-cache"
+
+    if_none_match = req.headers.get("if-none-match")
+    if if_none_match is not None and etag is not None and _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    size = os.path.getsize(path)
+    range_header = req.headers.get("range")
+    if_range = req.headers.get("if-range")
+    if range_header is not None and (if_range is None or _strong_match(if_range, etag)):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(a_iter_file(path, start, end - start + 1),
+                                     status_code=206, media_type=media_type, headers=headers)
+    if fallback:
+        # FileResponse would add an ETag of its own
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(a_iter_file(path), media_type=media_type, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
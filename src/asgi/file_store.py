@@ -0,0 +1,238 @@
+"""
+    filename: asgi/file_store.py
+    ~~~~~~~~~~~~~~~~~~~~
+    content-addressed file storage for uploaded files
+
+    Files are stored under their sha256: storage/ab/abcdef..., and the sha256 is also the file id,
+    so uploading the same content twice returns the existing row instead of a new copy.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import collections
+import dataclasses
+import mimetypes
+import os
+import threading
+import typing
+import uuid
+
+from fastapi import UploadFile
+from tortoise.exceptions import IntegrityError
+
+from utils.local_io import a_write_hashed
+from .asgi_config import config
+from .asgi_events import FileDB
+
+UPLOAD_CHUNK_SIZE = 1 << 20  # peak memory per upload
+LIST_MAX_LIMIT = 1000
+
+
+@dataclasses.dataclass(frozen=True)
+class FileMeta:
+    """FileMeta is the part of a FileDB row needed to serve a file"""
+    filename: str
+    path: str
+    sha256: str
+    size: int
+    origin_name: str
+    content_type: str
+
+    @classmethod
+    def from_row(cls, row: FileDB) -> "FileMeta":
+        # rows written before content types were recorded are sniffed once, then cached
+        content_type = row.content_type or sniff_content_type(row.path, row.origin_name)
+        return cls(row.filename, row.path, row.sha256, row.size, row.origin_name, content_type)
+
+
+class FileMetaCache:
+    """
+    FileMetaCache maps file ids to FileMeta in memory, least recently used ids are dropped first.
+
+    Content-addressed ids never change their content, so entries don't go stale across workers,
+    except by deletion: `resolve` checks that the file of a cached entry still exists.
+    Uploads `put` their row, so a fresh upload is served without a database lookup.
+    Missing ids are not cached, a file uploaded through another worker is found on the next request.
+    """
+
+    def __init__(self, capacity: int = 4096) -> None:
+        self._capacity = capacity
+        self._entries: "collections.OrderedDict[str, FileMeta]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fid: str) -> typing.Optional[FileMeta]:
+        with self._lock:
+            meta = self._entries.get(fid)
+            if meta is not None:
+                self._entries.move_to_end(fid)
+            return meta
+
+    def put(self, meta: FileMeta) -> None:
+        with self._lock:
+            self._entries[meta.filename] = meta
+            self._entries.move_to_end(meta.filename)
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, fid: str) -> None:
+        with self._lock:
+            self._entries.pop(fid, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+meta_cache = FileMetaCache()
+
+
+async def resolve(fid: str) -> typing.Optional[FileMeta]:
+    """
+    Resolve a file id, from memory when possible, from the database otherwise.
+    """
+    meta = meta_cache.get(fid)
+    if meta is not None:
+        if os.path.exists(meta.path):
+            return meta
+        meta_cache.invalidate(fid)  # deleted, possibly by another worker
+    row = await FileDB.filter(filename=fid).first()
+    if row is None:
+        return None
+    meta = FileMeta.from_row(row)
+    meta_cache.put(meta)
+    return meta
+
+
+async def delete_file(fid: str) -> bool:
+    """
+    Delete a file, its row, and its content and generated variants unless another row still refers to them.
+    Returns:
+        False if there was no such file.
+    """
+    from . import file_serve  # file_serve imports this module
+
+    meta_cache.invalidate(fid)
+    row = await FileDB.filter(filename=fid).first()
+    if row is None:
+        return False
+    await row.delete()
+    meta_cache.invalidate(fid)  # a request may have cached it while the row was being deleted
+    shared = FileDB.filter(sha256=row.sha256) if row.sha256 else FileDB.filter(path=row.path)
+    if await shared.exists():
+        return True
+    meta = FileMeta.from_row(row)
+    for path in [row.path] + [file_serve.variant_path(meta, variant) for variant in file_serve.VARIANTS]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return True
+
+
+async def list_files(cursor: int = 0,
+                     limit: int = 100,
+                     fields: typing.Optional[typing.Sequence[str]] = None) -> dict:
+    """
+    List files by ascending id, a page at a time.
+    Args:
+        cursor: Return files with an id greater than the cursor, `next_cursor` of the previous page.
+        limit: The page size, at most LIST_MAX_LIMIT.
+        fields: The fields to return, all by default. The id is always returned.
+    Returns:
+        {"files": [...], "next_cursor": int or None}
+    """
+    known = set(FileDB._meta.fields_map)
+    fields = list(fields) if fields else sorted(known)
+    unknown = [field for field in fields if field not in known]
+    if unknown:
+        raise ValueError(f"unknown fields: {unknown}")
+    if "id" not in fields:
+        fields.insert(0, "id")
+    limit = max(1, min(limit, LIST_MAX_LIMIT))
+    # one extra row tells if there is a next page
+    rows = await FileDB.filter(id__gt=cursor).order_by("id").limit(limit + 1).values(*fields)
+    next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+    return {"files": rows[:limit], "next_cursor": next_cursor}
+
+
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+
+def sniff_content_type(path: str, origin_name: str = "") -> str:
+    """
+    Detect the content type from the first bytes of the file, then from the uploaded file name.
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(16)
+    except OSError:
+        head = b""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in _SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return mimetypes.guess_type(origin_name)[0] or "application/octet-stream"
+
+
+def storage_root() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), config.STORAGE_PATH)
+
+
+def content_path(sha256: str) -> str:
+    """
+    The storage path of a content hash, fanned out by the first two hex digits.
+    """
+    return os.path.join(storage_root(), sha256[:2], sha256)
+
+
+async def store_upload(file: UploadFile) -> typing.Tuple[FileDB, bool]:
+    """
+    Stream an upload to disk while hashing it, then move it to its content address.
+    Args:
+        file: The uploaded file.
+    Returns:
+        (row, duplicate): The FileDB row of the content, duplicate is True if it was already stored.
+    """
+    tmp_path = os.path.join(storage_root(), f".upload-{uuid.uuid4().hex}")
+    try:
+        sha256, size = await a_write_hashed(tmp_path, file.read, UPLOAD_CHUNK_SIZE)
+        return await _commit(tmp_path, sha256, size, file.filename or "")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+async def _commit(tmp_path: str, sha256: str, size: int, origin_name: str) -> typing.Tuple[FileDB, bool]:
+    # uploads of the same content, in this worker or another one, race for the same row: the unique sha256
+    # index lets one insert win, the others return its row. Moving the same content to the same path is harmless
+    existing = await FileDB.filter(sha256=sha256).first()
+    if existing is not None and os.path.exists(existing.path):
+        return existing, True
+    path = content_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    if existing is not None:  # the row survived but the file was lost, restore it
+        existing.path = path
+        await existing.save()
+        meta_cache.put(FileMeta.from_row(existing))
+        return existing, False
+    try:
+        row = await FileDB.create(filename=sha256, path=path, sha256=sha256, size=size, origin_name=origin_name,
+                                  content_type=sniff_content_type(path, origin_name))
+    except IntegrityError:  # stored by a concurrent upload
+        return await FileDB.get(sha256=sha256), True
+    meta_cache.put(FileMeta.from_row(row))
+    return row, False
+
+
+def describe(row: FileDB, duplicate: bool) -> dict:
+    return {"id": row.filename, "sha256": row.sha256, "size": row.size,
+            "content_type": row.content_type, "duplicate": duplicate}
@@ -0,0 +1,32 @@
+"""
+    filename: asgi/shell_api.py
+    ~~~~~~~~~~~~~~~~~~~~
+    request model and response stream of the shell endpoints
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import json
+import typing
+
+from pydantic import BaseModel, Field
+
+
+class ShellRequest(BaseModel):
+    cmd: str = Field(..., min_length=1)
+    timeout: typing.Optional[float] = Field(None, gt=0)  # the SHELL_TIMEOUT config by default
+    cwd: typing.Optional[str] = None
+
+
+async def ndjson(events: typing.AsyncIterator[dict]) -> typing.AsyncIterator[str]:
+    """
+    One JSON object per line, written as the command prints. When the client disconnects the response is
+    cancelled, closing `events` kills the command.
+    """
+    try:
+        async for event in events:
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    finally:
+        await events.aclose()
@@ -0,0 +1,80 @@
+"""
+    filename: benchmarks/bench_cache.py
+    ~~~~~~~~~~~~~~~~~~~~
+    multi-threaded stress benchmark for CacheObject
+
+    run from the src directory:
+        python -m benchmarks.bench_cache --threads 1 2 4 8 --seconds 2
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import argparse
+import random
+import threading
+import time
+import warnings
+
+from io_tools.cache import CacheObject
+
+
+def _worker(cache: CacheObject, keys: list, read_ratio: float, stop: threading.Event, counter: list, slot: int):
+    rnd = random.Random(slot)
+    ops = 0
+    while not stop.is_set():
+        for _ in range(256):
+            key = keys[rnd.randrange(len(keys))]
+            if rnd.random() < read_ratio:
+                cache.get(key)
+            else:
+                cache.set(key, ops)
+            ops += 1
+    counter[slot] = ops
+
+
+def run(threads: int, seconds: float, key_count: int, read_ratio: float) -> float:
+    """
+    Hammer the cache with `threads` threads for `seconds` seconds.
+    Returns:
+        ops_per_second: total operations per second over all threads.
+    """
+    cache = CacheObject()
+    keys = [f"key-{i}" for i in range(key_count)]
+    for key in keys:
+        cache.set(key, 0)
+    stop = threading.Event()
+    counter = [0] * threads
+    workers = [threading.Thread(target=_worker, args=(cache, keys, read_ratio, stop, counter, i))
+               for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return sum(counter) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--seconds", type=float, default=2.0)
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--read-ratio", type=float, default=0.9)
+    args = parser.parse_args()
+
+    warnings.simplefilter("ignore")  # overwrite warnings would dominate the measurement
+    baseline = None
+    print(f"{'threads':>8} {'ops/s':>14} {'scaling':>8}")
+    for threads in args.threads:
+        ops = run(threads, args.seconds, args.keys, args.read_ratio)
+        baseline = baseline or ops
+        print(f"{threads:>8} {ops:>14,.0f} {ops / baseline:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+    filename: benchmarks/bench_match.py
+    ~~~~~~~~~~~~~~~~~~~~
+    template matching benchmark: image_tools.match on synthetic screens, headless
+
+    Screens and templates are generated from a seed, so every run measures the same pixels:
+    a textured background with UI-like panels, and a template planted `density` times, at `scale`.
+    Each case reports latency (p50, p95), throughput (frames and megapixels per second), the peak
+    memory traced by tracemalloc (numpy allocations, cv2 internal buffers are not traced),
+    and whether the planted template was found.
+
+    run from the src directory:
+        python -m benchmarks.bench_match --repeat 10 --output match.json
+        python -m benchmarks.bench_match --baseline match.json       # exit code 1 on a regression
+        python -m benchmarks.bench_match --quick --only find_image_matches
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+import typing
+
+import cv2
+import numpy as np
+
+from image_tools.match import CV
+
+RESOLUTIONS = {
+    "1080p": (1920, 1080),
+    "1440p": (2560, 1440),
+    "ultrawide": (3440, 1440),
+    "dual": (3840, 1080),  # two 1080p monitors side by side, as mss returns the "all monitors" frame
+}
+DENSITIES = {"sparse": 1, "dense": 24}
+SCALES = (1.0, 0.8)  # 1 / 0.8 = 1.25 is one of the scales find_scale_and_position tries
+TEMPLATE_SIZE = (96, 64)  # width, height at scale 1.0
+
+
+def synthetic_screen(width: int, height: int, seed: int) -> np.ndarray:
+    """
+    A BGR screen: a gradient with noise, and flat panels with borders, such as windows and buttons.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    screen = np.empty((height, width, 3), dtype=np.uint8)
+    screen[..., 0] = (x * 0.5 + y * 0.3).astype(np.uint8)
+    screen[..., 1] = (y * 0.6).astype(np.uint8)
+    screen[..., 2] = (x * 0.4).astype(np.uint8)
+    screen += rng.integers(0, 24, screen.shape, dtype=np.uint8)
+    for _ in range(width * height // 40000):
+        w, h = int(rng.integers(40, 400)), int(rng.integers(20, 200))
+        x0, y0 = int(rng.integers(0, width - w)), int(rng.integers(0, height - h))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.rectangle(screen, (x0, y0), (x0 + w, y0 + h), color, -1)
+        cv2.rectangle(screen, (x0, y0), (x0 + w, y0 + h), (255, 255, 255), 1)
+    return screen
+
+
+def synthetic_template(seed: int) -> np.ndarray:
+    """
+    A BGR icon with enough structure to match at one place only: shapes and text on a noisy tile.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = TEMPLATE_SIZE
+    template = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    template = cv2.GaussianBlur(template, (5, 5), 0)
+    cv2.circle(template, (width // 4, height // 2), height // 4, (20, 200, 240), -1)
+    cv2.putText(template, "OK", (width // 2, height * 2 // 3), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+    return template
+
+
+def plant(screen: np.ndarray, template: np.ndarray, count: int, scale: float, seed: int) -> typing.List[tuple]:
+    """
+    Paste `count` copies of the template resized by `scale` on a grid of random cells, they don't overlap.
+    Returns:
+        The top-left corners of the copies.
+    """
+    rng = np.random.default_rng(seed)
+    scaled = template if scale == 1.0 else cv2.resize(template, None, fx=scale, fy=scale,
+                                                     interpolation=cv2.INTER_AREA)
+    h, w = scaled.shape[:2]
+    columns, rows = screen.shape[1] // (w * 2), screen.shape[0] // (h * 2)
+    cells = rng.choice(columns * rows, size=min(count, columns * rows), replace=False)
+    corners = []
+    for cell in cells:
+        x = int(cell % columns) * w * 2 + int(rng.integers(0, w))
+        y = int(cell // columns) * h * 2 + int(rng.integers(0, h))
+        screen[y:y + h, x:x + w] = scaled
+        corners.append((x, y))
+    return corners
+
+
+class Case(typing.NamedTuple):
+    name: str
+    run: typing.Callable[[], typing.Any]
+    found: typing.Callable[[typing.Any], bool]
+    pixels: int
+
+
+def build_cases(resolution: str, density: str, scale: float) -> typing.List[Case]:
+    """
+    The measured calls on one synthetic screen. Inputs are prepared here, only the call is timed.
+    """
+    width, height = RESOLUTIONS[resolution]
+    seed = sum(map(ord, f"{resolution}{density}{scale}"))  # stable across runs, unlike hash()
+    screen = synthetic_screen(width, height, seed)
+    template = synthetic_template(7)
+    corners = plant(screen, template, DENSITIES[density], scale, seed + 1)
+    gray = cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY)
+    scaled = template if scale == 1.0 else cv2.resize(template, None, fx=scale, fy=scale,
+                                                     interpolation=cv2.INTER_AREA)
+    scaled_gray = cv2.cvtColor(scaled, cv2.COLOR_BGR2GRAY)
+    th, tw = scaled_gray.shape
+    centers = {(x + tw // 2, y + th // 2) for x, y in corners}
+
+    def near(center, tolerance=2) -> bool:
+        return any(abs(center[0] - cx) <= tolerance and abs(center[1] - cy) <= tolerance for cx, cy in centers)
+
+    def position_found(result) -> bool:
+        try:
+            return near(result)
+        except TypeError:
+            return False
+
+    def position(src, template):
+        try:
+            return CV.quick_match_position(src, template)
+        except Exception:  # "No match found"
+            return None
+
+    key = f"{resolution}/{density}/x{scale:g}"
+    pixels = width * height
+    cases = [
+        Case(f"quick_match_exist/{key}", lambda: CV.quick_match_exist(gray, scaled_gray, 0.9),
+             lambda result: bool(result), pixels),
+        Case(f"quick_match_position/{key}", lambda: position(gray, scaled_gray), position_found, pixels),
+        Case(f"find_image_matches/{key}",
+             lambda: CV.find_image_matches(gray, scaled_gray, 0.9, DENSITIES[density]),
+             lambda result: bool(result) and all(near(center) for center, _ in result), pixels),
+    ]
+    if density == "sparse":
+        # the original-size template searched on a rescaled screen: the screen is at `scale`,
+        # so the template is found where the screen is resized by 1 / scale
+        cases.append(Case(
+            f"find_scale_and_position/{key}",
+            lambda: CV.scan_scales(screen, template, (0.5, 2.0), 0.25),
+            lambda result: result[0] is not None and abs(result[0] - 1 / scale) < 1e-6 and result[2] >= 0.8,
+            pixels))
+    return cases
+
+
+def measure(case: Case, repeat: int, warmup: int = 1) -> dict:
+    """
+    Returns:
+        {"p50_ms", "p95_ms", "mean_ms", "fps", "mpix_per_s", "peak_mb", "found"}
+    """
+    result = None
+    for _ in range(warmup):
+        result = case.run()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        case.run()
+        latencies.append((time.perf_counter() - start) * 1000)
+    # traced apart from the timed runs, tracemalloc slows allocations down
+    tracemalloc.start()
+    case.run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    latencies.sort()
+    mean = statistics.fmean(latencies)
+    return {
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))],
+        "mean_ms": mean,
+        "fps": 1000 / mean,
+        "mpix_per_s": case.pixels / 1e6 / (mean / 1000),
+        "peak_mb": peak / 1e6,
+        "found": bool(case.found(result)),
+    }
+
+
+def environment() -> dict:
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "cv2": cv2.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "cv2_threads": cv2.getNumThreads(),
+    }
+
+
+def compare(cases: dict, baseline: dict, tolerance: float, floor_ms: float) -> typing.List[str]:
+    """
+    The cases whose p50 grew more than `tolerance` (relative) and `floor_ms` (absolute, timer noise)
+    over the baseline, or that stopped finding the template.
+    """
+    regressions = []
+    for name, now in cases.items():
+        before = baseline.get("cases", {}).get(name)
+        if before is None:
+            continue
+        grew = now["p50_ms"] - before["p50_ms"]
+        if grew > floor_ms and now["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p50 {before['p50_ms']:.2f} -> {now['p50_ms']:.2f} ms")
+        if before.get("found") and not now["found"]:
+            regressions.append(f"{name}: the template is no longer found")
+    return regressions
+
+
+def report(cases: dict, baseline: typing.Optional[dict] = None) -> None:
+    before = (baseline or {}).get("cases", {})
+    print(f"{'case':<52} {'p50 ms':>9} {'p95 ms':>9} {'fps':>8} {'Mpix/s':>8} {'peak MB':>8} {'found':>6} "
+          f"{'delta':>8}")
+    for name, result in cases.items():
+        old = before.get(name)
+        delta = f"{(result['p50_ms'] / old['p50_ms'] - 1) * 100:+7.1f}%" if old else f"{'':>8}"
+        print(f"{name:<52} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['fps']:>8.1f} "
+              f"{result['mpix_per_s']:>8.1f} {result['peak_mb']:>8.1f} {str(result['found']):>6} {delta}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--resolutions", nargs="+", choices=list(RESOLUTIONS), default=list(RESOLUTIONS))
+    parser.add_argument("--only", help="run the cases whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="1080p, sparse, scale 1.0 only")
+    parser.add_argument("--threads", type=int, help="cv2.setNumThreads, pin it to compare machines")
+    parser.add_argument("--output", help="save the result as JSON")
+    parser.add_argument("--baseline", help="a result saved with --output to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative p50 growth flagged as a regression")
+    parser.add_argument("--floor-ms", type=float, default=0.5, help="p50 growth below this is noise")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+    resolutions, densities, scales = args.resolutions, list(DENSITIES), SCALES
+    if args.quick:
+        resolutions, densities, scales = ["1080p"], ["sparse"], (1.0,)
+
+    results = {}
+    for resolution, density, scale in itertools.product(resolutions, densities, scales):
+        for case in build_cases(resolution, density, scale):
+            if args.only and args.only not in case.name:
+                continue
+            results[case.name] = measure(case, args.repeat)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "repeat": args.repeat, "cases": results}, f, indent=2)
+    if baseline is not None:
+        if baseline.get("environment") != environment():
+            print("note: the baseline was measured in another environment", baseline.get("environment"))
+        regressions = compare(results, baseline, args.tolerance, args.floor_ms)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+    filename: benchmarks/bench_startup.py
+    ~~~~~~~~~~~~~~~~~~~~
+    cold start benchmark: import time of the app and of each heavy subsystem, from `python -X importtime`
+
+    Every measurement runs in a fresh interpreter, so nothing is warm in sys.modules.
+    The subsystem table tells what is paid at startup (imported by the app) and what is deferred to first use.
+
+    run from the src directory:
+        python -m benchmarks.bench_startup --repeat 5 --output startup.json
+        python -m benchmarks.bench_startup --baseline startup.json
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import typing
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUBSYSTEMS = ("fastapi", "tortoise", "pydantic", "numpy", "cv2", "PIL", "mss", "pyautogui", "pynput",
+              "psutil", "pywinauto")
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def importtime(statement: str) -> typing.Tuple[float, typing.Dict[str, float]]:
+    """
+    Run `statement` in a fresh interpreter under -X importtime.
+    Returns:
+        (wall_ms, cumulative): the wall time of the statement, and the cumulative import time in ms
+        of every module, where the module was first imported.
+    """
+    code = f"import time; t = time.perf_counter(); {statement}; print(time.perf_counter() - t)"
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=SRC, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed")
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        found = _LINE.match(line)
+        if found is not None:
+            cumulative.setdefault(found.group(4), int(found.group(2)) / 1000)
+    return float(proc.stdout.strip().splitlines()[-1]) * 1000, cumulative
+
+
+def measure(module: str, repeat: int) -> dict:
+    """
+    Returns:
+        {"module", "wall_ms", "loaded": {subsystem: ms}, "standalone": {subsystem: ms or None}}
+        `loaded` are the subsystems the module imports, `standalone` the cold import of each subsystem alone.
+    """
+    walls, loaded = [], {}
+    for _ in range(repeat):
+        wall, cumulative = importtime(f"import {module}")
+        walls.append(wall)
+        for name in SUBSYSTEMS:
+            if name in cumulative:
+                loaded.setdefault(name, []).append(cumulative[name])
+    standalone = {}
+    for name in SUBSYSTEMS:
+        try:
+            standalone[name] = statistics.median(importtime(f"import {name}")[0] for _ in range(repeat))
+        except RuntimeError:
+            standalone[name] = None  # not installed here
+    return {
+        "module": module,
+        "wall_ms": statistics.median(walls),
+        "loaded": {name: statistics.median(times) for name, times in loaded.items()},
+        "standalone": standalone,
+    }
+
+
+def report(result: dict, baseline: typing.Optional[dict] = None) -> None:
+    def delta(now, before):
+        return f"{now - before:+10.1f}" if before is not None and now is not None else f"{'':>10}"
+
+    before = baseline or {}
+    print(f"import {result['module']}: {result['wall_ms']:.1f} ms"
+          + (f" ({result['wall_ms'] - before['wall_ms']:+.1f} ms)" if baseline else ""))
+    print(f"{'subsystem':<12} {'at startup':>11} {'first use':>10} {'delta':>10}")
+    for name, alone in result["standalone"].items():
+        at_startup = result["loaded"].get(name)
+        first_use = f"{alone:>10.1f}" if alone is not None else f"{'missing':>10}"
+        startup = f"{at_startup:>11.1f}" if at_startup is not None else f"{'deferred':>11}"
+        print(f"{name:<12} {startup} {first_use} {delta(at_startup, before.get('loaded', {}).get(name))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--module", default="asgi.asgi_app")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="save the result as JSON")
+    parser.add_argument("--baseline", help="a result saved with --output to compare with")
+    args = parser.parse_args()
+
+    result = measure(args.module, args.repeat)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+    filename: image_tools/autoclick.py
+    ~~~~~~~~~~~~~~~~~~~~
+    closed loop autoclick: wait for a template to appear on screen, then click it
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import threading
+import time
+import typing
+
+# (image, (left, top) of the image on the desktop, time.monotonic() of the capture)
+Grabbed = typing.Tuple[typing.Any, typing.Tuple[int, int], float]
+# (center in image pixels or None, score)
+Located = typing.Tuple[typing.Optional[typing.Tuple[int, int]], float]
+
+SCALES = (1.0, 0.75, 0.5, 0.375, 0.25)  # coarse match levels, finest first
+
+
+def percentile(values: typing.Sequence[float], q: float) -> typing.Optional[float]:
+    """
+    The q-th percentile (0..100) by linear interpolation, None for no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+class _LatestFrame:
+    """A one slot mailbox, a new frame replaces the one the matcher didn't take yet."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._item = None
+        self.dropped = 0
+
+    def put(self, item) -> None:
+        with self._cond:
+            if self._item is not None:
+                self.dropped += 1
+            self._item = item
+            self._cond.notify()
+
+    def take(self, timeout: float):
+        with self._cond:
+            self._cond.wait_for(lambda: self._item is not None, timeout)
+            item, self._item = self._item, None
+            return item
+
+
+class TemplateLocator:
+    """
+    TemplateLocator finds one template in grayscale frames, coarse to fine.
+
+    At scale < 1 the frame and the template are downscaled and matched, when the coarse score is within
+    `margin` of the threshold the match is refined at full resolution in a small window around the coarse hit,
+    so the reported score is always a full resolution TM_CCOEFF_NORMED score.
+    """
+
+    def __init__(self, template, margin: float = 0.15) -> None:
+        import cv2
+        from image_tools.match import CV
+
+        self._cv2 = cv2
+        self._CV = CV
+        self.template = CV._as_image(template, cv2.IMREAD_GRAYSCALE)
+        self.margin = margin
+        self._scaled = {1.0: self.template}
+
+    def min_scale(self) -> float:
+        # don't shrink the template below 12 pixels, it stops being distinctive
+        return min(1.0, max(12 / min(self.template.shape[:2]), SCALES[-1]))
+
+    def _template_at(self, scale: float):
+        scaled = self._scaled.get(scale)
+        if scaled is None:
+            scaled = self._cv2.resize(self.template, None, fx=scale, fy=scale, interpolation=self._cv2.INTER_AREA)
+            self._scaled[scale] = scaled
+        return scaled
+
+    def _best(self, image, template) -> typing.Tuple[float, typing.Tuple[int, int]]:
+        cv2 = self._cv2
+        _, score, _, loc = cv2.minMaxLoc(cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED))
+        return score, loc
+
+    def __call__(self, image, scale: float, threshold: float) -> Located:
+        cv2 = self._cv2
+        frame = self._CV._as_image(image, cv2.IMREAD_GRAYSCALE)
+        height, width = self.template.shape[:2]
+        if height > frame.shape[0] or width > frame.shape[1]:
+            return None, -1.0
+        if scale < 1.0:
+            small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            coarse, loc = self._best(small, self._template_at(scale))
+            if coarse < threshold - self.margin:
+                return None, coarse
+            # refine around the coarse hit, the window covers the rounding of the downscale
+            pad = int(2 / scale) + 2
+            x0 = max(0, int(loc[0] / scale) - pad)
+            y0 = max(0, int(loc[1] / scale) - pad)
+            x1 = min(frame.shape[1], int(loc[0] / scale) + width + pad)
+            y1 = min(frame.shape[0], int(loc[1] / scale) + height + pad)
+            score, loc = self._best(frame[y0:y1, x0:x1], self.template)
+            loc = (loc[0] + x0, loc[1] + y0)
+        else:
+            score, loc = self._best(frame, self.template)
+        if score < threshold:
+            return None, score
+        return (loc[0] + width // 2, loc[1] + height // 2), score
+
+
+class Autoclicker:
+    """
+    Autoclicker runs a capture thread and a match loop, the capture of frame N+1 overlaps the match of frame N.
+
+    A frame that the matcher couldn't take before the next capture is dropped, the matcher always works
+    on the newest frame. When the target is found the click is issued right away from the match loop.
+    The match resolution adapts to the latency budget: when the capture-to-decision latency exceeds it
+    the matcher goes to a coarser level, when it is well under it goes back to a finer one.
+
+    Example:
+        >>> clicker = Autoclicker(grab, click, TemplateLocator(template), threshold=0.9, budget_ms=80)
+        >>> report = clicker.run(should_stop=job.should_stop, timeout=30)
+        >>> report["latency_ms"]["p99"]
+    """
+
+    def __init__(self,
+                 grab: typing.Callable[[], Grabbed],
+                 click: typing.Callable[[int, int], typing.Any],
+                 locate: typing.Callable[[typing.Any, float, float], Located],
+                 threshold: float = 0.9,
+                 budget_ms: float = 100.0,
+                 max_clicks: int = 1,
+                 cooldown_ms: float = 500.0,
+                 min_scale: float = SCALES[-1]) -> None:
+        """
+        Args:
+            grab: Returns the newest frame as (image, (left, top), captured_at).
+            click: Clicks a desktop position, such as DeviceOperate.mouse_click.
+            locate: Called with (image, scale, threshold), returns (center or None, score), see TemplateLocator.
+            threshold: The score that triggers a click.
+            budget_ms: The target capture-to-click latency.
+            max_clicks: The run ends after this many clicks.
+            cooldown_ms: Frames captured within this time after a click are ignored, the UI needs time to react.
+            min_scale: The coarsest match level allowed.
+        """
+        self._grab = grab
+        self._click = click
+        self._locate = locate
+        self.threshold = threshold
+        self.budget = budget_ms / 1000
+        self.max_clicks = max_clicks
+        self.cooldown = cooldown_ms / 1000
+        self._levels = [scale for scale in SCALES if scale >= min_scale] or [1.0]
+
+    def _capture_loop(self, mailbox: _LatestFrame, stop: threading.Event, errors: list) -> None:
+        try:
+            while not stop.is_set():
+                mailbox.put(self._grab())
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    def run(self,
+            should_stop: typing.Callable[[], bool] = lambda: False,
+            timeout: typing.Optional[float] = None,
+            on_progress: typing.Optional[typing.Callable[[dict], typing.Any]] = None) -> dict:
+        """
+        Run until max_clicks clicks, `should_stop` returns True, or the timeout.
+        Returns:
+            report: clicks, frame counters, the final match scale and p50/p99 of the latencies in ms.
+        """
+        mailbox, stop, errors = _LatestFrame(), threading.Event(), []
+        capture = threading.Thread(target=self._capture_loop, args=(mailbox, stop, errors),
+                                   name="autoclick-capture", daemon=True)
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        level, smoothed = 0, None
+        clicks, latencies, match_times = [], [], []
+        frames = skipped = 0
+        ignore_before = 0.0
+        last_progress = started
+        capture.start()
+        try:
+            while len(clicks) < self.max_clicks and not should_stop() and not stop.is_set():
+                now = time.monotonic()
+                if deadline is not None and now > deadline:
+                    break
+                item = mailbox.take(timeout=0.1)
+                if item is None:
+                    continue
+                image, (left, top), captured_at = item
+                if captured_at < ignore_before:
+                    skipped += 1
+                    continue
+                frames += 1
+                scale = self._levels[level]
+                match_started = time.monotonic()
+                center, score = self._locate(image, scale, self.threshold)
+                decided = time.monotonic()
+                match_times.append(decided - match_started)
+                if center is not None:
+                    self._click(center[0] + left, center[1] + top)
+                    clicked = time.monotonic()
+                    latencies.append(clicked - captured_at)
+                    clicks.append({"x": int(center[0] + left), "y": int(center[1] + top), "score": float(score),
+                                   "latency_ms": (clicked - captured_at) * 1000, "scale": scale})
+                    ignore_before = clicked + self.cooldown
+                # keep the capture-to-decision latency inside the budget
+                latency = decided - captured_at
+                smoothed = latency if smoothed is None else 0.7 * smoothed + 0.3 * latency
+                if smoothed > self.budget and level < len(self._levels) - 1:
+                    level, smoothed = level + 1, None
+                elif smoothed < self.budget / 3 and level > 0:
+                    level, smoothed = level - 1, None
+                if on_progress is not None and decided - last_progress >= 0.5:
+                    last_progress = decided
+                    on_progress({"frames": frames, "clicks": len(clicks), "scale": self._levels[level],
+                                 "last_score": float(score)})
+        finally:
+            stop.set()
+            capture.join(timeout=1.0)
+        if errors:
+            raise errors[0]
+
+        elapsed = time.monotonic() - started
+        return {
+            "clicks": clicks,
+            "frames": frames,
+            "frames_dropped": mailbox.dropped,
+            "frames_skipped": skipped,
+            "fps": frames / elapsed if elapsed > 0 else 0.0,
+            "scale": self._levels[level],
+            "budget_ms": self.budget * 1000,
+            "latency_ms": _summary(latencies),
+            "match_ms": _summary(match_times),
+        }
+
+
+def _summary(seconds: typing.Sequence[float]) -> dict:
+    p50, p99 = percentile(seconds, 50), percentile(seconds, 99)
+    return {
+        "count": len(seconds),
+        "p50": None if p50 is None else p50 * 1000,
+        "p99": None if p99 is None else p99 * 1000,
+    }
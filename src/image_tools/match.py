@@ -7,14 +7,75 @@
     date: 2023/11/28
     license: Apache License 2.0
 """
+import functools
+import os
 import typing
 import cv2
 import numpy as np
 import PIL
 import PIL.Image
+from io_tools.memoize import cached
+
+
+@functools.lru_cache(maxsize=128)
+def _decode(path: str, flags: int, mtime_ns: int, size: int) -> np.ndarray:
+    # mtime and size are part of the key, a rewritten file is decoded again
+    image = cv2.imread(path, flags)
+    if image is None:
+        raise FileNotFoundError(f"can't read image {path!r}")
+    image.flags.writeable = False  # shared by every caller
+    return image
 
 
 class CV:
+    @classmethod
+    def load_image(cls, path: os.PathLike, flags=cv2.IMREAD_COLOR) -> np.ndarray:
+        """
+        Decode an image file once, later calls get the same read-only ndarray until the file changes.
+        Meant for templates, which are small and reused, not for frames.
+        """
+        stat = os.stat(path)
+        return _decode(os.fspath(path), flags, stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    def _as_image(cls, image, flags=cv2.IMREAD_COLOR) -> np.ndarray:
+        """
+        Load an image path, or convert an already decoded image to the layout `flags` asks for.
+
+        Args:
+            image: An image path or a BGR, BGRA or grayscale ndarray.
+            flags: cv2.IMREAD_COLOR or cv2.IMREAD_GRAYSCALE.
+        """
+        if not isinstance(image, np.ndarray):
+            decoded = cv2.imread(image, flags)
+            if decoded is None:
+                raise FileNotFoundError(f"can't read image {image!r}")
+            return decoded
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        if flags == cv2.IMREAD_GRAYSCALE:
+            if channels == 1:
+                return image
+            return cv2.cvtColor(image, cv2.COLOR_BGRA2GRAY if channels == 4 else cv2.COLOR_BGR2GRAY)
+        if channels == 4:
+            return cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+        if channels == 1:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        return image
+
+    @classmethod
+    def screenshot_to_bgra(cls, screenshot) -> np.ndarray:
+        """
+        View a mss ScreenShot as a BGRA ndarray, without copying the pixels.
+        """
+        return np.asarray(screenshot)
+
+    @classmethod
+    def screenshot_to_bgr(cls, screenshot) -> np.ndarray:
+        """
+        View a mss ScreenShot as a BGR ndarray, without going through an encoded file.
+        """
+        return cls.screenshot_to_bgra(screenshot)[:, :, :3]
+
     @classmethod
     def cv2pil(cls, image: np.ndarray, /):
         """
@@ -61,15 +122,17 @@ class CV:
                            template,
                            min_threshold=0.9,
                            matches_count=5,
+                           should_stop: typing.Optional[typing.Callable[[], bool]] = None,
                            ) -> typing.List[typing.Tuple[typing.Tuple[int, int], float]]:
         """
         Find the matches of a template image in a source image., return the center of the matches and the match value.
 
         Args:
-            src: The source image path.
-            template: The template image path.
+            src: The source image path or ndarray.
+            template: The template image path or ndarray.
             min_threshold: The minimum threshold of the match value.
             matches_count: The number of the matches.
+            should_stop: Checked every 4096 candidates, the matches found so far are returned when it returns True.
 
         Returns:
             A list of tuples, each tuple contains the center of the match and the match value.
@@ -79,8 +142,8 @@ class CV:
         assert src is not None
         assert template is not None
         # load the src and template image
-        img = cv2.imread(src, 0)
-        template = cv2.imread(template, 0)
+        img = cls._as_image(src, cv2.IMREAD_GRAYSCALE)
+        template = cls._as_image(template, cv2.IMREAD_GRAYSCALE)
         w, h = template.shape[::-1]
 
         # use template matching method
@@ -94,7 +157,9 @@ class CV:
         distance_threshold = (w ** 2 + h ** 2) ** 0.5
         # calculate the distance threshold by the diagonal of the template
 
-        for pt in sorted_indices:
+        for n, pt in enumerate(sorted_indices):
+            if should_stop is not None and n % 4096 == 0 and should_stop():
+                break
             overlap = False
             for non_overlap in non_overlapping:
                 dist = ((non_overlap[0][0] - pt[0]) ** 2 + (non_overlap[0][1] - pt[1]) ** 2) ** 0.5
@@ -114,12 +179,14 @@ class CV:
         return non_overlapping
 
     @classmethod
+    # keyed by path, mtime and size of both images, or by the content of ndarrays
+    @cached(ttl=600, max_size=64, paths=("source_img", "template_img"))
     def find_scale_and_position(cls, source_img, template_img, scale_range=(0.5, 2.0), scale_step=0.1):
         """
         Find the best scale and position of the template image in the source image.
         Args:
-            source_img: The source image path.
-            template_img: The template image path.
+            source_img: The source image path or ndarray.
+            template_img: The template image path or ndarray.
             scale_range: The scale range to check.
             scale_step: The scale step to check.
         Returns:
@@ -128,8 +195,18 @@ class CV:
             best_loc: The best location.
             best_match_val: The best match value.
         """
-        source_img = cv2.imread(source_img)
-        template_img = cv2.imread(template_img)
+        return cls.scan_scales(source_img, template_img, scale_range, scale_step)
+
+    @classmethod
+    def scan_scales(cls, source_img, template_img, scale_range=(0.5, 2.0), scale_step=0.1,
+                    should_stop: typing.Optional[typing.Callable[[], bool]] = None):
+        """
+        The uncached search behind find_scale_and_position.
+        Args:
+            should_stop: Checked before every scale, the search returns the best match so far when it returns True.
+        """
+        source_img = cls._as_image(source_img)
+        template_img = cls._as_image(template_img)
         template_height, template_width = template_img.shape[:2]
         best_scale = None
         best_loc = None
@@ -137,6 +214,8 @@ class CV:
 
         # get all scales to check
         for scale in np.arange(scale_range[0], scale_range[1], scale_step):
+            if should_stop is not None and should_stop():
+                break
             # use the current scale to resize the source image
             scaled_img = cv2.resize(source_img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
             # check if the scaled image is smaller than the template
@@ -153,3 +232,67 @@ class CV:
                 best_match_val = max_val
 
         return best_scale, best_loc, best_match_val
+
+    @classmethod
+    def match_template(cls,
+                       src: np.ndarray,
+                       template,
+                       threshold: float = 0.9,
+                       roi: typing.Optional[typing.Sequence[int]] = None,
+                       max_matches: int = 1) -> dict:
+        """
+        Match one template in a grayscale frame, optionally inside a region of interest.
+        Args:
+            src: The grayscale frame.
+            template: The template path (decoded once, see load_image) or ndarray.
+            threshold: The minimum score of a match.
+            roi: (x, y, width, height) of the region to search, the whole frame by default.
+            max_matches: The maximum number of non-overlapping matches.
+        Returns:
+            {"found": bool, "score": best score, "matches": [{"center": (x, y), "score": float}, ...]}
+            centers are frame coordinates.
+        """
+        if isinstance(template, np.ndarray):
+            template = cls._as_image(template, cv2.IMREAD_GRAYSCALE)
+        else:
+            template = cls.load_image(template, cv2.IMREAD_GRAYSCALE)
+        x0, y0 = 0, 0
+        region = src
+        if roi is not None:
+            x, y, width, height = roi
+            x0, y0 = max(0, int(x)), max(0, int(y))
+            region = src[y0:max(y0, int(y + height)), x0:max(x0, int(x + width))]
+        h, w = template.shape[:2]
+        if h > region.shape[0] or w > region.shape[1]:
+            return {"found": False, "score": None, "matches": []}
+
+        # no integral-image prefilter: on textured screens its cheapest bound costs more than this match,
+        # and rules out few windows
+        res = cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED)
+        best, matches = None, []
+        while len(matches) < max_matches:
+            _, max_val, _, (mx, my) = cv2.minMaxLoc(res)
+            if best is None:
+                best = max_val
+            if max_val < threshold:
+                break
+            matches.append({"center": (x0 + mx + w // 2, y0 + my + h // 2), "score": float(max_val)})
+            # suppress every window that overlaps this match, the next one doesn't share a pixel with it
+            res[max(0, my - h + 1):my + h, max(0, mx - w + 1):mx + w] = -1
+        return {"found": bool(matches), "score": float(best), "matches": matches}
+
+    @classmethod
+    def match_many(cls, src, templates: typing.Sequence[dict], executor=None) -> typing.List[dict]:
+        """
+        Match several templates in one frame, the frame is decoded and converted to grayscale once.
+        Args:
+            src: The frame path or ndarray.
+            templates: keyword arguments of match_template, such as {"template": path, "threshold": 0.8}.
+            executor: A concurrent.futures executor to match in parallel, cv2 releases the GIL while matching.
+        Returns:
+            The match_template results, in the order of `templates`.
+        """
+        gray = cls._as_image(src, cv2.IMREAD_GRAYSCALE)
+        if executor is None:
+            return [cls.match_template(gray, **spec) for spec in templates]
+        return list(executor.map(lambda spec: cls.match_template(gray, **spec), templates))
@@ -0,0 +1,165 @@
+"""
+    filename: image_tools/probe.py
+    ~~~~~~~~~~~~~~~~~~~~
+    Pixel probes: tell UI states apart by a few pixel colours, before any template matching.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import threading
+import typing
+
+import numpy as np
+
+
+class Pixel(typing.NamedTuple):
+    """The pixel at (x, y) is `color` (B, G, R), within `tolerance` on every channel."""
+    x: int
+    y: int
+    color: typing.Tuple[int, int, int]
+    tolerance: int = 8
+
+
+class Region(typing.NamedTuple):
+    """The mean colour of the width x height region at (x, y) is `color` (B, G, R), within `tolerance`."""
+    x: int
+    y: int
+    width: int
+    height: int
+    color: typing.Tuple[int, int, int]
+    tolerance: int = 8
+
+
+def as_bgra(image) -> np.ndarray:
+    """
+    View a frame as a (height, width, channels) array without copying: a mss ScreenShot through its raw
+    BGRA buffer, an ndarray as is.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    return np.frombuffer(image.raw, dtype=np.uint8).reshape(image.height, image.width, 4)
+
+
+class _Compiled(typing.NamedTuple):
+    names: typing.List[str]
+    ys: np.ndarray  # pixel probes first, then every pixel of every region
+    xs: np.ndarray
+    pixels: int  # the number of pixel probes
+    starts: np.ndarray  # where each region starts in ys/xs, after the pixel probes
+    counts: np.ndarray  # pixels per region
+    colors: np.ndarray  # (probes, 3)
+    tolerances: np.ndarray  # (probes,)
+    owners: np.ndarray  # the set of each probe
+    bottom_right: typing.Tuple[int, int]  # the largest (y, x) probed, to check the frame size
+
+
+class ProbeBook:
+    """
+    ProbeBook holds named probe sets, a set matches when all its probes do.
+
+    `evaluate` checks every probe of every set with one numpy gather on the frame, a few microseconds
+    for hundreds of probes, where a template match on a full frame takes milliseconds. Use it as the gate
+    that decides whether a match is needed at all.
+
+    Example:
+        >>> book = ProbeBook()
+        >>> book.add("battle", [Pixel(1820, 40, (48, 196, 255)), Region(900, 1000, 6, 6, (30, 30, 30))])
+        >>> book.add("lobby", [Pixel(60, 60, (255, 255, 255), tolerance=4)])
+        >>> book.evaluate(screenshot)
+        {'battle': False, 'lobby': True}
+    """
+
+    def __init__(self) -> None:
+        self._sets: typing.Dict[str, typing.List[typing.Union[Pixel, Region]]] = {}
+        self._compiled: typing.Optional[_Compiled] = None
+        self._lock = threading.Lock()
+
+    def add(self, name: str, probes: typing.Iterable[typing.Union[Pixel, Region]]) -> "ProbeBook":
+        probes = list(probes)
+        if not probes:
+            raise ValueError(f"probe set {name!r} is empty")
+        for probe in probes:
+            if probe.x < 0 or probe.y < 0 or (isinstance(probe, Region) and min(probe.width, probe.height) <= 0):
+                raise ValueError(f"probe {probe} of set {name!r} is outside the frame")
+        with self._lock:
+            self._sets[name] = probes
+            self._compiled = None
+        return self
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            self._sets.pop(name, None)
+            self._compiled = None
+
+    @property
+    def names(self) -> typing.List[str]:
+        return list(self._sets)
+
+    def _compile(self) -> _Compiled:
+        names = list(self._sets)
+        pixels = [(n, probe) for n, name in enumerate(names) for probe in self._sets[name]
+                  if isinstance(probe, Pixel)]
+        regions = [(n, probe) for n, name in enumerate(names) for probe in self._sets[name]
+                   if isinstance(probe, Region)]
+        ys = [probe.y for _, probe in pixels]
+        xs = [probe.x for _, probe in pixels]
+        starts, counts = [], []
+        for _, region in regions:
+            grid_y, grid_x = np.mgrid[region.y:region.y + region.height, region.x:region.x + region.width]
+            starts.append(len(ys) - len(pixels))
+            counts.append(grid_y.size)
+            ys.extend(grid_y.ravel().tolist())
+            xs.extend(grid_x.ravel().tolist())
+        probes = pixels + regions
+        return _Compiled(
+            names=names,
+            ys=np.asarray(ys, dtype=np.intp),
+            xs=np.asarray(xs, dtype=np.intp),
+            pixels=len(pixels),
+            starts=np.asarray(starts, dtype=np.intp),
+            counts=np.asarray(counts, dtype=np.float32),
+            colors=np.asarray([probe.color for _, probe in probes], dtype=np.float32).reshape(-1, 3),
+            tolerances=np.asarray([probe.tolerance for _, probe in probes], dtype=np.float32),
+            owners=np.asarray([owner for owner, _ in probes], dtype=np.intp),
+            bottom_right=(max(ys, default=-1), max(xs, default=-1)),
+        )
+
+    def _current(self) -> _Compiled:
+        with self._lock:
+            if self._compiled is None:
+                self._compiled = self._compile()
+            return self._compiled
+
+    def colors(self, image) -> np.ndarray:
+        """
+        The observed colour of every probe, pixel probes first then regions, in the order they were added,
+        such as to pick the colours and tolerances of a new probe set from a screenshot.
+        """
+        return self._gather(self._current(), image)
+
+    @staticmethod
+    def _gather(compiled: _Compiled, image) -> np.ndarray:
+        frame = as_bgra(image)
+        if compiled.bottom_right[0] >= frame.shape[0] or compiled.bottom_right[1] >= frame.shape[1]:
+            raise ValueError(f"a probe is outside the {frame.shape[1]}x{frame.shape[0]} frame")
+        # the one gather: every probed pixel, B, G and R
+        gathered = frame[compiled.ys, compiled.xs, :3].astype(np.float32)
+        if not len(compiled.starts):
+            return gathered
+        means = np.add.reduceat(gathered[compiled.pixels:], compiled.starts, axis=0) / compiled.counts[:, None]
+        return np.concatenate([gathered[:compiled.pixels], means])
+
+    def evaluate(self, image) -> typing.Dict[str, bool]:
+        """
+        Returns:
+            {name: whether every probe of the set matches the frame}
+        """
+        compiled = self._current()
+        if not compiled.names:
+            return {}
+        observed = self._gather(compiled, image)
+        matched = (np.abs(observed - compiled.colors) <= compiled.tolerances[:, None]).all(axis=1)
+        failed = np.bincount(compiled.owners, weights=(~matched).astype(np.float32), minlength=len(compiled.names))
+        return {name: bool(failed[n] == 0) for n, name in enumerate(compiled.names)}
@@ -1,5 +1,5 @@
 """
-    filename: io_tools/cache.py 
+    filename: io_tools/cache.py
     ~~~~~~~~~~~~~~~~~~~~
     a simple cache class for memory database
 
@@ -11,13 +11,35 @@
 import threading
 import os
 import json
+import time
+import typing
 import warnings
 
+from .cache_backend import StorageBackend
+from .serializer import Serializer, PickleSerializer
+
+_MISSING = object()
+_EXPIRED = object()
+
 
 class CacheObject:
     """CacheObject class can be regarded as a memory database.
     It is a singleton class, which means there is only one instance of it.
 
+    The keyspace is split into stripes, each stripe is a dict guarded by its own lock.
+    Reads never take a lock (a single dict lookup is atomic in CPython),
+    writes only lock the stripe that owns the key, so writers of different keys don't contend.
+    `submit` takes a consistent per-stripe snapshot before serializing,
+    so the file is never written from a dict that is being mutated.
+
+    With a storage backend (see io_tools.cache_backend), the stripes become a small hot layer
+    in front of the backend: nothing is loaded up front, misses are read from the backend on first access,
+    writes go through to the backend, and values are encoded by a pluggable serializer
+    (see io_tools.serializer). The default PickleSerializer keeps large buffers out of the pickle stream,
+    with MmapBackend numpy arrays read by `get_many` and `scan` come back as views of the mapping without copying.
+    Values kept in the hot layer are copied out of the mapping first, so they don't pin it across compactions.
+    The hot layer evicts in insertion order (FIFO), not by recency: reads never reorder it, so they stay lock-free.
+
     Example:
         >>> cache = CacheObject('cache.json')
         >>> cache.set('key','value')
@@ -26,72 +48,322 @@ class CacheObject:
         >>> cache.remove('key')
         >>> cache.get('key')
         None
+        >>> cache = CacheObject(backend=SQLiteBackend('cache.db'))
+        >>> cache.set_many({'user:1': 'a', 'user:2': 'b'})
+        >>> list(cache.scan(prefix='user:'))
+        [('user:1', 'a'), ('user:2', 'b')]
 
     Attributes:
-        _cache (dict): cache dictionary
-        _mutex (threading.Lock): mutex lock
+        _stripes (list[dict]): cache dictionaries, one per stripe
+        _locks (list[threading.Lock]): write locks, one per stripe
+        _mutex (threading.Lock): mutex lock for the local database file
         _localdb (os.PathLike): local database file path
+        _backend (StorageBackend): storage backend, None for the local json database
+        _hot_capacity (int): hot layer capacity per stripe when a backend is used
+        _serializer (Serializer): value serializer when a backend is used
+        _expires (list[dict]): deadlines of the volatile keys, one per stripe
 
     """
     _instance = None
+    _init_lock = threading.Lock()
+    STRIPES = 16
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
-            cls._instance = super(CacheObject, cls).__new__(cls)
+            with cls._init_lock:
+                if not cls._instance:
+                    cls._instance = super(CacheObject, cls).__new__(cls)
         return cls._instance
 
-    def __init__(self, localdb: os.PathLike = None) -> None:
+    def __init__(self,
+                 localdb: os.PathLike = None,
+                 stripes: int = STRIPES,
+                 backend: StorageBackend = None,
+                 hot_size: int = 1024,
+                 serializer: Serializer = None) -> None:
         """Contructor of CacheObject class.
+
+        Constructing the singleton again with no database, or with the same database,
+        returns the live instance untouched instead of wiping it under concurrent users.
+
         Args:
             localdb (os.PathLike): local database file path
+            stripes (int): number of lock stripes
+            backend (StorageBackend): storage backend, replaces the local json database
+            hot_size (int): number of values kept in memory in front of the backend, the oldest inserted go first
+            serializer (Serializer): value serializer for the backend, PickleSerializer by default
         """
-        self._cache = dict()
-        self._mutex = threading.Lock()
-        self._localdb = localdb
-        if self._localdb is not None:
-            with self._mutex:
-                self._load()
+        with CacheObject._init_lock:
+            if getattr(self, "_stripes", None) is not None and backend is None and localdb in (None, self._localdb):
+                return
+            if backend is not None and localdb is not None:
+                raise ValueError("localdb and backend are exclusive")
+            self._stripes = [dict() for _ in range(stripes)]
+            self._expires = [dict() for _ in range(stripes)]
+            self._purge_at = [64] * stripes
+            self._locks = [threading.Lock() for _ in range(stripes)]
+            self._mutex = threading.Lock()
+            self._localdb = localdb
+            self._backend = backend
+            self._hot_capacity = max(1, hot_size // stripes)
+            self._serializer = serializer or PickleSerializer()
+            if self._localdb is not None:
+                with self._mutex:
+                    self._load()
+
+    def _stripe_index(self, key) -> int:
+        return hash(key) % len(self._stripes)
 
     def _load(self):
         if os.path.exists(self._localdb):
             with open(self._localdb) as f:
-                self._cache = json.load(f)
+                data = json.load(f)
+            for key, value in data.items():
+                self._stripes[self._stripe_index(key)][key] = value
         else:
             with open(self._localdb, 'w+') as f:
-                json.dump(self._cache, f)
+                json.dump({}, f)
+
+    def _dumps(self, value):
+        return self._serializer.dumps(value)
+
+    def _loads(self, data):
+        return self._serializer.loads(data)
+
+    def _remember(self, index: int, key, value) -> None:
+        """
+        Put a value in the hot layer of a stripe, the caller holds the stripe lock.
+        """
+        stripe = self._stripes[index]
+        stripe[key] = value
+        if self._backend is not None and len(stripe) > self._hot_capacity:
+            # evict the oldest insertion, reads never reorder the dict so they can stay lock-free
+            oldest = next(iter(stripe))
+            del stripe[oldest]
+            self._expires[index].pop(oldest, None)
+
+    def _purge_expired(self, index: int) -> None:
+        """
+        Drop the expired volatile keys of a stripe, the caller holds the stripe lock.
+        """
+        now = time.monotonic()
+        expires = self._expires[index]
+        for key in [key for key, deadline in expires.items() if deadline <= now]:
+            del expires[key]
+            self._stripes[index].pop(key, None)
+        self._purge_at[index] = max(64, 2 * len(expires))
 
-    def set(self, key, value):
-        if key in self._cache:
-            warnings.warn('Key already exists, will be overwritten.')
-        self._cache[key] = value
+    def _lookup(self, key):
+        """
+        Lock-free lookup in the in-memory layer, returns _MISSING for absent or expired keys.
+        """
+        index = self._stripe_index(key)
+        value = self._stripes[index].get(key, _MISSING)
+        if value is not _MISSING:
+            deadline = self._expires[index].get(key)
+            if deadline is not None and deadline <= time.monotonic():
+                return _EXPIRED
+        return value
 
-    def get(self, key):
-        if key not in self._cache:
+    def set(self, key, value, ttl: typing.Optional[float] = None):
+        """
+        Set the value of a key.
+        Args:
+            key: The key.
+            value: The value.
+            ttl: Time to live in seconds. Keys with a ttl are volatile, they are kept in memory only,
+                never written to the local database or the backend.
+        """
+        index = self._stripe_index(key)
+        with self._locks[index]:
+            stripe = self._stripes[index]
+            expires = self._expires[index]
+            if ttl is not None:
+                if self._backend is not None:
+                    self._backend.delete(key)
+                stripe.pop(key, None)
+                expires[key] = time.monotonic() + ttl
+                self._remember(index, key, value)
+                if len(expires) > self._purge_at[index]:
+                    self._purge_expired(index)
+                return
+            expires.pop(key, None)
+            if self._backend is None:
+                if key in stripe:
+                    warnings.warn('Key already exists, will be overwritten.')
+                stripe[key] = value
+            else:
+                stripe.pop(key, None)
+                self._backend.set(key, self._dumps(value))
+                self._remember(index, key, value)
+
+    def get(self, key, default=_MISSING):
+        """
+        Get the value of a key.
+        Returns None with a warning when the key is missing, or `default` without a warning if it is given.
+        """
+        # lock-free read
+        value = self._lookup(key)
+        if value is _MISSING and self._backend is not None:
+            index = self._stripe_index(key)
+            # fill the hot layer under the lock, so a concurrent set can't be overwritten by a stale read
+            with self._locks[index]:
+                stripe = self._stripes[index]
+                if key in stripe:
+                    return stripe[key]
+                data = self._backend.get(key)
+                if data is not None:
+                    if isinstance(data, memoryview):
+                        data = data.tobytes()  # the hot layer outlives the mapping, see the class docstring
+                    value = self._loads(data)
+                    self._remember(index, key, value)
+                    return value
+        if value is _MISSING or value is _EXPIRED:
+            if default is not _MISSING:
+                return default
             warnings.warn('Key not found.')
             return None
-        return self._cache[key]
+        return value
+
+    def get_many(self, keys: typing.Iterable) -> dict:
+        """
+        Get many keys at once, missing keys are left out of the result.
+        With a backend, all the misses of the hot layer are read in one backend call.
+        """
+        result = {}
+        misses = []
+        for key in keys:
+            value = self._lookup(key)
+            if value is _MISSING:
+                misses.append(key)
+            elif value is not _EXPIRED:
+                result[key] = value
+        if self._backend is not None and misses:
+            for key, data in self._backend.get_many(misses).items():
+                result[key] = self._loads(data)
+        return result
+
+    def set_many(self, items: typing.Union[dict, typing.Iterable[typing.Tuple]]) -> None:
+        """
+        Set many keys at once, with a backend they are written in one backend call.
+        """
+        items = list(items.items() if isinstance(items, dict) else items)
+        if self._backend is not None:
+            self._backend.set_many([(key, self._dumps(value)) for key, value in items])
+        for key, value in items:
+            index = self._stripe_index(key)
+            with self._locks[index]:
+                self._expires[index].pop(key, None)
+                self._stripes[index].pop(key, None)
+                self._remember(index, key, value)
+
+    def scan(self,
+             prefix: typing.Optional[str] = None,
+             start: typing.Optional[str] = None,
+             end: typing.Optional[str] = None,
+             limit: typing.Optional[int] = None) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+        """
+        Iterate over the persistent (key, value) pairs in key order.
+        Args:
+            prefix: Only keys starting with prefix.
+            start: Only keys >= start.
+            end: Only keys < end.
+            limit: The maximum number of pairs.
+        """
+        if self._backend is not None:
+            for key, data in self._backend.scan(prefix, start, end, limit):
+                yield key, self._loads(data)
+            return
+        start, end = StorageBackend._scan_bounds(prefix, start, end)
+        data = self.snapshot()
+        count = 0
+        for key in sorted(data):
+            if start is not None and key < start:
+                continue
+            if end is not None and key >= end:
+                break
+            if limit is not None and count >= limit:
+                break
+            count += 1
+            yield key, data[key]
 
     def remove(self, key):
-        if key not in self._cache:
-            warnings.warn('Key not found.')
-        del self._cache[key]
+        index = self._stripe_index(key)
+        with self._locks[index]:
+            stripe = self._stripes[index]
+            volatile = self._expires[index].pop(key, None) is not None
+            if self._backend is not None:
+                present = stripe.pop(key, _MISSING) is not _MISSING
+                if not self._backend.delete(key) and not (volatile and present):
+                    warnings.warn('Key not found.')
+                return
+            if key not in stripe:
+                warnings.warn('Key not found.')
+            del stripe[key]
 
     def clear(self):
-        self._cache.clear()
+        # always acquire the stripe locks in the same order to avoid deadlocks
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            for stripe, expires in zip(self._stripes, self._expires):
+                stripe.clear()
+                expires.clear()
+            if self._backend is not None:
+                self._backend.clear()
+        finally:
+            for lock in reversed(self._locks):
+                lock.release()
+
+    def snapshot(self) -> dict:
+        """
+        Return a copy of the persistent part of the cache, volatile keys are left out.
+        Every stripe is copied under its own lock, so each stripe is internally consistent.
+        """
+        if self._backend is not None:
+            return dict(self.scan())
+        data = dict()
+        for lock, stripe, expires in zip(self._locks, self._stripes, self._expires):
+            with lock:
+                if expires:
+                    data.update((key, value) for key, value in stripe.items() if key not in expires)
+                else:
+                    data.update(stripe)
+        return data
 
     def submit(self):
+        if self._backend is not None:
+            self._backend.flush()
+            return
         if self._localdb is None:
             warnings.warn('Local database not specified.')
             return
-        # with lock
+        # with lock, write to a temporary file then swap it in, readers of the file never see half a dump.
+        # the snapshot is taken under the lock too, or a slower submit could write an older snapshot last
         with self._mutex:
-            with open(self._localdb, 'w+') as f:
-                json.dump(self._cache, f)
+            data = self.snapshot()
+            tmp_path = f"{self._localdb}.tmp"
+            with open(tmp_path, 'w+') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._localdb)
+
+    def __contains__(self, key):
+        value = self._lookup(key)
+        if value is _EXPIRED:
+            return False
+        if value is not _MISSING:
+            return True
+        return self._backend is not None and self._backend.contains(key)
+
+    def __len__(self):
+        if self._backend is not None:
+            return self._backend.count()
+        return sum(len(stripe) for stripe in self._stripes)
 
     def __getitem__(self, key):
         return self.get(key)
-    
+
     def __setitem__(self, key, value):
         self.set(key, value)
         self.submit()
-    
+
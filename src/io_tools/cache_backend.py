@@ -0,0 +1,476 @@
+"""
+    filename: io_tools/cache_backend.py
+    ~~~~~~~~~~~~~~~~~~~~
+    storage backends for CacheObject, keys are str and values are bytes,
+    or a list of byte frames produced by io_tools.serializer that are written back to back
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import bisect
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import typing
+
+
+def _prefix_upper_bound(prefix: str) -> typing.Optional[str]:
+    """
+    The smallest string that is greater than every string starting with `prefix`.
+    Code point order is the same as UTF-8 byte order, so it works for both sqlite and python.
+    """
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10FFFF:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+class StorageBackend:
+    """
+    StorageBackend is the interface CacheObject uses to persist values.
+
+    Implementations open their storage lazily, on the first call that needs it.
+
+    Methods:
+        get: Get the value of a key, None if not found.
+        get_many: Get the values of many keys.
+        set: Set the value of a key.
+        set_many: Set many key/value pairs at once.
+        delete: Delete a key, return True if the key existed.
+        contains: Check if a key exists.
+        scan: Iterate over key/value pairs in key order, filtered by prefix or range.
+        count: Number of keys.
+        clear: Delete every key.
+        flush: Make the written data durable.
+        close: Release the storage.
+    """
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        raise NotImplementedError
+
+    def get_many(self, keys: typing.Iterable[str]) -> typing.Dict[str, bytes]:
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set(self, key: str, value: typing.Union[bytes, typing.List[bytes]]) -> None:
+        raise NotImplementedError
+
+    def set_many(self, items: typing.Iterable[typing.Tuple[str, bytes]]) -> None:
+        for key, value in items:
+            self.set(key, value)
+
+    def delete(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def contains(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def scan(self,
+             prefix: typing.Optional[str] = None,
+             start: typing.Optional[str] = None,
+             end: typing.Optional[str] = None,
+             limit: typing.Optional[int] = None) -> typing.Iterator[typing.Tuple[str, bytes]]:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def _frames(value) -> typing.List[bytes]:
+        return value if isinstance(value, list) else [value]
+
+    @staticmethod
+    def _scan_bounds(prefix, start, end):
+        """
+        Merge a prefix filter and a [start, end) range into one [start, end) range.
+        """
+        if prefix:
+            upper = _prefix_upper_bound(prefix)
+            start = prefix if start is None else max(start, prefix)
+            if upper is not None:
+                end = upper if end is None else min(end, upper)
+        return start, end
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    SQLiteBackend stores the cache in a sqlite table in WAL mode.
+
+    Every thread gets its own connection, so readers don't block each other or the writer.
+
+    Example:
+        >>> cache = CacheObject(backend=SQLiteBackend('cache.db'))
+        >>> cache['key'] = b'value'
+    """
+
+    def __init__(self, path: os.PathLike, table: str = "cache") -> None:
+        """
+        Args:
+            path: The sqlite database file path.
+            table: The table name.
+        """
+        self._path = path
+        self._table = table
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            with self._connections_lock:
+                if not self._schema_ready:
+                    conn.execute(f"CREATE TABLE IF NOT EXISTS {self._table} "
+                                 f"(key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID")
+                    self._schema_ready = True
+                self._connections.append(conn)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            f"SELECT value FROM {self._table} WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_many(self, keys):
+        keys = list(keys)
+        result = {}
+        conn = self._connection()
+        # sqlite limits the number of host parameters, query in chunks
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for key, value in conn.execute(
+                    f"SELECT key, value FROM {self._table} WHERE key IN ({placeholders})", chunk):
+                result[key] = value
+        return result
+
+    def set(self, key, value):
+        self._connection().execute(
+            f"INSERT OR REPLACE INTO {self._table} (key, value) VALUES (?, ?)", (key, self._join(value)))
+
+    def set_many(self, items):
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(f"INSERT OR REPLACE INTO {self._table} (key, value) VALUES (?, ?)",
+                             ((key, self._join(value)) for key, value in items))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @classmethod
+    def _join(cls, value) -> bytes:
+        frames = cls._frames(value)
+        return frames[0] if len(frames) == 1 else b"".join(frames)
+
+    def delete(self, key):
+        cursor = self._connection().execute(f"DELETE FROM {self._table} WHERE key = ?", (key,))
+        return cursor.rowcount > 0
+
+    def contains(self, key):
+        return self._connection().execute(
+            f"SELECT 1 FROM {self._table} WHERE key = ?", (key,)).fetchone() is not None
+
+    def scan(self, prefix=None, start=None, end=None, limit=None):
+        start, end = self._scan_bounds(prefix, start, end)
+        clauses, params = [], []
+        if start is not None:
+            clauses.append("key >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("key < ?")
+            params.append(end)
+        sql = f"SELECT key, value FROM {self._table}"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY key"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        yield from self._connection().execute(sql, params)
+
+    def count(self):
+        return self._connection().execute(f"SELECT COUNT(*) FROM {self._table}").fetchone()[0]
+
+    def clear(self):
+        self._connection().execute(f"DELETE FROM {self._table}")
+
+    def flush(self):
+        self._connection().execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class MmapBackend(StorageBackend):
+    """
+    MmapBackend stores the cache in an append-only key/value log file that is read through mmap.
+
+    Only the record headers are read when the file is opened, values stay on disk until they are asked for,
+    and are then returned as a memoryview of the mapping without copying.
+    Overwritten and deleted records are reclaimed by `compact`.
+
+    File layout:
+        header: MAGIC
+        record: flags (u32), key length (u32), value length (u64), key, padding, value, padding
+        every record and every value starts on an ALIGN byte boundary.
+
+    Example:
+        >>> cache = CacheObject(backend=MmapBackend('cache.kv'))
+        >>> cache['key'] = b'value'
+    """
+    MAGIC = b"OATKV\x00\x00\x01"
+    ALIGN = 64
+    _RECORD = struct.Struct("<IIQ")
+    _TOMBSTONE = 1
+
+    def __init__(self, path: os.PathLike, compact_ratio: float = 0.5) -> None:
+        """
+        Args:
+            path: The key/value file path.
+            compact_ratio: Compact on flush when more than this part of the file is dead records.
+        """
+        self._path = path
+        self._compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        self._file = None
+        self._map = None
+        self._index: typing.Dict[str, typing.Tuple[int, int]] = {}
+        self._sorted_keys: typing.Optional[typing.List[str]] = None
+        self._size = 0
+        self._dead_bytes = 0
+
+    @classmethod
+    def _pad(cls, n: int) -> int:
+        return -n % cls.ALIGN
+
+    def _open(self) -> None:
+        if self._file is not None:
+            return
+        with self._lock:
+            if self._file is not None:
+                return
+            if not os.path.exists(self._path) or os.path.getsize(self._path) == 0:
+                with open(self._path, "wb") as f:
+                    f.write(self.MAGIC + b"\x00" * self._pad(len(self.MAGIC)))
+            file = open(self._path, "r+b")
+            self._size = os.fstat(file.fileno()).st_size
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._map[:len(self.MAGIC)] != self.MAGIC:
+                file.close()
+                raise ValueError(f"{self._path} is not a cache file")
+            self._build_index()
+            self._file = file
+
+    def _build_index(self) -> None:
+        offset = len(self.MAGIC) + self._pad(len(self.MAGIC))
+        index = {}
+        dead = 0
+        while offset + self._RECORD.size <= self._size:
+            flags, key_len, value_len = self._RECORD.unpack_from(self._map, offset)
+            key_start = offset + self._RECORD.size
+            value_start = key_start + key_len + self._pad(key_start + key_len)
+            record_end = value_start + value_len + self._pad(value_start + value_len)
+            if record_end > self._size:
+                break  # torn write at the tail
+            key = self._map[key_start:key_start + key_len].decode("utf-8")
+            if key in index:
+                dead += index[key][2]
+            if flags & self._TOMBSTONE:
+                index.pop(key, None)
+                dead += record_end - offset
+            else:
+                index[key] = (value_start, value_len, record_end - offset)
+            offset = record_end
+        self._size = offset
+        self._index = index
+        self._dead_bytes = dead
+        self._sorted_keys = None
+
+    def _view(self, start: int, length: int) -> memoryview:
+        if start + length > len(self._map):
+            with self._lock:
+                if start + length > len(self._map):
+                    self._file.flush()
+                    # the old mapping stays alive as long as a returned view still references it
+                    self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)[start:start + length]
+
+    def _encode(self, key: str, value, flags: int = 0) -> typing.Tuple[typing.List[bytes], int, int, int]:
+        key_bytes = key.encode("utf-8")
+        frames = self._frames(value) if value is not None else []
+        value_len = sum(memoryview(frame).nbytes for frame in frames)
+        header = self._RECORD.pack(flags, len(key_bytes), value_len)
+        key_end = self._size + len(header) + len(key_bytes)
+        value_start = key_end + self._pad(key_end)
+        value_end = value_start + value_len
+        chunks = [header, key_bytes, b"\x00" * self._pad(key_end)]
+        chunks.extend(frames)
+        chunks.append(b"\x00" * self._pad(value_end))
+        return chunks, value_start, value_len, value_end + self._pad(value_end) - self._size
+
+    def _append(self, key: str, value, flags: int = 0) -> None:
+        chunks, value_start, value_len, record_len = self._encode(key, value, flags)
+        self._file.seek(self._size)
+        self._file.writelines(chunks)
+        self._size += record_len
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._dead_bytes += old[2]
+        elif self._sorted_keys is not None and not flags & self._TOMBSTONE:
+            bisect.insort(self._sorted_keys, key)
+        if flags & self._TOMBSTONE:
+            self._dead_bytes += record_len
+            if old is not None and self._sorted_keys is not None:
+                self._sorted_keys.remove(key)
+        else:
+            self._index[key] = (value_start, value_len, record_len)
+
+    def get(self, key):
+        self._open()
+        # under the lock: compact replaces the index and the mapping together, an offset of the old index
+        # must not be read in the new mapping
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            return self._view(entry[0], entry[1])
+
+    def set(self, key, value):
+        self._open()
+        with self._lock:
+            self._append(key, value)
+
+    def set_many(self, items):
+        self._open()
+        with self._lock:
+            for key, value in items:
+                self._append(key, value)
+
+    def delete(self, key):
+        self._open()
+        with self._lock:
+            if key not in self._index:
+                return False
+            self._append(key, None, self._TOMBSTONE)
+            return True
+
+    def contains(self, key):
+        self._open()
+        return key in self._index
+
+    def scan(self, prefix=None, start=None, end=None, limit=None):
+        self._open()
+        start, end = self._scan_bounds(prefix, start, end)
+        with self._lock:
+            if self._sorted_keys is None:
+                self._sorted_keys = sorted(self._index)
+            keys = self._sorted_keys
+            lo = 0 if start is None else bisect.bisect_left(keys, start)
+            hi = len(keys) if end is None else bisect.bisect_left(keys, end)
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            selected = keys[lo:hi]
+        for key in selected:
+            value = self.get(key)
+            if value is not None:
+                yield key, value
+
+    def count(self):
+        self._open()
+        return len(self._index)
+
+    def clear(self):
+        self._open()
+        with self._lock:
+            self._swap_file([])
+
+    def flush(self):
+        if self._file is None:
+            return
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if self._size and self._dead_bytes > self._size * self._compact_ratio:
+                try:
+                    self.compact()
+                except PermissionError:
+                    pass  # Windows: views handed out still map the file, compact on a later flush
+
+    def compact(self) -> None:
+        """
+        Rewrite the file with only the live records.
+        """
+        self._open()
+        with self._lock:
+            self._swap_file(sorted(self._index))
+
+    def _swap_file(self, keys: typing.List[str]) -> None:
+        """
+        Copy `keys` into a new file and replace the current file with it.
+        The file is replaced rather than truncated, views handed out earlier keep pointing at the old data.
+        Windows doesn't replace a file that is still mapped: while such views are alive, PermissionError
+        is raised and the current file is kept.
+        """
+        tmp_path = f"{self._path}.compact"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        target = MmapBackend(tmp_path)
+        target._open()
+        for key in keys:
+            start, length, _ = self._index[key]
+            target._append(key, self._view(start, length))
+        target.close()
+        old_map = self._map
+        self.close()
+        try:
+            old_map.close()
+        except BufferError:
+            pass  # views handed out still use it, it is unmapped when the last one is released
+        try:
+            os.replace(tmp_path, self._path)
+        except PermissionError:
+            os.remove(tmp_path)
+            raise
+        finally:
+            self._open()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                self._file.close()
+            self._file = None
+            self._map = None
+            self._index = {}
+            self._sorted_keys = None
@@ -0,0 +1,185 @@
+"""
+    filename: io_tools/capture.py
+    ~~~~~~~~~~~~~~~~~~~~
+    Screen capture service, concurrent callers share captures and encodes.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import collections
+import concurrent.futures
+import dataclasses
+import itertools
+import threading
+import time
+import typing
+
+
+class CaptureOverloaded(RuntimeError):
+    """Raised when too many callers are already waiting for a capture."""
+
+
+@dataclasses.dataclass
+class CaptureFrame:
+    """CaptureFrame is one grab of all screens"""
+    frame_id: int
+    captured_at: float  # time.monotonic() when the grab finished
+    screens: list  # typing.List[device.ScreenInfo]
+
+    def screen(self, number: int):
+        for info in self.screens:
+            if info.capture_screen_number == number:
+                return info
+        return None
+
+
+class CaptureService:
+    """
+    CaptureService runs screen grabs on its own bounded executor, instead of the shared request threadpool.
+
+    Single-flight: callers that accept a frame up to `max_age` seconds old get the latest frame if it is fresh
+    enough, or join the grab in flight, so N concurrent requests cost one grab. PNG encodes of a frame are
+    shared the same way. When more than `max_queue` callers are waiting, new callers get CaptureOverloaded
+    so the server sheds load instead of piling up threads.
+
+    Example:
+        >>> service = CaptureService(DeviceOperate.get_all_screen_info)
+        >>> frame = service.capture(max_age=0.1).result()
+        >>> frame.screen(1).capture_picture
+    """
+
+    def __init__(self,
+                 grab: typing.Callable[[], list],
+                 max_workers: int = 2,
+                 max_queue: int = 16,
+                 freshness: float = 0.05,
+                 keep_encodes: int = 8) -> None:
+        """
+        Args:
+            grab: The function that grabs all screens, DeviceOperate.get_all_screen_info.
+            max_workers: Threads for grabs and encodes.
+            max_queue: The maximum number of callers waiting for a grab.
+            freshness: The default staleness tolerance in seconds.
+            keep_encodes: The number of encoded screenshots remembered for reuse.
+        """
+        self._grab = grab
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix="capture")
+        self.max_queue = max_queue
+        self.freshness = freshness
+        self._keep_encodes = keep_encodes
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._latest: typing.Optional[CaptureFrame] = None
+        self._inflight: typing.Optional[concurrent.futures.Future] = None
+        self._waiting = 0
+        self._encodes: "collections.OrderedDict[tuple, concurrent.futures.Future]" = collections.OrderedDict()
+        self._counters = collections.Counter()
+        self._listeners: typing.List[typing.Callable[[CaptureFrame], typing.Any]] = []
+
+    def add_listener(self, listener: typing.Callable[[CaptureFrame], typing.Any]) -> None:
+        """
+        Call `listener` with every new frame, on the capture thread: it must return quickly, such as
+        FlightRecorder.feed which only keeps the frame for its own thread.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: typing.Callable[[CaptureFrame], typing.Any]) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _run_grab(self) -> CaptureFrame:
+        try:
+            screens = self._grab()
+            frame = CaptureFrame(next(self._ids), time.monotonic(), screens)
+            with self._lock:
+                self._latest = frame
+        finally:
+            with self._lock:
+                self._inflight = None
+        for listener in list(self._listeners):
+            try:
+                listener(frame)
+            except Exception:
+                self._counters["listener_errors"] += 1
+        return frame
+
+    def capture(self, max_age: typing.Optional[float] = None) -> concurrent.futures.Future:
+        """
+        Get a frame that is at most `max_age` seconds old.
+        Returns:
+            future: A future of CaptureFrame.
+        Raises:
+            CaptureOverloaded: If max_queue callers are already waiting.
+        """
+        max_age = self.freshness if max_age is None else max_age
+        with self._lock:
+            latest = self._latest
+            if latest is not None and time.monotonic() - latest.captured_at <= max_age:
+                self._counters["fresh_hits"] += 1
+                return _resolved(latest)
+            if self._waiting >= self.max_queue:
+                self._counters["shed"] += 1
+                raise CaptureOverloaded(f"{self._waiting} callers are waiting for a capture")
+            if self._inflight is None:
+                self._counters["grabs"] += 1
+                self._inflight = self._executor.submit(self._run_grab)
+            else:
+                self._counters["coalesced"] += 1
+            future = self._inflight
+            self._waiting += 1
+        future.add_done_callback(self._done_waiting)
+        return future
+
+    def _done_waiting(self, _) -> None:
+        with self._lock:
+            self._waiting -= 1
+
+    def encode(self,
+               frame: CaptureFrame,
+               number: int,
+               encoder: typing.Callable[[typing.Any], typing.Any]) -> concurrent.futures.Future:
+        """
+        Encode one screen of a frame once, callers asking for the same frame and screen share the result.
+        Args:
+            frame: The frame.
+            number: The screen number.
+            encoder: Called with the ScreenInfo, returns the encoded result (bytes, a file path, ...).
+        Returns:
+            future: A future of the encoder result, None if the frame has no such screen.
+        """
+        key = (frame.frame_id, number)
+        with self._lock:
+            future = self._encodes.get(key)
+            if future is not None:
+                self._counters["encodes_shared"] += 1
+                return future
+            self._counters["encodes"] += 1
+            info = frame.screen(number)
+            future = self._executor.submit(encoder, info) if info is not None else _resolved(None)
+            self._encodes[key] = future
+            while len(self._encodes) > self._keep_encodes:
+                self._encodes.popitem(last=False)
+            return future
+
+    def forget_encode(self, frame: CaptureFrame, number: int) -> None:
+        """
+        Drop a shared encode result that is no longer usable, such as a deleted file.
+        """
+        with self._lock:
+            self._encodes.pop((frame.frame_id, number), None)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {"waiting": self._waiting, "max_queue": self.max_queue, **self._counters}
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _resolved(value) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    future.set_result(value)
+    return future
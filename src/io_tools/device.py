@@ -556,11 +556,12 @@ def io_press_key(options:list):
         pyautogui.hotkey(*options)
 
 
-def run_shell(cmd_text:str):
+def run_shell(cmd_text:str, timeout:float=None):
     """
-    Run shell command.
+    Run shell command, blocking. Use io_tools.shell.ShellRunner on an event loop or for long outputs.
     Args:
         cmd_text: The command to run.
+        timeout: Seconds before the command is killed and subprocess.TimeoutExpired is raised, no limit by default.
     """
-    result = subprocess.run(cmd_text, shell=True, capture_output=True, text=True)
+    result = subprocess.run(cmd_text, shell=True, capture_output=True, text=True, timeout=timeout)
     return result
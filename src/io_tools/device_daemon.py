@@ -0,0 +1,489 @@
+"""
+    filename: io_tools/device_daemon.py
+    ~~~~~~~~~~~~~~~~~~~~
+    one process owns the screen grabber and the input hooks, API workers attach to it as clients
+
+    The daemon grabs the screens on demand and publishes the pixels in a shared-memory ring of frame slots.
+    Clients ask for a capture over a local socket (unix socket, or named pipe on Windows), get back the slot
+    of the frame, and copy the pixels out of shared memory once, without a pickle or a socket transfer.
+    The copy is what lets callers keep a frame: a slot is reused after `slots` newer frames.
+    Input commands (clicks, keys, recent input events) go over the same socket.
+
+    Ring layout, every part 64-byte aligned:
+        header: magic, slot count, monitors per slot, slot size, id of the latest frame
+        slot:   seq, frame id, capture time, monitor count, monitor table, pixels (BGRA, one block per monitor)
+
+    Each slot is a seqlock: the writer makes `seq` odd while it writes and sets it to 2 * frame id when done,
+    a reader trusts the pixels as long as `seq` still has that value, see SharedScreenShot.valid.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import dataclasses
+import datetime
+import multiprocessing
+import multiprocessing.connection
+import os
+import secrets
+import signal
+import struct
+import sys
+import threading
+import time
+import typing
+from multiprocessing import shared_memory
+
+from .shared_cache import _attach_shared_memory
+
+ENV_ADDRESS = "OAT_DEVICE_DAEMON"
+ENV_AUTHKEY = "OAT_DEVICE_DAEMON_KEY"
+MAGIC = b"OATRING1"
+ALIGN = 64
+_HEADER = struct.Struct("<8sIIQQ")  # magic, slots, max monitors, slot size, latest frame id
+_SLOT = struct.Struct("<QQdI")  # seq, frame id, captured_at (time.monotonic), monitor count
+_MONITOR = struct.Struct("<iiiiiQQ")  # number, left, top, width, height, pixel offset in the slot, nbytes
+_LATEST_OFFSET = 24  # offset of the latest frame id in the header
+
+# the DeviceOperate methods a client may call, screen grabs go through the ring instead
+INPUT_METHODS = frozenset({
+    "get_screen_device_numbers", "get_mouse_position", "set_mouse_position", "simulate_click", "mouse_click",
+    "keyboard_press", "keyboard_write", "keyboard_hotkey", "keyboard_key_down", "keyboard_key_up",
+    "keyboard_is_pressed",
+})
+
+
+class FrameOverwritten(RuntimeError):
+    """Raised when the slot of a frame was reused by a newer frame while it was read."""
+
+
+def _align(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+class FrameRing:
+    """
+    FrameRing is the shared-memory frame ring, the daemon writes it and clients attach to it by name.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool = False) -> None:
+        self._shm = shm
+        self._owner = owner
+        magic, self.slots, self.max_monitors, self.slot_size, _ = _HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("not a frame ring")
+        self._slot_header = _align(_SLOT.size + self.max_monitors * _MONITOR.size)
+
+    @classmethod
+    def create(cls, slots: int, max_monitors: int, max_frame_bytes: int) -> "FrameRing":
+        """
+        Args:
+            slots: The number of frames kept, a reader has slots - 1 newer frames of time to use a frame.
+            max_monitors: The maximum number of monitors in a frame.
+            max_frame_bytes: The maximum size of the pixels of one frame, all monitors together.
+        """
+        slot_header = _align(_SLOT.size + max_monitors * _MONITOR.size)
+        slot_size = slot_header + _align(max_frame_bytes) + max_monitors * ALIGN
+        shm = shared_memory.SharedMemory(create=True, size=ALIGN + slots * slot_size)
+        _HEADER.pack_into(shm.buf, 0, MAGIC, slots, max_monitors, slot_size, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str) -> "FrameRing":
+        return cls(_attach_shared_memory(name))
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def _slot_base(self, frame_id: int) -> int:
+        return ALIGN + (frame_id % self.slots) * self.slot_size
+
+    def latest(self) -> int:
+        return struct.unpack_from("<Q", self._shm.buf, _LATEST_OFFSET)[0]
+
+    def write(self, frame_id: int, captured_at: float, screens: typing.Sequence[tuple]) -> None:
+        """
+        Publish a frame, only the daemon writes.
+        Args:
+            screens: (number, left, top, width, height, pixels) per monitor, pixels are BGRA bytes.
+        Raises:
+            ValueError: If the frame doesn't fit in a slot.
+        """
+        if len(screens) > self.max_monitors:
+            raise ValueError(f"{len(screens)} monitors, the ring was made for {self.max_monitors}")
+        base = self._slot_base(frame_id)
+        buf = self._shm.buf
+        offset = self._slot_header
+        layout = []
+        for number, left, top, width, height, pixels in screens:
+            nbytes = len(pixels)
+            if offset + nbytes > self.slot_size:
+                raise ValueError("the frame is larger than a ring slot, the screen layout changed, restart the daemon")
+            layout.append((number, left, top, width, height, offset, nbytes))
+            offset = _align(offset + nbytes)
+        seq = struct.unpack_from("<Q", buf, base)[0]
+        struct.pack_into("<Q", buf, base, seq | 1)  # odd: being written
+        for (number, left, top, width, height, offset, nbytes), screen in zip(layout, screens):
+            buf[base + offset:base + offset + nbytes] = screen[5]
+        for n, entry in enumerate(layout):
+            _MONITOR.pack_into(buf, base + _SLOT.size + n * _MONITOR.size, *entry)
+        _SLOT.pack_into(buf, base, seq | 1, frame_id, captured_at, len(layout))
+        struct.pack_into("<Q", buf, base, frame_id * 2)
+        struct.pack_into("<Q", buf, _LATEST_OFFSET, frame_id)
+
+    def valid(self, frame_id: int) -> bool:
+        return struct.unpack_from("<Q", self._shm.buf, self._slot_base(frame_id))[0] == frame_id * 2
+
+    def read(self, frame_id: int, copy: bool = False) -> typing.Tuple[float, typing.List["SharedScreenInfo"]]:
+        """
+        Args:
+            copy: Copy the pixels out of the ring, the screens stay valid after the slot is reused.
+                Without it the screens view the shared memory and are only good until then, see SharedScreenShot.valid.
+        Returns:
+            (captured_at, screens)
+        Raises:
+            FrameOverwritten: If the slot holds another frame already, or was reused during the copy.
+        """
+        base = self._slot_base(frame_id)
+        buf = self._shm.buf
+        seq, stored_id, captured_at, count = _SLOT.unpack_from(buf, base)
+        if seq != frame_id * 2 or stored_id != frame_id:
+            raise FrameOverwritten(f"frame {frame_id} was overwritten")
+        screens = []
+        for n in range(count):
+            entry = _MONITOR.unpack_from(buf, base + _SLOT.size + n * _MONITOR.size)
+            number, left, top, width, height, offset, nbytes = entry
+            pixels = buf[base + offset:base + offset + nbytes]
+            pixels = memoryview(bytes(pixels)) if copy else pixels.toreadonly()
+            shot = SharedScreenShot(None if copy else self, frame_id, pixels, left, top, width, height)
+            screens.append(SharedScreenInfo(shot, number, left, top, width, height))
+        if not self.valid(frame_id):
+            raise FrameOverwritten(f"frame {frame_id} was overwritten")
+        return captured_at, screens
+
+    def close(self) -> None:
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+class SharedScreenShot:
+    """
+    SharedScreenShot has the interface of mss ScreenShot (raw, size, rgb, numpy array interface)
+    over pixels of the frame ring, or over a copy of them. np.asarray(shot) is a BGRA view of `raw`.
+    """
+
+    def __init__(self, ring: typing.Optional[FrameRing], frame_id: int, raw: memoryview,
+                 left: int, top: int, width: int, height: int) -> None:
+        self._ring = ring
+        self.frame_id = frame_id
+        self.raw = raw
+        self.pos = (left, top)
+        self.width = width
+        self.height = height
+
+    @property
+    def size(self) -> typing.Tuple[int, int]:
+        return self.width, self.height
+
+    @property
+    def left(self) -> int:
+        return self.pos[0]
+
+    @property
+    def top(self) -> int:
+        return self.pos[1]
+
+    @property
+    def __array_interface__(self) -> dict:
+        return {"version": 3, "shape": (self.height, self.width, 4), "typestr": "|u1", "data": self.raw}
+
+    @property
+    def rgb(self) -> bytes:
+        raw = bytes(self.raw)
+        rgb = bytearray(self.width * self.height * 3)
+        rgb[0::3], rgb[1::3], rgb[2::3] = raw[2::4], raw[1::4], raw[0::4]
+        return bytes(rgb)
+
+    def valid(self) -> bool:
+        """
+        False once the slot was reused, check it after using the pixels of a frame that was held for a while.
+        A copied frame is always valid.
+        """
+        return self._ring is None or self._ring.valid(self.frame_id)
+
+
+@dataclasses.dataclass
+class SharedScreenInfo:
+    """SharedScreenInfo has the fields of device.ScreenInfo that the server uses."""
+    capture_picture: SharedScreenShot
+    capture_screen_number: int
+    screen_left: int
+    screen_top: int
+    screen_width: int
+    screen_height: int
+    capture_time: datetime.datetime = dataclasses.field(default_factory=datetime.datetime.now)
+
+    @property
+    def capture_size(self) -> typing.Tuple[int, int]:
+        return self.screen_width, self.screen_height
+
+
+class DeviceDaemon:
+    """
+    DeviceDaemon serves the screen and the input devices of this process to DeviceClient.
+
+    Requests are tuples (op, *args), supported ops:
+        capture(max_age): grab unless the latest frame is at most max_age seconds old, returns the frame id;
+                          concurrent requests share the grab in flight
+        call(method, args, kwargs): call one of INPUT_METHODS of the device
+        events(kind): recent "mouse" or "keyboard" events of the input listener
+    """
+
+    def __init__(self, device, listener=None, slots: int = 8) -> None:
+        """
+        Args:
+            device: The DeviceOperate.
+            listener: The InputListener, None to serve no input events.
+            slots: The number of frames in the ring.
+        """
+        self._device = device
+        self._listener = listener
+        self._lock = threading.Lock()
+        self._grabbed = threading.Condition(self._lock)
+        self._grabbing = False
+        self._frame_id = 0
+        self._captured_at = 0.0
+        self._stopped = threading.Event()
+        first = device.get_all_screen_info()
+        frame_bytes = sum(len(info.capture_picture.raw) for info in first)
+        self.ring = FrameRing.create(slots, max(len(first) * 2, 4), frame_bytes)
+        self._publish(first, time.monotonic())
+
+    def _publish(self, screens: list, captured_at: float) -> int:
+        frame_id = self._frame_id + 1
+        self.ring.write(frame_id, captured_at, [
+            (info.capture_screen_number, info.screen_left, info.screen_top,
+             info.capture_picture.width, info.capture_picture.height, info.capture_picture.raw)
+            for info in screens
+        ])
+        self._frame_id, self._captured_at = frame_id, captured_at
+        return frame_id
+
+    def capture(self, max_age: float = 0.0) -> int:
+        with self._lock:
+            if self._frame_id and time.monotonic() - self._captured_at <= max_age:
+                return self._frame_id
+            if self._grabbing:  # join the grab in flight
+                current = self._frame_id
+                self._grabbed.wait_for(lambda: not self._grabbing)
+                if self._frame_id != current:
+                    return self._frame_id
+            self._grabbing = True
+        try:
+            screens = self._device.get_all_screen_info()
+            captured_at = time.monotonic()
+            with self._lock:
+                return self._publish(screens, captured_at)
+        finally:
+            with self._lock:
+                self._grabbing = False
+                self._grabbed.notify_all()
+
+    def handle(self, request: tuple):
+        op, *args = request
+        if op == "capture":
+            return self.capture(*args)
+        if op == "call":
+            method, call_args, call_kwargs = args
+            if method not in INPUT_METHODS:
+                raise ValueError(f"{method} can't be called through the daemon")
+            return getattr(self._device, method)(*call_args, **call_kwargs)
+        if op == "events":
+            if self._listener is None:
+                return []
+            if args[0] == "mouse":
+                # pynput buttons and keys are sent as strings, workers don't import pynput
+                return [(x, y, str(button), pressed) for x, y, button, pressed in
+                        self._listener.get_recent_mouse_events()]
+            if args[0] == "keyboard":
+                return [str(key) for key in self._listener.get_recent_keyboard_events()]
+            raise ValueError(f"unknown event kind {args[0]!r}")
+        raise ValueError(f"unknown op {op!r}")
+
+    def _serve_client(self, conn: multiprocessing.connection.Connection) -> None:
+        with conn:
+            while not self._stopped.is_set():
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send((True, self.handle(request)))
+                except Exception as e:
+                    conn.send((False, e))
+
+    def serve_forever(self, listener: multiprocessing.connection.Listener) -> None:
+        try:
+            while not self._stopped.is_set():
+                try:
+                    conn = listener.accept()
+                except (OSError, multiprocessing.AuthenticationError):
+                    continue
+                threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._listener is not None:
+            self._listener.stop()
+        self.ring.close()
+
+
+def _local_devices():
+    from . import device
+
+    input_listener = device.InputListener()
+    input_listener.start()
+    return device.DeviceOperate(), input_listener
+
+
+def _daemon_main(authkey: bytes, ready: multiprocessing.connection.Connection, slots: int, factory) -> None:
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    daemon = DeviceDaemon(*factory(), slots=slots)
+    listener = multiprocessing.connection.Listener(authkey=authkey)
+    ready.send((listener.address, daemon.ring.name))
+    ready.close()
+    daemon.serve_forever(listener)
+
+
+def start_daemon(slots: int = 8, factory: typing.Callable[[], tuple] = _local_devices) -> multiprocessing.Process:
+    """
+    Start the device daemon and export its address in the environment,
+    processes started afterwards (uvicorn workers) attach with DeviceClient.from_env.
+
+    Args:
+        slots: The number of frames in the ring.
+        factory: Creates (device, input listener) in the daemon process, a module level function.
+    Returns:
+        process: The daemon process, it ends with the current process.
+    """
+    authkey = secrets.token_bytes(32)
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_daemon_main, args=(authkey, child, slots, factory),
+                                      name="oat-device-daemon", daemon=True)
+    process.start()
+    child.close()
+    address, ring_name = parent.recv()
+    parent.close()
+    os.environ[ENV_ADDRESS] = f"{ring_name}|{address}"
+    os.environ[ENV_AUTHKEY] = authkey.hex()
+    return process
+
+
+class _RemoteListener:
+    """The part of InputListener the server uses, served by the daemon's listener."""
+
+    def __init__(self, client: "DeviceClient") -> None:
+        self._client = client
+
+    def get_recent_mouse_events(self):
+        return self._client._call("events", "mouse")
+
+    def get_recent_keyboard_events(self):
+        return self._client._call("events", "keyboard")
+
+    def start(self) -> None:
+        pass  # the daemon owns the hooks
+
+    def stop(self) -> None:
+        pass
+
+
+class DeviceClient:
+    """
+    DeviceClient gives a worker process the DeviceOperate interface of the device daemon.
+
+    Example:
+        >>> start_daemon()                     # in the launcher process
+        >>> device = DeviceClient.from_env()   # in every worker
+        >>> screens = device.get_all_screen_info()
+        >>> np.asarray(screens[1].capture_picture)   # BGRA pixels, copied out of the ring
+        >>> device.mouse_click(100, 200, button="left")
+    """
+
+    def __init__(self, address, ring_name: str, authkey: bytes) -> None:
+        self._address = address
+        self._authkey = authkey
+        # one connection per thread, a click doesn't wait behind a capture of another thread
+        self._local = threading.local()
+        self._conns: typing.List[multiprocessing.connection.Connection] = []
+        self._conns_lock = threading.Lock()
+        self.ring = FrameRing.attach(ring_name)
+        self.input_listener = _RemoteListener(self)
+
+    @classmethod
+    def from_env(cls) -> typing.Optional["DeviceClient"]:
+        """
+        Attach to the daemon exported by start_daemon, None if there is none.
+        """
+        spec = os.environ.get(ENV_ADDRESS)
+        if not spec:
+            return None
+        ring_name, address = spec.split("|", 1)
+        return cls(address, ring_name, bytes.fromhex(os.environ[ENV_AUTHKEY]))
+
+    def _conn(self) -> multiprocessing.connection.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = multiprocessing.connection.Client(self._address, authkey=self._authkey)
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def _call(self, *request):
+        conn = self._conn()
+        conn.send(request)
+        ok, result = conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def get_all_screen_info(self, max_age: float = 0.0) -> typing.List[SharedScreenInfo]:
+        """
+        Ask the daemon for a frame at most `max_age` seconds old and copy it out of shared memory.
+
+        The frames go on to the capture cache, PNG encoding, jobs and the flight recorder, which all keep them
+        for longer than the ring keeps a slot, so they get their own pixels.
+        """
+        for _ in range(3):
+            frame_id = self._call("capture", max_age)
+            try:
+                return self.ring.read(frame_id, copy=True)[1]
+            except FrameOverwritten:  # other workers captured a whole ring meanwhile
+                max_age = 0.0
+        raise FrameOverwritten("the frame ring turns over faster than frames can be read, add slots")
+
+    @classmethod
+    def screenshot_to_png(cls, screenshot, save_path: os.PathLike) -> None:
+        import mss.tools
+        mss.tools.to_png(screenshot.rgb, screenshot.size, output=save_path)
+
+    def __getattr__(self, name: str):
+        if name not in INPUT_METHODS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call("call", name, args, kwargs)
+
+    def close(self) -> None:
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
+        try:
+            self.ring.close()
+        except BufferError:
+            pass  # frames are still referenced, the mapping goes away with the process
@@ -0,0 +1,225 @@
+"""
+    filename: io_tools/memoize.py
+    ~~~~~~~~~~~~~~~~~~~~
+    memoization decorator backed by CacheObject
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import inspect
+import math
+import os
+import threading
+import typing
+
+from .cache import CacheObject
+
+_MISS = object()
+
+
+def _update_digest(digest, value, stat: bool = False) -> None:
+    """
+    Feed an argument into the digest.
+
+    numpy arrays and buffers are hashed by content, mss screenshots by their pixels,
+    paths of existing files by path, mtime and size when `stat` is set, everything else by repr.
+    """
+    if value is None or isinstance(value, (bool, int, float, complex)):
+        digest.update(repr(value).encode())
+        return
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        digest.update(b"b")
+        digest.update(value)
+        return
+    if isinstance(value, (str, os.PathLike)):
+        path = os.fspath(value)
+        digest.update(repr(path).encode())
+        if not stat:
+            return
+        try:
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return
+        digest.update(f"@{stat.st_mtime_ns}:{stat.st_size}".encode())
+        return
+    if isinstance(value, (tuple, list)):
+        digest.update(f"{type(value).__name__}[{len(value)}]".encode())
+        for item in value:
+            _update_digest(digest, item, stat)
+        return
+    if isinstance(value, dict):
+        digest.update(f"dict[{len(value)}]".encode())
+        for key in sorted(value, key=repr):
+            _update_digest(digest, key)
+            _update_digest(digest, value[key])
+        return
+    if hasattr(value, "raw") and hasattr(value, "size") and hasattr(value, "pos"):
+        # mss.screenshot.ScreenShot
+        digest.update(f"screenshot{tuple(value.pos)}{tuple(value.size)}".encode())
+        digest.update(value.raw)
+        return
+    if hasattr(value, "__array_interface__") and hasattr(value, "dtype"):
+        # numpy.ndarray
+        digest.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        digest.update(value.data.cast("B") if value.flags.c_contiguous else value.tobytes())
+        return
+    digest.update(repr(value).encode())
+
+
+def make_key(func: typing.Callable, args: tuple, kwargs: dict, paths: typing.Collection[str] = ()) -> str:
+    """
+    Build the cache key of a call from the function name and a content hash of the arguments.
+    Args:
+        paths: The names of the parameters that are file paths, a rewritten file gives a new key.
+            Other strings are hashed as they are, they are never looked up on disk.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if paths:
+        for name, value in inspect.signature(func).bind_partial(*args, **kwargs).arguments.items():
+            digest.update(name.encode())
+            _update_digest(digest, value, name in paths)
+    else:
+        _update_digest(digest, args)
+        _update_digest(digest, kwargs)
+    return f"memo:{func.__module__}.{func.__qualname__}:{digest.hexdigest()}"
+
+
+def cached(ttl: typing.Optional[float] = None,
+           key: typing.Optional[typing.Callable[..., str]] = None,
+           cache: typing.Optional[CacheObject] = None,
+           max_size: typing.Optional[int] = None,
+           paths: typing.Collection[str] = ()):
+    """
+    Memoize a sync or async function in CacheObject.
+
+    Results are stored as volatile cache keys, they expire after `ttl` and are never persisted.
+    Concurrent callers of the same key share one in-flight computation (single-flight),
+    exceptions are passed to every waiting caller and are not cached.
+
+    Args:
+        ttl: Time to live of a result in seconds, None to keep it for the life of the process.
+        key: A function called with the same arguments as the decorated function that returns the key,
+            by default the key is a content hash of the arguments (see make_key).
+        cache: The CacheObject or SharedCacheClient to use, the CacheObject singleton by default.
+        max_size: The most results kept for the function, the oldest are dropped first. None for no limit.
+        paths: The names of the parameters that are file paths, see make_key.
+
+    Example:
+        >>> @cached(ttl=1.0)
+        ... def get_all_processes(): ...
+        >>> @cached(ttl=600, max_size=64, paths=("src", "template"))
+        ... def find_scale_and_position(src, template, **kw): ...
+        >>> @cached(key=lambda src, template, **kw: f"scale:{src}:{template}")
+        ... def find_scale_and_position(src, template, **kw): ...
+    """
+    lifetime = math.inf if ttl is None else ttl
+
+    def decorator(func):
+        # the keys stored by this function, oldest first, to drop the oldest past max_size
+        stored: typing.Dict[str, None] = {}
+        stored_lock = threading.Lock()
+
+        def cache_key(args, kwargs) -> str:
+            if key is not None:
+                return f"memo:{func.__module__}.{func.__qualname__}:{key(*args, **kwargs)}"
+            return make_key(func, args, kwargs, paths)
+
+        def store() -> CacheObject:
+            return cache if cache is not None else CacheObject()
+
+        def remember(k: str, value) -> None:
+            target = store()
+            target.set(k, value, ttl=lifetime)
+            if max_size is None:
+                return
+            with stored_lock:
+                stored.pop(k, None)
+                stored[k] = None
+                evicted = []
+                while len(stored) > max_size:
+                    evicted.append(next(iter(stored)))
+                    del stored[evicted[-1]]
+            for old in evicted:
+                if old in target:  # it may have expired already
+                    target.remove(old)
+
+        if inspect.iscoroutinefunction(func):
+            inflight: typing.Dict[typing.Tuple[int, str], asyncio.Future] = {}
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                k = cache_key(args, kwargs)
+                value = store().get(k, _MISS)
+                if value is not _MISS:
+                    return value
+                loop = asyncio.get_running_loop()
+                slot = (id(loop), k)
+                future = inflight.get(slot)
+                if future is not None:
+                    return await asyncio.shield(future)
+                future = loop.create_future()
+                inflight[slot] = future
+                try:
+                    value = await func(*args, **kwargs)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except BaseException as e:
+                    future.set_exception(e)
+                    future.exception()  # mark as retrieved when nobody else is waiting
+                    raise
+                else:
+                    remember(k, value)
+                    future.set_result(value)
+                    return value
+                finally:
+                    inflight.pop(slot, None)
+
+            async_wrapper.cache_key = cache_key
+            return async_wrapper
+
+        inflight_lock = threading.Lock()
+        inflight: typing.Dict[str, concurrent.futures.Future] = {}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            k = cache_key(args, kwargs)
+            value = store().get(k, _MISS)
+            if value is not _MISS:
+                return value
+            with inflight_lock:
+                future = inflight.get(k)
+                owner = future is None
+                if owner:
+                    # the previous owner may have finished between the lookup above and taking the lock
+                    value = store().get(k, _MISS)
+                    if value is not _MISS:
+                        return value
+                    future = concurrent.futures.Future()
+                    inflight[k] = future
+            if not owner:
+                return future.result()
+            try:
+                value = func(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            else:
+                remember(k, value)
+                future.set_result(value)
+                return value
+            finally:
+                with inflight_lock:
+                    inflight.pop(k, None)
+
+        wrapper.cache_key = cache_key
+        return wrapper
+
+    return decorator
+
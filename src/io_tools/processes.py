@@ -0,0 +1,338 @@
+"""
+    filename: io_tools/processes.py
+    ~~~~~~~~~~~~~~~~~~~~
+    Process table snapshots, refreshed incrementally.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import dataclasses
+import threading
+import typing
+
+ATTRS = ("pid", "ppid", "name", "status", "exe", "create_time")
+
+
+@dataclasses.dataclass(frozen=True)
+class ProcessInfo:
+    """ProcessInfo is the part of a process that doesn't change while it runs, plus its status at the last refresh"""
+    pid: int
+    ppid: int
+    name: str
+    status: str
+    exe: str
+    create_time: float
+
+
+class ProcessProvider:
+    """
+    ProcessProvider is where a snapshot reads the process table from, psutil in production, a fake in tests.
+    """
+
+    def pids(self) -> typing.Iterable[int]:
+        """
+        The pids alive now, a cheap call.
+        """
+        raise NotImplementedError
+
+    def info(self, pids: typing.Optional[typing.Iterable[int]] = None) -> typing.Iterator[dict]:
+        """
+        The ATTRS of the given pids, of every process for None. Processes that are gone are skipped.
+        """
+        raise NotImplementedError
+
+    def statuses(self, pids: typing.Iterable[int]) -> typing.Dict[int, str]:
+        """
+        The status of the given pids, the one attribute that changes while a process runs.
+        Processes that are gone are left out.
+        """
+        raise NotImplementedError
+
+
+class PsutilProvider(ProcessProvider):
+    def __init__(self) -> None:
+        import psutil
+
+        self._psutil = psutil
+
+    def pids(self) -> typing.Iterable[int]:
+        return self._psutil.pids()
+
+    def info(self, pids: typing.Optional[typing.Iterable[int]] = None) -> typing.Iterator[dict]:
+        psutil = self._psutil
+        if pids is None:
+            # one pass over the table, attributes read together, vanished processes skipped by psutil
+            for process in psutil.process_iter(attrs=list(ATTRS), ad_value=None):
+                yield process.info
+            return
+        for pid in pids:
+            try:
+                yield psutil.Process(pid).as_dict(attrs=list(ATTRS), ad_value=None)
+            except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                continue
+
+    def statuses(self, pids: typing.Iterable[int]) -> typing.Dict[int, str]:
+        wanted = set(pids)
+        # process_iter keeps its Process objects between calls, a status read is one cheap call per process
+        return {process.pid: process.info["status"] or ""
+                for process in self._psutil.process_iter(attrs=["status"], ad_value=None)
+                if process.pid in wanted}
+
+
+class ProcessSnapshot:
+    """
+    ProcessSnapshot keeps the process table and the parent to children map in memory.
+
+    `refresh` lists the pids, which is cheap, reads the attributes of new pids and only the status of the others,
+    processes that exited meanwhile are dropped instead of raising. Readers get consistent dicts,
+    a refresh builds new ones and swaps them in.
+
+    Example:
+        >>> snapshot = ProcessSnapshot()
+        >>> snapshot.refresh()
+        >>> snapshot.by_name("notepad.exe")
+        [ProcessInfo(pid=4242, ppid=1000, name='notepad.exe', ...)]
+        >>> snapshot.children_of(1000)
+    """
+
+    def __init__(self, provider: typing.Optional[ProcessProvider] = None) -> None:
+        self._provider = provider
+        self._lock = threading.Lock()
+        self.processes: typing.Dict[int, ProcessInfo] = {}
+        self.children: typing.Dict[int, typing.List[int]] = {}
+        self._names: typing.Dict[str, typing.List[int]] = {}
+        self.generation = 0
+
+    @property
+    def provider(self) -> ProcessProvider:
+        if self._provider is None:
+            self._provider = PsutilProvider()
+        return self._provider
+
+    def refresh(self, full: bool = False) -> typing.Tuple[typing.List[int], typing.List[int]]:
+        """
+        Bring the snapshot up to date.
+        Args:
+            full: Read every process again, such as to catch a pid reused between two refreshes.
+        Returns:
+            (added, removed): the pids that appeared and disappeared.
+        """
+        with self._lock:
+            previous = self.processes
+            changed = full
+            if full or not previous:
+                processes = {}
+                for info in self.provider.info():
+                    process = _to_process(info)
+                    processes[process.pid] = process
+            else:
+                alive = set(self.provider.pids())
+                processes = {pid: process for pid, process in previous.items() if pid in alive}
+                statuses = self.provider.statuses(list(processes))
+                for pid, process in list(processes.items()):
+                    status = statuses.get(pid)
+                    if status is None:  # exited since pids()
+                        del processes[pid]
+                    elif status != process.status:
+                        processes[pid] = dataclasses.replace(process, status=status)
+                        changed = True
+                for info in self.provider.info(sorted(alive - processes.keys())):
+                    process = _to_process(info)
+                    processes[process.pid] = process
+            added = [pid for pid in processes if pid not in previous]
+            removed = [pid for pid in previous if pid not in processes]
+            if added or removed or changed:
+                self._swap(processes)
+            return added, removed
+
+    def _swap(self, processes: typing.Dict[int, ProcessInfo]) -> None:
+        # one pass for children and names, instead of one process table scan per process
+        children: typing.Dict[int, typing.List[int]] = {}
+        names: typing.Dict[str, typing.List[int]] = {}
+        for pid, process in processes.items():
+            if process.ppid != pid:
+                children.setdefault(process.ppid, []).append(pid)
+            names.setdefault(process.name, []).append(pid)
+        self.processes, self.children, self._names = processes, children, names
+        self.generation += 1
+
+    def get(self, pid: int) -> typing.Optional[ProcessInfo]:
+        return self.processes.get(pid)
+
+    def by_name(self, name: str) -> typing.List[ProcessInfo]:
+        processes = self.processes
+        return [processes[pid] for pid in self._names.get(name, ()) if pid in processes]
+
+    def children_of(self, pid: int, recursive: bool = False) -> typing.List[int]:
+        children = self.children
+        found = list(children.get(pid, ()))
+        if recursive:
+            seen = set(found)
+            for child in found:  # found grows while it is walked
+                for grandchild in children.get(child, ()):
+                    if grandchild not in seen:
+                        seen.add(grandchild)
+                        found.append(grandchild)
+        return found
+
+    def __len__(self):
+        return len(self.processes)
+
+    def __iter__(self) -> typing.Iterator[ProcessInfo]:
+        return iter(list(self.processes.values()))
+
+
+def _to_process(info: dict) -> ProcessInfo:
+    return ProcessInfo(
+        pid=info["pid"],
+        ppid=info.get("ppid") or 0,
+        name=info.get("name") or "",
+        status=info.get("status") or "",
+        exe=info.get("exe") or "",
+        create_time=info.get("create_time") or 0.0,
+    )
+
+
+class WindowProvider:
+    """
+    WindowProvider lists the top-level windows of processes, Win32 in production, a fake in tests.
+    """
+
+    def windows(self) -> typing.Dict[int, typing.List[int]]:
+        """
+        Every visible top-level window, as pid -> window handles, in one enumeration.
+        """
+        raise NotImplementedError
+
+
+class ProcessIndex:
+    """
+    ProcessIndex maps process names to pids, and pids to their top-level window handles.
+
+    Lookups are dict reads, `refresh` brings the snapshot up to date incrementally and enumerates
+    the windows once, ProcessWatcher calls it in the background.
+
+    Example:
+        >>> index = ProcessIndex(ProcessSnapshot(), windows=Win32WindowProvider())
+        >>> index.refresh()
+        >>> index.windows_of_name("notepad.exe")
+        {4242: [132456]}
+    """
+
+    def __init__(self, snapshot: ProcessSnapshot, windows: typing.Optional[WindowProvider] = None) -> None:
+        self.snapshot = snapshot
+        self._window_provider = windows
+        self._windows: typing.Dict[int, typing.List[int]] = {}
+        self._lock = threading.Lock()
+
+    def refresh(self) -> typing.Tuple[typing.List[int], typing.List[int]]:
+        """
+        Returns:
+            (added, removed): the pids that appeared and disappeared since the last refresh.
+        """
+        with self._lock:
+            added, removed = self.snapshot.refresh()
+            if self._window_provider is not None:
+                # windows come and go without processes changing, such as a game showing its window late
+                self._windows = self._window_provider.windows()
+            return added, removed
+
+    def pids(self, name: str) -> typing.List[int]:
+        return [process.pid for process in self.snapshot.by_name(name)]
+
+    def windows(self, pid: int) -> typing.List[int]:
+        return list(self._windows.get(pid, ()))
+
+    def windows_of_name(self, name: str) -> typing.Dict[int, typing.List[int]]:
+        windows = self._windows
+        return {pid: list(windows.get(pid, ())) for pid in self.pids(name)}
+
+
+class ProcessWatcher:
+    """
+    ProcessWatcher refreshes a ProcessIndex every `interval` seconds on a daemon thread,
+    and calls the listeners with (added, removed) when processes appear or disappear.
+    """
+
+    def __init__(self, index: ProcessIndex, interval: float = 2.0) -> None:
+        self.index = index
+        self.interval = interval
+        self._listeners: typing.List[typing.Callable[[typing.List[int], typing.List[int]], typing.Any]] = []
+        self._stopped = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    def add_listener(self, listener: typing.Callable[[typing.List[int], typing.List[int]], typing.Any]) -> None:
+        self._listeners.append(listener)
+
+    def poll(self) -> None:
+        added, removed = self.index.refresh()
+        if added or removed:
+            for listener in list(self._listeners):
+                listener(added, removed)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                continue  # a failed enumeration is retried on the next tick
+
+    def start(self) -> None:
+        if self._thread is None:
+            self.poll()
+            self._thread = threading.Thread(target=self._run, name="process-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+class AppHandleCache:
+    """
+    AppHandleCache keeps one connected application handle per process, such as a pywinauto Application.
+
+    A handle is reused while its process is alive in the snapshot with the same create time,
+    so a pid reused by another process gets a new connection. Call `invalidate` when a handle fails.
+    """
+
+    def __init__(self, snapshot: ProcessSnapshot, connect: typing.Callable[[int], typing.Any]) -> None:
+        """
+        Args:
+            snapshot: The snapshot that tells which processes are alive.
+            connect: Connects to a pid and returns the handle, it is slow.
+        """
+        self._snapshot = snapshot
+        self._connect = connect
+        self._handles: typing.Dict[int, typing.Tuple[float, typing.Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, pid: int):
+        process = self._snapshot.get(pid)
+        if process is None:
+            self.invalidate(pid)
+            raise LookupError(f"process {pid} is not running")
+        with self._lock:
+            cached = self._handles.get(pid)
+            if cached is not None and cached[0] == process.create_time:
+                return cached[1]
+        handle = self._connect(pid)
+        with self._lock:
+            self._handles[pid] = (process.create_time, handle)
+        return handle
+
+    def invalidate(self, pid: int) -> None:
+        with self._lock:
+            self._handles.pop(pid, None)
+
+    def prune(self, added: typing.List[int] = (), removed: typing.List[int] = ()) -> None:
+        """
+        Drop the handles of exited processes, a ProcessWatcher listener.
+        """
+        with self._lock:
+            for pid in removed:
+                self._handles.pop(pid, None)
+
+    def __len__(self):
+        return len(self._handles)
@@ -0,0 +1,435 @@
+"""
+    filename: io_tools/recorder.py
+    ~~~~~~~~~~~~~~~~~~~~
+    Screen flight recorder: captured frames kept on disk as keyframe + tile delta segments, with a time index.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import bisect
+import os
+import struct
+import threading
+import time
+import typing
+import zlib
+
+import numpy as np
+
+MAGIC = b"OATR"
+VERSION = 1
+KEYFRAME, DELTA = 0, 1
+# magic, version, channels, width, height, tile size, start (unix time)
+_HEADER = struct.Struct("<4sHHIIHd")
+# one entry per frame in the .idx file: unix time, payload offset and length in the .oatrec file,
+# kind, entry number of the keyframe the frame is decoded from
+INDEX = np.dtype([("t", "<f8"), ("offset", "<u8"), ("length", "<u4"), ("kind", "u1"), ("key", "<u4")])
+_ENTRY = struct.Struct("<dQIBI")
+_COUNT = struct.Struct("<I")
+
+
+class Segment:
+    """
+    Segment is one recording file and its index: `<start ms>.oatrec` and `<start ms>.idx`.
+
+    The .oatrec file is a header followed by zlib payloads: a keyframe is the whole BGR frame,
+    a delta is the list of the tiles that changed since the previous frame and their pixels.
+    """
+
+    def __init__(self, directory: str, start: float, width: int = 0, height: int = 0, tile: int = 32) -> None:
+        self.directory = directory
+        self.start = start
+        self.width = width
+        self.height = height
+        self.tile = tile
+        self.end = start
+        self.frames = 0
+        name = os.path.join(directory, f"{int(start * 1000)}")
+        self.data_path = name + ".oatrec"
+        self.index_path = name + ".idx"
+        self._data = None
+        self._index = None
+        self._index_cache: typing.Optional[np.ndarray] = None  # the index of a closed segment
+        self._size: typing.Optional[int] = None  # the size of a closed segment
+
+    @classmethod
+    def open(cls, data_path: str) -> "Segment":
+        """Open a segment written before, such as by a previous run."""
+        with open(data_path, "rb") as f:
+            magic, version, _, width, height, tile, start = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{data_path} is not a recording")
+        segment = cls(os.path.dirname(data_path), start, width, height, tile)
+        index = segment.index()
+        segment.frames = len(index)
+        segment.end = float(index["t"][-1]) if len(index) else start
+        segment._index_cache = index
+        return segment
+
+    @property
+    def writing(self) -> bool:
+        return self._data is not None
+
+    @property
+    def size(self) -> int:
+        if self._size is not None:
+            return self._size
+        total = 0
+        for path in (self.data_path, self.index_path):
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        if not self.writing:
+            self._size = total
+        return total
+
+    def create(self) -> None:
+        self._data = open(self.data_path, "wb")
+        self._index = open(self.index_path, "wb")
+        self._data.write(_HEADER.pack(MAGIC, VERSION, 3, self.width, self.height, self.tile, self.start))
+
+    def append(self, kind: int, t: float, payload: bytes, key: int) -> int:
+        offset = self._data.tell()
+        self._data.write(payload)
+        self._data.flush()  # the payload is on disk before its index entry, readers never see a partial frame
+        self._index.write(_ENTRY.pack(t, offset, len(payload), kind, key))
+        self._index.flush()
+        self.frames += 1
+        self.end = t
+        return self.frames - 1
+
+    def close(self) -> None:
+        if self._data is not None:
+            self._data.close()
+            self._index.close()
+            self._data = self._index = None
+
+    def index(self) -> np.ndarray:
+        if self._index_cache is not None:
+            return self._index_cache
+        try:
+            with open(self.index_path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return np.zeros(0, dtype=INDEX)
+        complete = len(raw) // INDEX.itemsize * INDEX.itemsize  # an entry being written is left out
+        index = np.frombuffer(raw[:complete], dtype=INDEX)
+        if not self.writing:
+            self._index_cache = index
+        return index
+
+    def nearest(self, t: float) -> typing.Optional[typing.Tuple[int, float]]:
+        """
+        Returns:
+            (entry, timestamp) of the frame nearest `t`, None for an empty segment.
+        """
+        times = self.index()["t"]
+        if not len(times):
+            return None
+        n = int(np.searchsorted(times, t))
+        candidates = [m for m in (n - 1, n) if 0 <= m < len(times)]
+        best = min(candidates, key=lambda m: abs(times[m] - t))
+        return best, float(times[best])
+
+    def decode(self, entry: int) -> np.ndarray:
+        """
+        Decode one frame: its keyframe and the deltas up to it, not the whole segment.
+        Returns:
+            The BGR frame, (height, width, 3) uint8.
+        """
+        index = self.index()
+        key = int(index["key"][entry])
+        canvas = np.empty((_padded(self.height, self.tile), _padded(self.width, self.tile), 3), dtype=np.uint8)
+        with open(self.data_path, "rb") as f:
+            for row in index[key:entry + 1]:
+                f.seek(int(row["offset"]))
+                payload = zlib.decompress(f.read(int(row["length"])))
+                if row["kind"] == KEYFRAME:
+                    canvas[...] = np.frombuffer(payload, dtype=np.uint8).reshape(canvas.shape)
+                else:
+                    _apply_delta(canvas, payload, self.tile)
+        return canvas[:self.height, :self.width]
+
+    def to_dict(self) -> dict:
+        return {"start": self.start, "end": self.end, "frames": self.frames, "bytes": self.size,
+                "width": self.width, "height": self.height, "writing": self.writing}
+
+
+def _padded(size: int, tile: int) -> int:
+    return -(-size // tile) * tile
+
+
+def _tiles(canvas: np.ndarray, tile: int) -> np.ndarray:
+    # (rows, columns, tile, tile, 3) view of a padded canvas, writing to it writes to the canvas
+    height, width = canvas.shape[:2]
+    return canvas.reshape(height // tile, tile, width // tile, tile, 3).swapaxes(1, 2)
+
+
+def _apply_delta(canvas: np.ndarray, payload: bytes, tile: int) -> None:
+    (count,) = _COUNT.unpack_from(payload)
+    changed = np.frombuffer(payload, dtype="<u4", count=count, offset=_COUNT.size)
+    pixels = np.frombuffer(payload, dtype=np.uint8, offset=_COUNT.size + 4 * count).reshape(count, tile, tile, 3)
+    tiles = _tiles(canvas, tile)
+    columns = tiles.shape[1]
+    tiles[changed // columns, changed % columns] = pixels
+
+
+class FlightRecorder:
+    """
+    FlightRecorder keeps a rolling on-disk history of one monitor, to look at the screen of a misbehaving run
+    after the fact.
+
+    Frames are fed by a CaptureService listener, so frames grabbed for other reasons are recorded for free,
+    and `start` asks for a frame every `interval` when nobody else captures. A frame is stored as the
+    tiles that changed since the previous one, zlib level 1, with a full keyframe every `keyframe_every`
+    frames and when most of the screen changed. Segments rotate every `segment_seconds`.
+
+    Budgets: the oldest segments are deleted past `max_bytes`, and frames are dropped when encoding
+    would take more than `cpu_budget` of one core, measured per frame.
+
+    Example:
+        >>> recorder = FlightRecorder("recordings", monitor=1, interval=0.5, max_bytes=1 << 30)
+        >>> capture.add_listener(recorder.feed)
+        >>> recorder.start(request=lambda: capture.capture(0.5))
+        >>> timestamp, frame = recorder.frame_at(time.time() - 30)   # the screen 30 seconds ago
+    """
+
+    def __init__(self,
+                 directory: str,
+                 monitor: int = 0,
+                 interval: float = 0.5,
+                 segment_seconds: float = 60.0,
+                 keyframe_every: int = 60,
+                 tile: int = 32,
+                 max_bytes: int = 1 << 30,
+                 cpu_budget: float = 0.1,
+                 level: int = 1) -> None:
+        """
+        Args:
+            directory: Where segments are written, segments found there are part of the history.
+            monitor: The screen number to record, 0 is all monitors.
+            interval: The minimum seconds between two recorded frames.
+            segment_seconds: The length of a segment, the unit of deletion.
+            keyframe_every: The frames between two keyframes, the most frames a query decodes.
+            tile: The tile size of deltas in pixels.
+            max_bytes: The disk budget of the recordings.
+            cpu_budget: The share of one core encoding may use.
+            level: The zlib level.
+        """
+        self.directory = directory
+        self.monitor = monitor
+        self.interval = interval
+        self.segment_seconds = segment_seconds
+        self.keyframe_every = keyframe_every
+        self.tile = tile
+        self.max_bytes = max_bytes
+        self.cpu_budget = cpu_budget
+        self.level = level
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._segments: typing.List[Segment] = self._scan()
+        self._current: typing.Optional[Segment] = None
+        self._previous: typing.Optional[np.ndarray] = None  # the padded canvas of the last frame written
+        self._key = 0
+        self._since_key = 0
+        self._next_at = 0.0  # unix time before which fed frames are dropped
+        self._cost = 0.0  # seconds of CPU per frame, smoothed
+        self._pending = None
+        self._cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+        self.recorded = 0
+        self.dropped = 0
+        self.keyframes = 0
+
+    def _scan(self) -> typing.List[Segment]:
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".oatrec"):
+                try:
+                    segments.append(Segment.open(os.path.join(self.directory, name)))
+                except (OSError, ValueError, struct.error):
+                    continue  # a damaged file is left alone, and not in the history
+        return sorted(segments, key=lambda segment: segment.start)
+
+    def feed(self, frame) -> None:
+        """
+        A CaptureService listener: keep the recorded screen of a CaptureFrame for the encoder thread.
+        It never blocks the capture, a frame the encoder has no time for replaces the one waiting.
+        """
+        info = frame.screen(self.monitor)
+        if info is None or info.capture_picture is None:
+            return
+        # captured_at is monotonic, the history is queried by wall clock time
+        timestamp = time.time() - (time.monotonic() - frame.captured_at)
+        with self._cond:
+            if timestamp < self._next_at:
+                self.dropped += 1
+                return
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = (timestamp, info.capture_picture)
+            self._cond.notify()
+
+    def record(self, image, timestamp: typing.Optional[float] = None) -> None:
+        """
+        Encode and write one frame now.
+        Args:
+            image: A mss ScreenShot or a BGRA/BGR ndarray.
+            timestamp: Unix time of the capture, now by default.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        started = time.thread_time()
+        frame = _as_array(image)
+        height, width = frame.shape[:2]
+        with self._lock:
+            current = self._current
+            if current is None or timestamp - current.start >= self.segment_seconds \
+                    or (current.width, current.height) != (width, height):
+                current = self._rotate(timestamp, width, height)
+            canvas = np.zeros((_padded(height, self.tile), _padded(width, self.tile), 3), dtype=np.uint8)
+            canvas[:height, :width] = frame[:, :, :3]
+            kind, payload = self._encode(canvas)
+            # a keyframe is its own key, it decodes on its own
+            key = current.frames if kind == KEYFRAME else self._key
+            entry = current.append(kind, timestamp, payload, key)
+            if kind == KEYFRAME:
+                self._key = entry
+                self._since_key = 0
+                self.keyframes += 1
+            self._since_key += 1
+            self._previous = canvas
+            self.recorded += 1
+            self._enforce_disk_budget()
+        cost = time.thread_time() - started
+        self._cost = cost if self.recorded == 1 else 0.8 * self._cost + 0.2 * cost
+        # the next frame is taken when the encode of this one fits the budget
+        self._next_at = timestamp + max(self.interval, self._cost / self.cpu_budget)
+
+    def _encode(self, canvas: np.ndarray) -> typing.Tuple[int, bytes]:
+        previous = self._previous
+        if previous is not None and self._since_key < self.keyframe_every:
+            tiles = _tiles(canvas, self.tile)
+            changed = (tiles != _tiles(previous, self.tile)).any(axis=(2, 3, 4))
+            count = int(changed.sum())
+            if count * 2 < changed.size:  # a delta of most of the screen is no smaller than a keyframe
+                numbers = np.flatnonzero(changed).astype("<u4")
+                body = _COUNT.pack(count) + numbers.tobytes() + tiles[changed].tobytes()
+                return DELTA, zlib.compress(body, self.level)
+        return KEYFRAME, zlib.compress(canvas.tobytes(), self.level)
+
+    def _rotate(self, timestamp: float, width: int, height: int) -> Segment:
+        if self._current is not None:
+            self._current.close()
+        segment = Segment(self.directory, timestamp, width, height, self.tile)
+        segment.create()
+        self._segments.append(segment)
+        self._current = segment
+        self._previous = None  # a segment starts with a keyframe, it decodes on its own
+        self._key = 0  # entry numbers start again, the last key was in the old segment
+        return segment
+
+    def _enforce_disk_budget(self) -> None:
+        total = sum(segment.size for segment in self._segments)
+        while total > self.max_bytes and len(self._segments) > 1:
+            oldest = self._segments[0]
+            size = oldest.size
+            try:
+                for path in (oldest.data_path, oldest.index_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+            except OSError:
+                break  # open by a reader on Windows, retried after the next frame
+            self._segments.pop(0)
+            total -= size
+
+    def _run(self, request: typing.Optional[typing.Callable[[], typing.Any]]) -> None:
+        while not self._stopped.is_set():
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None or self._stopped.is_set(),
+                                    timeout=self.interval)
+                pending, self._pending = self._pending, None
+            if pending is not None:
+                try:
+                    self.record(pending[1], pending[0])
+                except Exception:
+                    continue  # a frame that can't be written is skipped, the recording goes on
+            elif request is not None and time.time() >= self._next_at:
+                try:
+                    request()  # the listener feeds the frame
+                except Exception:
+                    continue
+
+    def start(self, request: typing.Optional[typing.Callable[[], typing.Any]] = None) -> None:
+        """
+        Start the encoder thread.
+        Args:
+            request: Called when no frame came for `interval` seconds, such as lambda: capture.capture(interval).
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(request,), name="flight-recorder", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 2.0) -> None:
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        with self._lock:
+            if self._current is not None:
+                self._current.close()
+                self._current = None
+
+    def segments(self) -> typing.List[dict]:
+        with self._lock:
+            return [segment.to_dict() for segment in self._segments]
+
+    def frame_at(self, timestamp: float) -> typing.Optional[typing.Tuple[float, np.ndarray]]:
+        """
+        The recorded frame nearest `timestamp`.
+        Returns:
+            (the unix time of the frame, the BGR frame), None when nothing is recorded.
+        """
+        with self._lock:
+            segments = list(self._segments)
+        starts = [segment.start for segment in segments]
+        n = bisect.bisect_right(starts, timestamp)
+        best = None
+        # the segment that covers the timestamp, or the next one when it is past the end of it
+        for segment in segments[max(0, n - 1):n + 1]:
+            found = segment.nearest(timestamp)
+            if found is not None and (best is None or abs(found[1] - timestamp) < abs(best[2] - timestamp)):
+                best = (segment, found[0], found[1])
+        if best is None:
+            return None
+        segment, entry, found_at = best
+        try:
+            return found_at, segment.decode(entry)
+        except FileNotFoundError:
+            return None  # deleted by the disk budget meanwhile
+
+    def metrics(self) -> dict:
+        with self._lock:
+            total = sum(segment.size for segment in self._segments)
+            count = len(self._segments)
+        return {
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "keyframes": self.keyframes,
+            "segments": count,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "encode_ms": self._cost * 1000,
+            "cpu_share": self._cost / max(self.interval, self._cost / self.cpu_budget) if self._cost else 0.0,
+        }
+
+
+def _as_array(image) -> np.ndarray:
+    if isinstance(image, np.ndarray):
+        return image if image.ndim == 3 else np.repeat(image[:, :, None], 3, axis=2)
+    # a mss ScreenShot: its raw BGRA buffer, without copying
+    return np.frombuffer(image.raw, dtype=np.uint8).reshape(image.height, image.width, 4)
@@ -0,0 +1,268 @@
+"""
+    filename: io_tools/sampler.py
+    ~~~~~~~~~~~~~~~~~~~~
+    Per process resource sampling (cpu, memory, io) with a fixed-size history.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import threading
+import time
+import typing
+
+import numpy as np
+
+FIELDS = ("cpu_percent", "rss_bytes", "read_bytes_per_s", "write_bytes_per_s")
+
+
+class ProcessGone(Exception):
+    """Raised by a SampleProvider when the process exited."""
+
+
+class SampleProvider:
+    """
+    SampleProvider reads the counters of one process, psutil in production, a fake in tests.
+    """
+
+    def sample(self, pid: int) -> typing.Tuple[float, float, float, float]:
+        """
+        Returns:
+            (cpu_percent since the previous call, rss bytes, cumulative read bytes, cumulative write bytes)
+        Raises:
+            ProcessGone: If the process exited.
+        """
+        raise NotImplementedError
+
+    def forget(self, pid: int) -> None:
+        pass
+
+
+class PsutilSampleProvider(SampleProvider):
+    def __init__(self) -> None:
+        import psutil
+
+        self._psutil = psutil
+        self._processes: typing.Dict[int, typing.Any] = {}  # cpu_percent needs the same object between calls
+
+    def sample(self, pid: int) -> typing.Tuple[float, float, float, float]:
+        psutil = self._psutil
+        try:
+            process = self._processes.get(pid)
+            if process is None:
+                process = self._processes[pid] = psutil.Process(pid)
+            with process.oneshot():
+                cpu = process.cpu_percent(interval=None)
+                rss = process.memory_info().rss
+                try:
+                    io = process.io_counters()
+                    read, write = io.read_bytes, io.write_bytes
+                except (psutil.AccessDenied, AttributeError):  # not readable, or not on this platform
+                    read = write = 0
+            return cpu, rss, read, write
+        except (psutil.NoSuchProcess, psutil.ZombieProcess):
+            self.forget(pid)
+            raise ProcessGone(pid)
+
+    def forget(self, pid: int) -> None:
+        self._processes.pop(pid, None)
+
+
+class RingSeries:
+    """
+    RingSeries keeps the last `capacity` samples of FIELDS in preallocated numpy arrays,
+    appending never allocates.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, len(FIELDS)), dtype=np.float64)
+        self._next = 0
+        self._count = 0
+
+    def append(self, timestamp: float, values: typing.Sequence[float]) -> None:
+        self.times[self._next] = timestamp
+        self.values[self._next] = values
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def ordered(self) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            (times, values): copies, oldest first.
+        """
+        if self._count < self.capacity:
+            return self.times[:self._count].copy(), self.values[:self._count].copy()
+        order = np.roll(np.arange(self.capacity), -self._next)
+        return self.times[order], self.values[order]
+
+    def __len__(self):
+        return self._count
+
+
+def summarize(times: np.ndarray, values: np.ndarray) -> dict:
+    """
+    avg, p95, last and trend (change per minute, least squares) of every field.
+    """
+    if len(times) == 0:
+        return {field: None for field in FIELDS}
+    stats = {}
+    avg = values.mean(axis=0)
+    p95 = np.percentile(values, 95, axis=0)
+    if len(times) > 1 and times[-1] > times[0]:
+        t = times - times.mean()
+        slope = (t[:, None] * (values - avg)).sum(axis=0) / (t * t).sum() * 60
+    else:
+        slope = np.zeros(len(FIELDS))
+    for n, field in enumerate(FIELDS):
+        stats[field] = {"avg": float(avg[n]), "p95": float(p95[n]), "last": float(values[-1, n]),
+                        "trend_per_min": float(slope[n])}
+    return stats
+
+
+class ResourceSampler:
+    """
+    ResourceSampler samples a watched set of processes every `interval` seconds on a daemon thread.
+
+    Its own cost is measured per tick (thread CPU time). When a tick costs more than `max_overhead` of the
+    interval, the interval is stretched until it doesn't, so the sampler never takes more than that share
+    of a core away from the game it watches.
+
+    Example:
+        >>> sampler = ResourceSampler(interval=1.0, capacity=600)
+        >>> sampler.watch(4242)
+        >>> sampler.start()
+        >>> sampler.stats(4242, seconds=60)
+        {'pid': 4242, 'samples': 60, 'cpu_percent': {'avg': ..., 'p95': ..., 'trend_per_min': ...}, ...}
+    """
+
+    def __init__(self,
+                 provider: typing.Optional[SampleProvider] = None,
+                 interval: float = 1.0,
+                 capacity: int = 600,
+                 max_overhead: float = 0.01) -> None:
+        """
+        Args:
+            provider: Where samples come from, psutil by default.
+            interval: Seconds between two samples.
+            capacity: Samples kept per process.
+            max_overhead: The share of one core the sampler may use.
+        """
+        self._provider = provider
+        self.interval = interval
+        self.base_interval = interval
+        self.capacity = capacity
+        self.max_overhead = max_overhead
+        self._lock = threading.Lock()
+        self._series: typing.Dict[int, RingSeries] = {}
+        self._previous_io: typing.Dict[int, typing.Tuple[float, float, float]] = {}
+        self._gone: typing.Set[int] = set()
+        self._overhead = RingSeries(64)  # (tick seconds, tick cpu seconds, 0, 0)
+        self._stopped = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+
+    @property
+    def provider(self) -> SampleProvider:
+        if self._provider is None:
+            self._provider = PsutilSampleProvider()
+        return self._provider
+
+    def watch(self, pid: int) -> None:
+        with self._lock:
+            if pid not in self._series or pid in self._gone:
+                self._series[pid] = RingSeries(self.capacity)
+                self._gone.discard(pid)
+                self._previous_io.pop(pid, None)
+
+    def unwatch(self, pid: int) -> None:
+        with self._lock:
+            self._series.pop(pid, None)
+            self._previous_io.pop(pid, None)
+            self._gone.discard(pid)
+        self.provider.forget(pid)
+
+    def watched(self) -> typing.List[int]:
+        with self._lock:
+            return list(self._series)
+
+    def tick(self, now: typing.Optional[float] = None) -> None:
+        """
+        Take one sample of every watched process that is still running.
+        """
+        started, started_cpu = time.perf_counter(), time.thread_time()
+        now = time.time() if now is None else now
+        with self._lock:
+            pids = [pid for pid in self._series if pid not in self._gone]
+        for pid in pids:
+            try:
+                cpu, rss, read, write = self.provider.sample(pid)
+            except ProcessGone:
+                with self._lock:
+                    self._gone.add(pid)
+                continue
+            with self._lock:
+                series = self._series.get(pid)
+                if series is None:  # unwatched meanwhile
+                    continue
+                previous = self._previous_io.get(pid)
+                self._previous_io[pid] = (now, read, write)
+                if previous is None or now <= previous[0]:
+                    read_rate = write_rate = 0.0
+                else:
+                    elapsed = now - previous[0]
+                    read_rate = max(0.0, read - previous[1]) / elapsed
+                    write_rate = max(0.0, write - previous[2]) / elapsed
+                series.append(now, (cpu, rss, read_rate, write_rate))
+        cost = time.thread_time() - started_cpu
+        with self._lock:
+            self._overhead.append(now, (time.perf_counter() - started, cost, 0, 0))
+        # keep cost / interval under max_overhead, come back to the configured interval when it is cheap again
+        self.interval = max(self.base_interval, cost / self.max_overhead)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.tick()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def stats(self, pid: int, seconds: typing.Optional[float] = None) -> typing.Optional[dict]:
+        """
+        Aggregated stats of a watched process, over the last `seconds` or the whole history.
+        Returns:
+            None if the process is not watched.
+        """
+        with self._lock:
+            series = self._series.get(pid)
+            if series is None:
+                return None
+            times, values = series.ordered()
+            running = pid not in self._gone
+        if seconds is not None and len(times):
+            keep = times >= times[-1] - seconds
+            times, values = times[keep], values[keep]
+        return {"pid": pid, "running": running, "samples": int(len(times)), **summarize(times, values)}
+
+    def overhead(self) -> dict:
+        """
+        The measured cost of the sampler itself.
+        """
+        with self._lock:
+            _, values = self._overhead.ordered()
+        if not len(values):
+            return {"ticks": 0, "tick_ms": None, "cpu_share": 0.0, "interval": self.interval,
+                    "watched": len(self._series)}
+        return {
+            "ticks": int(len(values)),
+            "tick_ms": float(values[:, 0].mean() * 1000),
+            "cpu_share": float(values[:, 1].mean() / self.interval),
+            "interval": self.interval,
+            "watched": len(self._series),
+        }
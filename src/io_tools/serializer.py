@@ -0,0 +1,152 @@
+"""
+    filename: io_tools/serializer.py
+    ~~~~~~~~~~~~~~~~~~~~
+    value serializers for CacheObject storage backends
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import pickle
+import struct
+import typing
+
+Frames = typing.List[typing.Union[bytes, bytearray, memoryview]]
+
+
+class Serializer:
+    """
+    Serializer turns a value into a list of buffers (frames) and back.
+
+    Backends write the frames one after another without joining them,
+    and pass a single buffer (usually a memoryview over their storage) to `loads`.
+
+    Methods:
+        dumps: Serialize a value into frames.
+        loads: Deserialize a value from a buffer.
+    """
+
+    def dumps(self, value) -> Frames:
+        raise NotImplementedError
+
+    def loads(self, buffer) -> typing.Any:
+        raise NotImplementedError
+
+
+class PickleSerializer(Serializer):
+    """
+    PickleSerializer uses pickle protocol 5, large buffers (numpy arrays, bytearray, ...) are kept out-of-band.
+
+    Out-of-band buffers are written raw after the pickle stream, each one aligned to ALIGN bytes.
+    When `loads` is given a memoryview over an mmap (see MmapBackend), numpy arrays are rebuilt
+    directly on top of the mapping without copying, they are read-only in that case.
+
+    Layout:
+        magic (4s), frame count (u32), (offset u64, length u64) per frame, padding,
+        pickle stream, padding, buffer 1, padding, buffer 2, ...
+    """
+    MAGIC = b"OPK5"
+    ALIGN = 64
+    _HEADER = struct.Struct("<4sI")
+    _ENTRY = struct.Struct("<QQ")
+
+    def __init__(self, out_of_band_threshold: int = 1024) -> None:
+        """
+        Args:
+            out_of_band_threshold: Buffers smaller than this are kept inside the pickle stream.
+        """
+        self.out_of_band_threshold = out_of_band_threshold
+
+    @classmethod
+    def _pad(cls, n: int) -> bytes:
+        return b"\x00" * (-n % cls.ALIGN)
+
+    def dumps(self, value) -> Frames:
+        buffers = []
+
+        def buffer_callback(buffer: pickle.PickleBuffer):
+            raw = buffer.raw()
+            if raw.nbytes < self.out_of_band_threshold:
+                return True  # in-band
+            buffers.append(raw)
+            return False
+
+        payload = pickle.dumps(value, protocol=5, buffer_callback=buffer_callback)
+        parts = [payload] + buffers
+        header_size = self._HEADER.size + self._ENTRY.size * len(parts)
+        offset = header_size + len(self._pad(header_size))
+        table = []
+        body = []
+        for part in parts:
+            length = memoryview(part).nbytes
+            table.append(self._ENTRY.pack(offset, length))
+            body.append(part)
+            body.append(self._pad(offset + length))
+            offset += length + len(body[-1])
+        header = self._HEADER.pack(self.MAGIC, len(parts)) + b"".join(table)
+        return [header, self._pad(len(header))] + body
+
+    def loads(self, buffer):
+        view = memoryview(buffer).cast("B")
+        magic, count = self._HEADER.unpack_from(view, 0)
+        if magic != self.MAGIC:
+            raise ValueError("not a pickle frame")
+        parts = []
+        for i in range(count):
+            offset, length = self._ENTRY.unpack_from(view, self._HEADER.size + i * self._ENTRY.size)
+            parts.append(view[offset:offset + length])
+        return pickle.loads(parts[0], buffers=parts[1:])
+
+
+class MsgpackSerializer(Serializer):
+    """
+    MsgpackSerializer uses msgpack, bytes are stored as msgpack bin (never base64),
+    numpy arrays are stored as an extension type holding dtype, shape and the raw data.
+
+    msgpack is an optional dependency, it is imported when the serializer is created.
+    Arrays are copied out of the buffer on load, use PickleSerializer for zero-copy arrays.
+    """
+    NDARRAY_EXT = 1
+
+    def __init__(self) -> None:
+        try:
+            import msgpack
+        except ImportError as e:
+            raise ImportError("MsgpackSerializer requires the msgpack package") from e
+        self._msgpack = msgpack
+
+    def _default(self, obj):
+        np = _numpy()
+        if np is not None and isinstance(obj, np.ndarray):
+            obj = np.ascontiguousarray(obj)
+            header = self._msgpack.packb([obj.dtype.str, list(obj.shape)])
+            return self._msgpack.ExtType(self.NDARRAY_EXT, struct.pack("<I", len(header)) + header + obj.tobytes())
+        if isinstance(obj, (bytearray, memoryview)):
+            return bytes(obj)
+        raise TypeError(f"can't serialize {type(obj)!r}")
+
+    def _ext_hook(self, code, data):
+        if code != self.NDARRAY_EXT:
+            return self._msgpack.ExtType(code, data)
+        np = _numpy()
+        (header_len,) = struct.unpack_from("<I", data, 0)
+        dtype, shape = self._msgpack.unpackb(data[4:4 + header_len])
+        return np.frombuffer(data, dtype=dtype, offset=4 + header_len).reshape(shape)
+
+    def dumps(self, value) -> Frames:
+        return [self._msgpack.packb(value, default=self._default, use_bin_type=True)]
+
+    def loads(self, buffer):
+        return self._msgpack.unpackb(buffer, ext_hook=self._ext_hook, raw=False, strict_map_key=False)
+
+
+def _numpy():
+    """
+    numpy is only needed when arrays are cached, import it on demand.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
@@ -0,0 +1,448 @@
+"""
+    filename: io_tools/shared_cache.py
+    ~~~~~~~~~~~~~~~~~~~~
+    a cache shared by several processes, for multi-worker uvicorn deployments
+
+    One coordinator process owns the keyspace and is the only writer of the local database.
+    Workers keep a local mirror of the keyspace and a connection to the coordinator over a local socket
+    (unix socket, or named pipe on Windows). The coordinator publishes a change sequence number in shared memory,
+    a worker read compares it with the sequence number of its mirror and only talks to the coordinator
+    when something changed, so reads of an unchanged cache never leave the process.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import bisect
+import multiprocessing
+import multiprocessing.connection
+import os
+import secrets
+import signal
+import struct
+import sys
+import threading
+import time
+import typing
+import warnings
+from multiprocessing import shared_memory
+
+from .cache import CacheObject
+
+ENV_ADDRESS = "OAT_SHARED_CACHE"
+ENV_AUTHKEY = "OAT_SHARED_CACHE_KEY"
+_SEQ = struct.Struct("<Q")
+_MISSING = object()
+
+
+class CacheCoordinator:
+    """
+    CacheCoordinator serves one keyspace to many SharedCacheClient over multiprocessing.connection.
+
+    Every write gets a sequence number, the last one is published in shared memory.
+    The recent writes are kept in a bounded change log, so clients catch up with a delta
+    instead of a full copy.
+
+    Requests are tuples (op, *args), supported ops:
+        sync(since): keys changed after `since`, or a full snapshot if the log doesn't reach back that far
+        set(key, value, ttl=None) / set_many(items) / remove(key) / clear()
+        submit(): write the local database now
+
+    Keys set with a ttl are volatile as in CacheObject: never written to the local database.
+    Syncs send their remaining lifetime along, and expired keys are logged as removed when they are purged.
+    """
+
+    def __init__(self, localdb: os.PathLike = None, log_size: int = 10000, submit_interval: float = 1.0) -> None:
+        """
+        Args:
+            localdb: The local database file, written by the coordinator only.
+            log_size: Number of changes kept for delta syncs.
+            submit_interval: Minimum seconds between two writes of the local database.
+        """
+        self._cache = CacheObject(localdb) if localdb is not None else CacheObject()
+        self._localdb = localdb
+        self._lock = threading.Lock()
+        # the keyspace loaded from the local database is change 1, it is never in the log:
+        # a new client (at 0) sees a published sequence it doesn't have, and gets it as a full snapshot
+        self._seq = 1
+        self._log_seqs: typing.List[int] = []
+        self._log_keys: typing.List[str] = []
+        self._log_size = log_size
+        self._deadlines: typing.Dict[str, float] = {}  # volatile keys, by time.monotonic() deadline
+        self._purge_at = 64
+        self._submit_interval = submit_interval
+        self._dirty = threading.Event()
+        self._stopped = threading.Event()
+        self._shm = shared_memory.SharedMemory(create=True, size=_SEQ.size)
+        _SEQ.pack_into(self._shm.buf, 0, self._seq)
+
+    @property
+    def shm_name(self) -> str:
+        return self._shm.name
+
+    def _record(self, keys: typing.Iterable[str]) -> int:
+        """
+        Log changed keys and publish the new sequence number, the caller holds the lock.
+        """
+        for key in keys:
+            self._seq += 1
+            self._log_seqs.append(self._seq)
+            self._log_keys.append(key)
+        if len(self._log_seqs) > self._log_size * 2:
+            del self._log_seqs[:-self._log_size]
+            del self._log_keys[:-self._log_size]
+        _SEQ.pack_into(self._shm.buf, 0, self._seq)
+        self._dirty.set()
+        return self._seq
+
+    def _purge_expired(self) -> None:
+        """
+        Drop the expired volatile keys and log them as removed, so the mirrors drop them too.
+        The caller holds the lock.
+        """
+        now = time.monotonic()
+        expired = [key for key, deadline in self._deadlines.items() if deadline <= now]
+        for key in expired:
+            del self._deadlines[key]
+        if expired:
+            self._record(expired)
+        self._purge_at = max(64, 2 * len(self._deadlines))
+
+    def _sync(self, since: int):
+        """
+        Returns:
+            (seq, full, updated, deleted, ttls): with full=True, `updated` is the whole keyspace.
+            `ttls` holds the remaining seconds of the volatile keys in `updated`.
+        """
+        if since == self._seq:
+            return self._seq, False, {}, [], {}
+        now = time.monotonic()
+        ttls = {}
+        oldest = self._log_seqs[0] if self._log_seqs else self._seq + 1
+        if since == 0 or since + 1 < oldest:
+            updated = self._cache.snapshot()  # without the volatile keys
+            for key, deadline in self._deadlines.items():
+                value = self._cache.get(key, _MISSING)
+                if deadline > now and value is not _MISSING:
+                    updated[key] = value
+                    ttls[key] = deadline - now
+            return self._seq, True, updated, [], ttls
+        start = bisect.bisect_right(self._log_seqs, since)
+        updated, deleted = {}, []
+        for key in set(self._log_keys[start:]):
+            value = self._cache.get(key, _MISSING)
+            if value is _MISSING:
+                deleted.append(key)
+            else:
+                updated[key] = value
+                if key in self._deadlines:
+                    ttls[key] = self._deadlines[key] - now
+        return self._seq, False, updated, deleted, ttls
+
+    def handle(self, request: tuple):
+        op, *args = request
+        with self._lock:
+            if op == "sync":
+                return self._sync(*args)
+            if op == "set":
+                key, value, ttl = args
+                if ttl is None:
+                    self._deadlines.pop(key, None)
+                    self._cache.set_many([(key, value)])
+                else:
+                    self._deadlines[key] = time.monotonic() + ttl
+                    self._cache.set(key, value, ttl=ttl)
+                seq = self._record([key])
+                if len(self._deadlines) > self._purge_at:
+                    self._purge_expired()
+                    seq = self._seq
+                return seq
+            if op == "set_many":
+                items = list(args[0])
+                for key, _ in items:
+                    self._deadlines.pop(key, None)
+                self._cache.set_many(items)
+                return self._record([key for key, _ in items])
+            if op == "remove":
+                key = args[0]
+                self._deadlines.pop(key, None)
+                if key not in self._cache:
+                    return None
+                self._cache.remove(key)
+                return self._record([key])
+            if op == "clear":
+                keys = list(self._cache.snapshot()) + list(self._deadlines)
+                self._deadlines.clear()
+                self._cache.clear()
+                return self._record(keys)
+            if op == "submit":
+                self._submit()
+                return self._seq
+        raise ValueError(f"unknown op {op!r}")
+
+    def _submit(self) -> None:
+        self._dirty.clear()
+        if self._localdb is not None:
+            self._cache.submit()
+
+    def _submitter(self) -> None:
+        while not self._stopped.is_set():
+            self._dirty.wait(self._submit_interval)
+            if self._dirty.is_set():
+                with self._lock:
+                    self._submit()
+                time.sleep(self._submit_interval)
+
+    def _serve_client(self, conn: multiprocessing.connection.Connection) -> None:
+        with conn:
+            while not self._stopped.is_set():
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send((True, self.handle(request)))
+                except Exception as e:
+                    conn.send((False, e))
+
+    def serve_forever(self, listener: multiprocessing.connection.Listener) -> None:
+        threading.Thread(target=self._submitter, daemon=True).start()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    conn = listener.accept()
+                except (OSError, multiprocessing.AuthenticationError):
+                    continue
+                threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._stopped.set()
+        with self._lock:
+            self._submit()
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _coordinator_main(localdb, authkey: bytes, ready: multiprocessing.connection.Connection) -> None:
+    # the launcher stops the daemon with SIGTERM, turn it into SystemExit so the database is written on the way out
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    coordinator = CacheCoordinator(localdb)
+    listener = multiprocessing.connection.Listener(authkey=authkey)
+    ready.send((listener.address, coordinator.shm_name))
+    ready.close()
+    coordinator.serve_forever(listener)
+
+
+def start_coordinator(localdb: os.PathLike = None) -> multiprocessing.Process:
+    """
+    Start the coordinator process and export its address in the environment,
+    processes started afterwards (uvicorn workers) find it with SharedCacheClient.from_env.
+
+    Args:
+        localdb: The local database file.
+    Returns:
+        process: The coordinator process, a daemon that ends with the current process.
+    """
+    authkey = secrets.token_bytes(32)
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_coordinator_main, args=(localdb, authkey, child),
+                                      name="oat-cache-coordinator", daemon=True)
+    process.start()
+    child.close()
+    address, shm_name = parent.recv()
+    parent.close()
+    os.environ[ENV_ADDRESS] = f"{shm_name}|{address}"
+    os.environ[ENV_AUTHKEY] = authkey.hex()
+    return process
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # python < 3.13, keep the resource tracker from unlinking the coordinator's block
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix":
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SharedCacheClient:
+    """
+    SharedCacheClient gives a worker process the CacheObject interface over the coordinator's keyspace.
+
+    Reads are served from the local mirror after one shared-memory sequence check,
+    writes are sent to the coordinator, which orders them, then the mirror catches up.
+    Values have to be picklable. Keys set with a ttl expire in the mirror on their own,
+    without waiting for the coordinator to purge them.
+
+    Example:
+        >>> start_coordinator('cache.json')            # in the launcher process
+        >>> cache = SharedCacheClient.from_env()       # in every worker
+        >>> cache['key'] = 'value'
+        >>> cache['key']
+        'value'
+    """
+
+    def __init__(self, address, shm_name: str, authkey: bytes) -> None:
+        self._conn = multiprocessing.connection.Client(address, authkey=authkey)
+        self._conn_lock = threading.Lock()
+        self._shm = _attach_shared_memory(shm_name)
+        self._mirror: typing.Dict[str, typing.Any] = {}
+        self._expires: typing.Dict[str, float] = {}  # deadlines of the volatile keys of the mirror
+        self._seq = 0
+        self._sync_lock = threading.Lock()
+        self._sync()
+
+    @classmethod
+    def from_env(cls) -> typing.Optional["SharedCacheClient"]:
+        """
+        Connect to the coordinator exported by start_coordinator, None if there is none.
+        """
+        spec = os.environ.get(ENV_ADDRESS)
+        if not spec:
+            return None
+        shm_name, address = spec.split("|", 1)
+        return cls(address, shm_name, bytes.fromhex(os.environ[ENV_AUTHKEY]))
+
+    def _call(self, *request):
+        with self._conn_lock:
+            self._conn.send(request)
+            ok, result = self._conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def _published_seq(self) -> int:
+        return _SEQ.unpack_from(self._shm.buf, 0)[0]
+
+    def _sync(self) -> None:
+        with self._sync_lock:
+            if self._published_seq() == self._seq:
+                return
+            seq, full, updated, deleted, ttls = self._call("sync", self._seq)
+            now = time.monotonic()
+            if full:
+                self._expires = {key: now + ttl for key, ttl in ttls.items()}
+                self._mirror = updated
+            else:
+                # in place, a delta costs the changed keys only. Single lookups stay consistent,
+                # iterations (scan, snapshot) copy the keys or the dict first
+                for key in updated:
+                    if key in ttls:
+                        self._expires[key] = now + ttls[key]
+                    else:
+                        self._expires.pop(key, None)
+                self._mirror.update(updated)
+                for key in deleted:
+                    self._mirror.pop(key, None)
+                    self._expires.pop(key, None)
+            self._seq = seq
+
+    def _fresh(self) -> dict:
+        if self._published_seq() != self._seq:
+            self._sync()
+        return self._mirror
+
+    def _lookup(self, key):
+        """
+        Lookup in the mirror, returns _MISSING for absent or expired keys.
+        """
+        value = self._fresh().get(key, _MISSING)
+        if value is not _MISSING:
+            deadline = self._expires.get(key)
+            if deadline is not None and deadline <= time.monotonic():
+                return _MISSING
+        return value
+
+    def get(self, key, default=_MISSING):
+        value = self._lookup(key)
+        if value is not _MISSING:
+            return value
+        if default is not _MISSING:
+            return default
+        warnings.warn('Key not found.')
+        return None
+
+    def get_many(self, keys: typing.Iterable) -> dict:
+        result = {}
+        for key in keys:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                result[key] = value
+        return result
+
+    def set(self, key, value, ttl: typing.Optional[float] = None):
+        """
+        Set the value of a key.
+        Args:
+            key: The key.
+            value: The value.
+            ttl: Time to live in seconds, see CacheObject.set.
+        """
+        self._call("set", key, value, ttl)
+        self._sync()
+
+    def set_many(self, items):
+        items = list(items.items() if isinstance(items, dict) else items)
+        self._call("set_many", items)
+        self._sync()
+
+    def remove(self, key):
+        if self._call("remove", key) is None:
+            warnings.warn('Key not found.')
+        self._sync()
+
+    def clear(self):
+        self._call("clear")
+        self._sync()
+
+    def scan(self, prefix=None, start=None, end=None, limit=None):
+        mirror = self._fresh()
+        count = 0
+        for key in sorted(mirror):
+            value = mirror.get(key, _MISSING)
+            if value is _MISSING or key in self._expires:  # removed by a sync since, or volatile
+                continue
+            if prefix is not None and not key.startswith(prefix):
+                continue
+            if start is not None and key < start:
+                continue
+            if end is not None and key >= end:
+                break
+            if limit is not None and count >= limit:
+                break
+            count += 1
+            yield key, value
+
+    def snapshot(self) -> dict:
+        """
+        Return a copy of the persistent part of the cache, volatile keys are left out as in CacheObject.
+        """
+        mirror = dict(self._fresh())
+        for key in list(self._expires):
+            mirror.pop(key, None)
+        return mirror
+
+    def submit(self):
+        self._call("submit")
+
+    def close(self):
+        with self._conn_lock:
+            self._conn.close()
+        self._shm.close()
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def __len__(self):
+        return len(self._fresh())
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
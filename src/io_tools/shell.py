@@ -0,0 +1,344 @@
+"""
+    filename: io_tools/shell.py
+    ~~~~~~~~~~~~~~~~~~~~
+    Shell commands run on the event loop, their output streamed as it is written.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import asyncio
+import codecs
+import concurrent.futures
+import locale
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import typing
+
+CHUNK = 64 * 1024
+
+
+class ShellBusy(RuntimeError):
+    """Raised when too many commands are already waiting for a slot."""
+
+
+class ShellRunner:
+    """
+    ShellRunner runs shell commands as asyncio subprocesses, at most `max_concurrent` at a time.
+
+    `stream` yields the output while the command runs, no thread is held and the output is never held
+    in full: the pipes are read in chunks into a small queue, a slow reader makes the command wait
+    on its pipe. A command past its timeout is killed, with its child processes, and so is a command
+    whose stream is closed early, such as when the HTTP client disconnects.
+
+    Event loops without subprocess support, the selector loop uvicorn uses on Windows with reload or workers,
+    get the same streams from a Popen and one reader thread per pipe.
+
+    Example:
+        >>> runner = ShellRunner(max_concurrent=4, timeout=60)
+        >>> async for event in runner.stream("ping -n 3 127.0.0.1"):
+        ...     print(event)
+        {'stream': 'stdout', 'data': 'Pinging 127.0.0.1 ...', 't': 0.01}
+        ...
+        {'stream': 'exit', 'code': 0, 'timed_out': False, 't': 2.03}
+    """
+
+    def __init__(self, max_concurrent: int = 4, timeout: float = 60.0, max_waiting: int = 64) -> None:
+        """
+        Args:
+            max_concurrent: The commands running at the same time, the others wait for a slot.
+            timeout: The default timeout of a command in seconds, its wait for a slot included.
+            max_waiting: The commands allowed to wait for a slot, ShellBusy past it.
+        """
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    def stream(self,
+               cmd: str,
+               timeout: typing.Optional[float] = None,
+               cwd: typing.Optional[str] = None) -> typing.AsyncIterator[dict]:
+        """
+        Run a command and yield its output.
+        Args:
+            cmd: The command line, run by the shell.
+            timeout: Seconds before the command is killed, the runner's timeout by default.
+            cwd: The working directory.
+        Yields:
+            {"stream": "stdout" or "stderr", "data": text, "t": seconds since the start}, as it is written,
+            then {"stream": "exit", "code": return code, "timed_out": bool, "t": seconds}.
+        Raises:
+            ShellBusy: Right away, not from the iterator, so a server answers 503 before it starts a response.
+                Commands admitted at the same time may wait past max_waiting, none of them fails later.
+        """
+        if self.busy:
+            raise ShellBusy(f"{self.waiting} commands are waiting")
+        return self._stream(cmd, timeout, cwd)
+
+    async def _stream(self,
+                      cmd: str,
+                      timeout: typing.Optional[float],
+                      cwd: typing.Optional[str]) -> typing.AsyncIterator[dict]:
+        if self._semaphore is None:  # created on the loop that uses it
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        started = time.monotonic()
+        limit = self.timeout if timeout is None else timeout
+        deadline = None if limit is None else started + limit
+
+        def remaining() -> typing.Optional[float]:
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        if self._semaphore.locked():
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), remaining())
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                yield {"stream": "exit", "code": None, "timed_out": True, "t": time.monotonic() - started}
+                return
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()  # a free slot, taken without yielding to the loop
+        self.running += 1
+        process = None
+        close = None
+        finished = False
+        try:
+            queue: asyncio.Queue = asyncio.Queue(maxsize=16)
+            process, close = await _spawn(cmd, cwd, queue)
+            open_streams, timed_out = 2, False
+            while open_streams:
+                try:
+                    item = await asyncio.wait_for(queue.get(), remaining())
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    _kill(process)
+                    break
+                if item is None:
+                    open_streams -= 1
+                    continue
+                yield {"stream": item[0], "data": item[1], "t": time.monotonic() - started}
+            if not timed_out:
+                # the pipes are closed, the command may still run, such as after `exec >/dev/null`
+                try:
+                    code = await asyncio.wait_for(process.wait(), remaining())
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    _kill(process)
+            if timed_out:
+                code = await process.wait()  # killed, it ends now
+            finished = True
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.completed += 1
+            yield {"stream": "exit", "code": code, "timed_out": timed_out, "t": time.monotonic() - started}
+        finally:
+            try:
+                # closed early (client gone, task cancelled) or failed: don't leave the command running
+                if process is not None and not finished:
+                    self.cancelled += 1
+                    _kill(process)
+                    try:
+                        await asyncio.wait_for(process.wait(), 1.0)  # reaped here, not by a __del__ later
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                if close is not None:
+                    close()
+                self.running -= 1
+                self._semaphore.release()
+
+    async def run(self, cmd: str, timeout: typing.Optional[float] = None, cwd: typing.Optional[str] = None,
+                  max_output: int = 1024 * 1024) -> dict:
+        """
+        Run a command and collect its output, at most `max_output` characters of each stream are kept.
+        Returns:
+            {"code", "timed_out", "stdout", "stderr", "truncated", "t"}
+        """
+        output = {"stdout": [], "stderr": []}
+        sizes = {"stdout": 0, "stderr": 0}
+        truncated = False
+        result = {}
+        async for event in self.stream(cmd, timeout, cwd):
+            stream = event["stream"]
+            if stream == "exit":
+                result = event
+                continue
+            room = max_output - sizes[stream]
+            if len(event["data"]) > room:
+                truncated = True
+            if room > 0:
+                output[stream].append(event["data"][:room])
+                sizes[stream] += min(room, len(event["data"]))
+        return {"code": result.get("code"), "timed_out": result.get("timed_out", False),
+                "stdout": "".join(output["stdout"]), "stderr": "".join(output["stderr"]),
+                "truncated": truncated, "t": result.get("t")}
+
+    @property
+    def busy(self) -> bool:
+        """True when a new command would raise ShellBusy, such as to answer 503 before streaming."""
+        return self._semaphore is not None and self._semaphore.locked() and self.waiting >= self.max_waiting
+
+    def metrics(self) -> dict:
+        return {"running": self.running, "waiting": self.waiting, "max_concurrent": self.max_concurrent,
+                "completed": self.completed, "timeouts": self.timeouts, "cancelled": self.cancelled}
+
+
+async def _spawn(cmd: str, cwd: typing.Optional[str], queue: asyncio.Queue) -> typing.Tuple[typing.Any, typing.Callable[[], None]]:
+    """
+    Start a command whose output chunks go to `queue`, each pipe ends with None.
+    Returns:
+        (process, close): an asyncio Process or a _ThreadedProcess, and the callable that stops the readers
+            and closes the pipes, called once the command is over or killed.
+    """
+    try:
+        process = await asyncio.create_subprocess_shell(
+            cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, cwd=cwd, **_new_process_group())
+    except NotImplementedError:  # the loop can't run subprocesses, such as the selector loop on Windows
+        process = _ThreadedProcess(cmd, cwd, queue, asyncio.get_running_loop())
+        return process, process.close
+    readers = [asyncio.ensure_future(_pump(process.stdout, "stdout", queue)),
+               asyncio.ensure_future(_pump(process.stderr, "stderr", queue))]
+
+    def close() -> None:
+        for reader in readers:
+            reader.cancel()
+        # now, on the loop, rather than in the transport's __del__ when the loop may be closed already
+        process._transport.close()
+
+    return process, close
+
+
+class _ThreadedProcess:
+    """
+    The part of asyncio.subprocess.Process that ShellRunner uses, over a Popen and one reader thread per pipe.
+    The readers put the chunks on the loop's queue and wait while it is full, as _pump does.
+    """
+
+    def __init__(self, cmd: str, cwd: typing.Optional[str], queue: asyncio.Queue,
+                 loop: asyncio.AbstractEventLoop) -> None:
+        self._popen = subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, cwd=cwd, **_new_process_group())
+        self.pid = self._popen.pid
+        self._queue = queue
+        self._loop = loop
+        self._closed = threading.Event()
+        self._exited = loop.create_future()
+        for target, args in ((self._read, (self._popen.stdout, "stdout")),
+                             (self._read, (self._popen.stderr, "stderr")),
+                             (self._wait, ())):
+            threading.Thread(target=target, args=args, name=f"shell-{self.pid}", daemon=True).start()
+
+    @property
+    def returncode(self) -> typing.Optional[int]:
+        return self._popen.poll()
+
+    def kill(self) -> None:
+        self._popen.kill()
+
+    async def wait(self) -> int:
+        # shielded: a timed out wait_for must not cancel the future the waiter thread sets
+        return await asyncio.shield(self._exited)
+
+    def close(self) -> None:
+        self._closed.set()
+
+    def _wait(self) -> None:
+        code = self._popen.wait()
+        try:
+            self._loop.call_soon_threadsafe(lambda: self._exited.done() or self._exited.set_result(code))
+        except RuntimeError:
+            pass  # the loop is closed
+
+    def _read(self, pipe, name: str) -> None:
+        decoder = codecs.getincrementaldecoder(_ENCODING)(errors="replace")
+        with pipe:
+            try:
+                while True:
+                    chunk = pipe.read1(CHUNK)
+                    text = decoder.decode(chunk, final=not chunk)
+                    if text and not self._put((name, text)):
+                        return
+                    if not chunk:
+                        break
+            except (OSError, ValueError):
+                pass  # the pipe broke, the stream is over all the same
+            self._put(None)
+
+    def _put(self, item) -> bool:
+        # False once the stream is closed, nobody reads the queue anymore
+        put = self._queue.put(item)
+        try:
+            future = asyncio.run_coroutine_threadsafe(put, self._loop)
+        except RuntimeError:  # the loop is closed
+            put.close()  # never scheduled, don't warn that it was never awaited
+            return False
+        while not self._closed.is_set():
+            try:
+                future.result(0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                continue
+            except concurrent.futures.CancelledError:
+                return False
+        future.cancel()
+        return False
+
+
+async def _pump(reader: asyncio.StreamReader, name: str, queue: asyncio.Queue) -> None:
+    # chunks rather than lines: a long line without a newline is still streamed, and bounded
+    decoder = codecs.getincrementaldecoder(_ENCODING)(errors="replace")
+    try:
+        while True:
+            chunk = await reader.read(CHUNK)
+            text = decoder.decode(chunk, final=not chunk)
+            if text:
+                await queue.put((name, text))
+            if not chunk:
+                break
+    except (ConnectionError, OSError):
+        pass  # the pipe broke, the stream is over all the same
+    await queue.put(None)
+
+
+def _new_process_group() -> dict:
+    # the shell starts the command as its child, killing the shell alone would leave the command running
+    if sys.platform == "win32":
+        return {"creationflags": 0x00000200}  # CREATE_NEW_PROCESS_GROUP
+    return {"start_new_session": True}
+
+
+def _kill(process) -> None:
+    if process.returncode is not None:
+        return
+    try:
+        if sys.platform == "win32":
+            # taskkill /T takes the whole tree, TerminateProcess would only stop cmd.exe. Not waited for
+            subprocess.Popen(["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+
+
+# what subprocess.run(text=True) decodes with, the console code page on Windows
+_ENCODING = locale.getpreferredencoding(False)
@@ -12,7 +12,11 @@ import dataclasses
 import typing
 import psutil
 import ctypes
-import pywinauto
+from utils.lazy import lazy_import
+from .memoize import cached
+from .processes import AppHandleCache, ProcessIndex, ProcessSnapshot, ProcessWatcher, WindowProvider
+
+pywinauto = lazy_import("pywinauto")  # only needed to connect to and start applications
 
 @dataclasses.dataclass
 class WindowsProcess:
@@ -24,7 +28,31 @@ class WindowsProcess:
     executable: str  # Executable Path
 
 
+class Win32WindowProvider(WindowProvider):
+    """Win32WindowProvider enumerates the visible top-level windows with EnumWindows."""
+
+    def windows(self) -> typing.Dict[int, typing.List[int]]:
+        user32 = ctypes.windll.user32
+        found: typing.Dict[int, typing.List[int]] = {}
+        pid = ctypes.c_ulong()
+
+        @ctypes.WINFUNCTYPE(ctypes.c_bool, ctypes.c_void_p, ctypes.c_void_p)
+        def on_window(hwnd, _):
+            if hwnd and user32.IsWindowVisible(hwnd):
+                user32.GetWindowThreadProcessId(hwnd, ctypes.byref(pid))
+                found.setdefault(pid.value, []).append(hwnd)
+            return True
+
+        user32.EnumWindows(on_window, 0)
+        return found
+
+
 class WindowsProcessOperate:
+    snapshot = ProcessSnapshot()  # shared by every call, refreshed incrementally
+    index = ProcessIndex(snapshot, Win32WindowProvider())
+    watcher = ProcessWatcher(index, interval=2.0)  # started by the first lookup
+    apps = AppHandleCache(snapshot, lambda pid: pywinauto.Application().connect(process=pid))
+    watcher.add_listener(apps.prune)
 
     @classmethod
     def _is_system_process(cls, process: WindowsProcess) -> bool:
@@ -47,21 +75,18 @@ class WindowsProcessOperate:
         return ctypes.windll.shell32.IsUserAnAdmin() != 0
 
     @classmethod
-    def get_all_processes(cls) -> typing.List[WindowsProcess]:
+    @cached(ttl=1.0)
+    def get_all_processes(cls) -> typing.Tuple[WindowsProcess, ...]:
         """
         Get all system processes.
         Returns:
-            typing.List[WindowsProcess]: A list of WindowsProcess objects.
+            typing.Tuple[WindowsProcess, ...]: WindowsProcess objects, a tuple since the cached result is shared.
         """
-        pids = psutil.pids()
-        process_list = []
-        for pid in pids:
-            if pid == 0:  # System Idle Process
-                continue
-            process = psutil.Process(pid)
-            process_list.append(
-                WindowsProcess(process.name(), process.children(), process.pid, process.status(), process.exe()))
-        return process_list
+        cls.snapshot.refresh()
+        snapshot = cls.snapshot
+        return tuple(WindowsProcess(process.name, bool(snapshot.children.get(process.pid)), process.pid,
+                                    process.status, process.exe)
+                     for process in snapshot if process.pid != 0)  # 0 is the System Idle Process
 
     @classmethod
     def kill_process_by_pid(cls, pid: int) -> None:
@@ -88,13 +113,28 @@ class WindowsProcessOperate:
     def load_process_to_front(cls,program_name: str) -> None:
         """
         load a background program to front.
+
+        The process and its windows come from the index, the application handle from the handle cache,
+        so a known window is focused without enumerating processes or connecting again.
         """
-        for process in cls.get_all_processes():
-            if process.process_name==program_name:
-                app = pywinauto.Application().connect(process=process.pid)
-                app.window().set_focus()
+        cls.watcher.start()
+        windows = cls.index.windows_of_name(program_name)
+        if not any(windows.values()):
+            cls.index.refresh()  # started since the last tick of the watcher
+            windows = cls.index.windows_of_name(program_name)
+        error = None
+        for pid, handles in windows.items():
+            try:
+                app = cls.apps.get(pid)
+                window = app.window(handle=handles[0]) if handles else app.window()
+                window.set_focus()
                 return
-            
+            except Exception as e:  # exited since the last refresh, or the handle went stale
+                cls.apps.invalidate(pid)
+                error = e
+        if error is not None:
+            raise error
+
     @classmethod
     def load_process_from_executable(cls,executable_path: str) -> None:
         """
@@ -0,0 +1,416 @@
+"""
+    filename: mihoyo/scheduler.py
+    ~~~~~~~~~~~~~~~~~~~~
+    one loop for every automation workflow: one capture per tick, cheap checks first, one input at a time
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import threading
+import time
+import typing
+
+from image_tools.autoclick import Grabbed, percentile
+from utils.lazy import lazy_import, lazy_property
+
+match = lazy_import("image_tools.match")  # cv2 and numpy, only for template checks
+probe = lazy_import("image_tools.probe")  # numpy, only for probe checks
+
+
+class Frame:
+    """
+    The capture of one tick, shared by every task. Derived images are computed once, when a check first needs them.
+    """
+
+    def __init__(self, image, offset: typing.Tuple[int, int], captured_at: float) -> None:
+        self.image = image  # BGRA as grabbed from mss, or BGR
+        self.offset = offset  # (left, top) of the image on the desktop
+        self.captured_at = captured_at
+        self._probed: typing.Dict[int, typing.Dict[str, bool]] = {}
+
+    @lazy_property
+    def array(self):
+        """The image as a (height, width, channels) ndarray, a mss ScreenShot is viewed without a copy."""
+        return probe.as_bgra(self.image)
+
+    @lazy_property
+    def gray(self):
+        return match.CV._as_image(self.array, match.cv2.IMREAD_GRAYSCALE)
+
+    def probe(self, book) -> typing.Dict[str, bool]:
+        """
+        Every probe set of a ProbeBook evaluated on this frame, in one gather the first time it is asked for.
+        """
+        probed = self._probed.get(id(book))
+        if probed is None:
+            probed = self._probed[id(book)] = book.evaluate(self.image)
+        return probed
+
+    def to_desktop(self, x: int, y: int) -> typing.Tuple[int, int]:
+        return int(x + self.offset[0]), int(y + self.offset[1])
+
+
+class Check:
+    """
+    Check is a named test of a frame. A truthy result is a hit, and is passed to the action.
+
+    The scheduler measures its cost and counts its hits, and evaluates the checks of a state in the order of
+    expected cost per hit, cost / p(hit): a cheap check that often decides goes first, an expensive one
+    that rarely hits goes last. A check used by several tasks is evaluated once per frame.
+    """
+
+    def __init__(self, name: str, func: typing.Callable[[Frame], typing.Any], cost_ms: float = 1.0) -> None:
+        """
+        Args:
+            name: Shown in the stats.
+            func: Called with the Frame, returns a falsy value or the hit, such as the center of a match.
+            cost_ms: The first cost estimate, measurements replace it.
+        """
+        self.name = name
+        self.func = func
+        self.cost = cost_ms / 1000
+        self.evaluations = 0
+        self.hits = 0
+
+    @property
+    def p_hit(self) -> float:
+        # Laplace smoothing, a check that never ran yet counts as a 50% chance
+        return (self.hits + 1) / (self.evaluations + 2)
+
+    @property
+    def priority(self) -> float:
+        return self.cost / self.p_hit
+
+    def evaluate(self, frame: Frame):
+        started = time.perf_counter()
+        result = self.func(frame)
+        elapsed = time.perf_counter() - started
+        self.cost = 0.8 * self.cost + 0.2 * elapsed
+        self.evaluations += 1
+        if result:
+            self.hits += 1
+        return result
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "cost_ms": self.cost * 1000, "p_hit": self.p_hit,
+                "evaluations": self.evaluations, "hits": self.hits}
+
+
+def template_check(name: str, template, threshold: float = 0.9,
+                   roi: typing.Optional[typing.Sequence[int]] = None) -> Check:
+    """
+    Hit when the template is in the frame (inside `roi`), the result is the desktop position of its center.
+    """
+    def check(frame: Frame):
+        found = match.CV.match_template(frame.gray, template, threshold, roi)
+        return frame.to_desktop(*found["matches"][0]["center"]) if found["found"] else None
+
+    return Check(name, check, cost_ms=10.0)
+
+
+def pixel_check(name: str, x: int, y: int, color: typing.Sequence[int], tolerance: int = 8) -> Check:
+    """
+    Hit when the pixel at (x, y) of the frame is within `tolerance` of the BGR `color` on every channel,
+    the result is the desktop position of the pixel.
+    """
+    def check(frame: Frame):
+        pixel = frame.array[y, x]
+        if all(abs(int(pixel[n]) - int(color[n])) <= tolerance for n in range(3)):
+            return frame.to_desktop(x, y)
+        return None
+
+    return Check(name, check, cost_ms=0.01)
+
+
+def probe_check(name: str, book) -> Check:
+    """
+    Hit when the probe set `name` of a ProbeBook matches. The sets of one book share one gather per frame,
+    register the sets of every workflow in the same book, such as Scheduler.probes.
+    """
+    return Check(name, lambda frame: frame.probe(book)[name], cost_ms=0.02)
+
+
+def gated(gate: Check, check: Check) -> Check:
+    """
+    Run `check` only on frames where `gate` hits, such as a template match behind the probe of the screen
+    that shows the template. The result is the one of `check`.
+    """
+    def run(frame: Frame):
+        return check.evaluate(frame) if gate.evaluate(frame) else None
+
+    return Check(f"{check.name} if {gate.name}", run, cost_ms=gate.cost * 1000)
+
+
+# called with (input arbiter, hit result), does the clicks and key presses of a transition
+Action = typing.Callable[["InputArbiter", typing.Any], typing.Any]
+
+
+class Transition(typing.NamedTuple):
+    check: Check
+    action: typing.Optional[Action]
+    target: typing.Optional[str]  # the next state, None to stay
+
+
+class Workflow:
+    """
+    Workflow is a state machine: in each state, the first check that hits runs its action and moves to its target.
+    A state without transitions is final.
+
+    Example:
+        >>> flow = Workflow("daily", initial="lobby")
+        >>> flow.on("lobby", pixel_check("mail badge", 1780, 42, (36, 28, 230)), click_hit, "mail")
+        >>> flow.on("mail", template_check("claim", "claim.png"), click_hit, "done")
+        >>> scheduler.register(flow)
+    """
+
+    def __init__(self, name: str, initial: str, cooldown_ms: float = 300.0) -> None:
+        """
+        Args:
+            name: The task name, unique in a scheduler.
+            initial: The first state.
+            cooldown_ms: Frames captured within this time after an action are not checked, the UI needs time
+                to react, a check on a stale frame would repeat the action.
+        """
+        self.name = name
+        self.initial = initial
+        self.cooldown = cooldown_ms / 1000
+        self.states: typing.Dict[str, typing.List[Transition]] = {initial: []}
+
+    def on(self, state: str, check: Check, action: typing.Optional[Action] = None,
+           goto: typing.Optional[str] = None) -> "Workflow":
+        self.states.setdefault(state, []).append(Transition(check, action, goto))
+        if goto is not None:
+            self.states.setdefault(goto, [])
+        return self
+
+
+def click_hit(arbiter: "InputArbiter", hit) -> None:
+    """An action: click the desktop position a check returned."""
+    arbiter.mouse_click(*hit)
+
+
+class InputArbiter:
+    """
+    InputArbiter serializes the use of the input devices: every call to the device goes through one lock,
+    so two workflows, or a workflow and an API request, never interleave their clicks and key presses.
+
+    `hold` keeps the devices for a sequence of calls, such as a drag or a key combination typed by hand.
+    """
+
+    def __init__(self, device) -> None:
+        """
+        Args:
+            device: What does the input, such as DeviceOperate or a DeviceClient.
+        """
+        self._device = device
+        self._lock = threading.RLock()
+        self.waited = 0.0
+        self.calls = 0
+
+    def hold(self, timeout: float = -1) -> "_Held":
+        return _Held(self, timeout)
+
+    def __getattr__(self, name: str):
+        method = getattr(self._device, name)
+
+        def call(*args, **kwargs):
+            with self.hold():
+                self.calls += 1
+                return method(*args, **kwargs)
+
+        return call
+
+
+class _Held:
+    def __init__(self, arbiter: InputArbiter, timeout: float) -> None:
+        self._arbiter = arbiter
+        self._timeout = timeout
+
+    def __enter__(self) -> InputArbiter:
+        started = time.perf_counter()
+        if not self._arbiter._lock.acquire(timeout=self._timeout):
+            raise TimeoutError("the input devices are busy")
+        self._arbiter.waited += time.perf_counter() - started
+        return self._arbiter
+
+    def __exit__(self, *exc) -> None:
+        self._arbiter._lock.release()
+
+
+class Task:
+    """The running state of a registered workflow, and its stats."""
+
+    def __init__(self, workflow: Workflow) -> None:
+        self.workflow = workflow
+        self.state = workflow.initial
+        self.status = "running"  # running, done, failed
+        self.error: typing.Optional[str] = None
+        self.ignore_before = 0.0
+        self.cpu = 0.0
+        self.ticks = 0
+        self.transitions = 0
+        self.reactions: typing.List[float] = []  # capture to end of action, seconds
+
+    def to_dict(self) -> dict:
+        p50, p99 = percentile(self.reactions, 50), percentile(self.reactions, 99)
+        return {
+            "name": self.workflow.name,
+            "state": self.state,
+            "status": self.status,
+            "error": self.error,
+            "ticks": self.ticks,
+            "transitions": self.transitions,
+            "cpu_ms": self.cpu * 1000,
+            "reaction_ms": {"count": len(self.reactions),
+                            "p50": None if p50 is None else p50 * 1000,
+                            "p99": None if p99 is None else p99 * 1000},
+        }
+
+
+class Scheduler:
+    """
+    Scheduler runs every registered workflow from one loop.
+
+    Each tick grabs one frame for all tasks, runs the checks of each task's current state cheapest expected
+    cost per hit first, stops at the first hit, and runs its action through the InputArbiter. The result of
+    a check is shared by every task that uses it on the same frame. No task is active, no capture.
+
+    CPU time is the thread time spent in a task's checks and actions, a shared check counts for the task
+    that evaluated it first. Reaction latency is from the capture of the frame to the end of the action.
+
+    Example:
+        >>> scheduler = Scheduler(grab, InputArbiter(DeviceOperate), interval=0.1)
+        >>> scheduler.register(flow)
+        >>> scheduler.start()
+        >>> scheduler.stats()["tasks"]
+    """
+
+    def __init__(self, grab: typing.Callable[[], Grabbed], arbiter: InputArbiter, interval: float = 0.1,
+                 keep_reactions: int = 1000) -> None:
+        """
+        Args:
+            grab: Returns the newest frame as (image, (left, top), captured_at), see image_tools.autoclick.
+            arbiter: The input devices.
+            interval: The seconds between two ticks, a tick that takes longer is followed right away by the next.
+            keep_reactions: The reaction latencies kept per task for the percentiles.
+        """
+        self._grab = grab
+        self.arbiter = arbiter
+        self.interval = interval
+        self.keep_reactions = keep_reactions
+        self._tasks: typing.Dict[str, Task] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+        self.ticks = 0
+        self.captures = 0
+        self.capture_time = 0.0
+
+    @lazy_property
+    def probes(self):
+        """The ProbeBook of every workflow of this scheduler, all their probe sets in one gather per frame."""
+        return probe.ProbeBook()
+
+    def register(self, workflow: Workflow) -> Task:
+        with self._lock:
+            if workflow.name in self._tasks and self._tasks[workflow.name].status == "running":
+                raise ValueError(f"workflow {workflow.name!r} is already running")
+            task = self._tasks[workflow.name] = Task(workflow)
+            return task
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            self._tasks.pop(name, None)
+
+    def tick(self) -> int:
+        """
+        Run one tick.
+        Returns:
+            The number of transitions taken.
+        """
+        with self._lock:
+            tasks = [task for task in self._tasks.values() if task.status == "running"]
+        self.ticks += 1
+        if not tasks:
+            return 0
+        started = time.perf_counter()
+        image, offset, captured_at = self._grab()
+        self.capture_time += time.perf_counter() - started
+        self.captures += 1
+        frame = Frame(image, offset, captured_at)
+        results: typing.Dict[int, typing.Any] = {}  # id(check) -> result on this frame
+        taken = 0
+        for task in tasks:
+            if captured_at < task.ignore_before:
+                continue
+            cpu_started = time.thread_time()
+            try:
+                taken += self._step(task, frame, results)
+            except Exception as e:
+                task.status, task.error = "failed", f"{type(e).__name__}: {e}"
+            finally:
+                task.cpu += time.thread_time() - cpu_started
+                task.ticks += 1
+        return taken
+
+    def _step(self, task: Task, frame: Frame, results: typing.Dict[int, typing.Any]) -> int:
+        transitions = task.workflow.states.get(task.state, [])
+        if not transitions:
+            task.status = "done"
+            return 0
+        for transition in sorted(transitions, key=lambda t: t.check.priority):
+            check = transition.check
+            if id(check) in results:
+                hit = results[id(check)]
+            else:
+                hit = results[id(check)] = check.evaluate(frame)
+            if not hit:
+                continue
+            if transition.action is not None:
+                transition.action(self.arbiter, hit)
+                task.ignore_before = time.monotonic() + task.workflow.cooldown
+            task.reactions.append(time.monotonic() - frame.captured_at)
+            del task.reactions[:-self.keep_reactions]
+            task.transitions += 1
+            if transition.target is not None:
+                task.state = transition.target
+                if not task.workflow.states.get(task.state):
+                    task.status = "done"
+            return 1
+        return 0
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            self.tick()
+            self._stopped.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 1.0) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            tasks = list(self._tasks.values())
+        checks = {}
+        for task in tasks:
+            for transitions in task.workflow.states.values():
+                for transition in transitions:
+                    checks[id(transition.check)] = transition.check
+        return {
+            "ticks": self.ticks,
+            "captures": self.captures,
+            "capture_ms": self.capture_time / self.captures * 1000 if self.captures else None,
+            "input_calls": self.arbiter.calls,
+            "input_wait_ms": self.arbiter.waited * 1000,
+            "tasks": [task.to_dict() for task in tasks],
+            "checks": sorted((check.to_dict() for check in checks.values()), key=lambda c: c["name"]),
+        }
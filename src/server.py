@@ -1,12 +1,31 @@
 import uvicorn
 from asgi.asgi_app import asgi_application
+from asgi.asgi_config import config as asgi_config
 from app_setting import config
+from io_tools import device_daemon, shared_cache
 
 
 def run_server():
     """
     run the asgi application, you can run this function in a new thread
     """
+    if config.ASGI_APP_WORKERS > 1:
+        # every worker is a process with its own memory, they share one cache through the coordinator,
+        # and one screen grabber and input hooks through the device daemon
+        coordinator = shared_cache.start_coordinator(asgi_config.CACHE_DB_PATH)
+        daemon = device_daemon.start_daemon()
+        try:
+            uvicorn.run(
+                "asgi.asgi_app:asgi_application",
+                host=config.ASGI_APP_HOST,
+                port=config.ASGI_APP_PORT,
+                workers=config.ASGI_APP_WORKERS,
+            )
+        finally:
+            for process in (daemon, coordinator):
+                process.terminate()
+                process.join()
+        return
     uvicorn.run(
         asgi_application,
         host=config.ASGI_APP_HOST,
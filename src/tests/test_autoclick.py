@@ -0,0 +1,58 @@
+import itertools
+import threading
+import time
+import unittest
+from image_tools.autoclick import Autoclicker, percentile
+
+
+class TestAutoclicker(unittest.TestCase):
+    def setUp(self):
+        self.frame_ids = itertools.count()
+        self.clicks = []
+
+    def grab(self):
+        time.sleep(0.005)
+        return next(self.frame_ids), (100, 200), time.monotonic()
+
+    def test_click_when_found(self):
+        # the target shows up from the 5th frame on
+        def locate(frame_id, scale, threshold):
+            return ((10, 20), 0.95) if frame_id >= 5 else (None, 0.2)
+
+        clicker = Autoclicker(self.grab, lambda x, y: self.clicks.append((x, y)), locate, max_clicks=2,
+                              cooldown_ms=0)
+        report = clicker.run(timeout=2)
+        self.assertEqual(self.clicks, [(110, 220), (110, 220)])
+        self.assertEqual(report["latency_ms"]["count"], 2)
+        self.assertGreater(report["latency_ms"]["p99"], 0)
+
+    def test_slow_match_goes_coarse(self):
+        scales = []
+
+        def locate(frame_id, scale, threshold):
+            scales.append(scale)
+            time.sleep(0.02 * scale)
+            return None, 0.0
+
+        clicker = Autoclicker(self.grab, self.clicks.append, locate, budget_ms=10)
+        report = clicker.run(timeout=0.5)
+        self.assertEqual(scales[0], 1.0)
+        self.assertLess(report["scale"], 1.0)
+        self.assertEqual(self.clicks, [])
+
+    def test_stop_and_errors(self):
+        stop = threading.Event()
+        threading.Timer(0.05, stop.set).start()
+        report = Autoclicker(self.grab, self.clicks.append, lambda *_: (None, 0.0)).run(should_stop=stop.is_set)
+        self.assertGreater(report["frames"], 0)
+
+        def broken():
+            raise OSError("no screen")
+
+        with self.assertRaises(OSError):
+            Autoclicker(broken, self.clicks.append, lambda *_: (None, 0.0)).run(timeout=1)
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertAlmostEqual(percentile(list(range(101)), 99), 99)
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import time
+import unittest
+from utils.background import TempArtifactStore
+
+
+class TestTempArtifactStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, store, keep=False, size=10):
+        path = store.allocate(".bin", keep=keep)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        store.commit(path)
+        return path
+
+    def test_release_deletes(self):
+        store = TempArtifactStore(self.tmpdir.name)
+        path = self.write(store)
+        self.assertTrue(os.path.exists(path))
+        store.release(path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(store.metrics()["files"], 0)
+
+    def test_pinned_files_survive_limits(self):
+        store = TempArtifactStore(self.tmpdir.name, max_files=2)
+        pinned = [self.write(store) for _ in range(5)]
+        self.assertTrue(all(os.path.exists(path) for path in pinned))
+        kept = [self.write(store, keep=True) for _ in range(3)]
+        for path in kept:
+            store.release(path)
+        self.assertFalse(os.path.exists(kept[0]))  # oldest unpinned file evicted
+        self.assertTrue(os.path.exists(kept[2]))
+        self.assertEqual(store.metrics()["deleted_evicted"], 1)
+
+    def test_byte_limit_and_age(self):
+        store = TempArtifactStore(self.tmpdir.name, max_bytes=25, max_age=0.05)
+        paths = [self.write(store, keep=True) for _ in range(3)]
+        for path in paths:
+            store.release(path)
+        self.assertEqual(store.metrics()["bytes"], 20)
+        time.sleep(0.06)
+        self.assertEqual(store.metrics()["files"], 0)
+        store.close()
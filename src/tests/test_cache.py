@@ -1,8 +1,179 @@
+import json
+import os
+import pickle
+import tempfile
 import unittest
+import threading
+import warnings
+from unittest import mock
 from io_tools.cache import CacheObject
+from io_tools.cache_backend import SQLiteBackend, MmapBackend
+from io_tools.serializer import PickleSerializer
 
 class TestCache(unittest.TestCase):
     def test_cache(self):
         cache = CacheObject('cache.json')
         cache['key1'] = 'value1'
-        self.assertEqual(cache['key1'], 'value1')
\ No newline at end of file
+        self.assertEqual(cache['key1'], 'value1')
+
+    def test_concurrent_write(self):
+        cache = CacheObject()
+        THREADS = 8
+        KEYS = 500
+
+        def writer(n):
+            for i in range(KEYS):
+                cache.set(f"t{n}-{i}", i)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            threads = [threading.Thread(target=writer, args=(n,)) for n in range(THREADS)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        snapshot = cache.snapshot()
+        for n in range(THREADS):
+            self.assertEqual(snapshot[f"t{n}-{KEYS - 1}"], KEYS - 1)
+        cache.submit()
+
+    def test_concurrent_submit_writes_latest(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "db.json")
+            cache = object.__new__(CacheObject)  # an instance of its own, the singleton is left alone
+            cache.__init__(path)
+            cache["k"] = "old"
+            taken, release = threading.Event(), threading.Event()
+            snapshot = cache.snapshot
+
+            def slow_snapshot():
+                data = snapshot()
+                if not taken.is_set():  # the first submit stalls after its snapshot
+                    taken.set()
+                    release.wait(2)
+                return data
+
+            with mock.patch.object(cache, "snapshot", slow_snapshot):
+                first = threading.Thread(target=cache.submit)
+                first.start()
+                taken.wait(2)
+                cache["k"] = "new"
+                second = threading.Thread(target=cache.submit)
+                second.start()
+                second.join(0.1)
+                release.set()
+                first.join()
+                second.join()
+            with open(path) as f:
+                self.assertEqual(json.load(f)["k"], "new")
+
+
+class TestCacheBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check_backend(self, backend):
+        backend.set_many([("user:1", b"a"), ("user:2", b"b"), ("video:1", b"c")])
+        backend.set("user:1", b"aa")
+        self.assertEqual(bytes(backend.get("user:1")), b"aa")
+        self.assertIsNone(backend.get("missing"))
+        self.assertEqual([k for k, _ in backend.scan(prefix="user:")], ["user:1", "user:2"])
+        self.assertEqual([k for k, _ in backend.scan(start="user:2", end="video:2")], ["user:2", "video:1"])
+        self.assertEqual(set(backend.get_many(["user:2", "video:1", "missing"])), {"user:2", "video:1"})
+        self.assertTrue(backend.delete("user:2"))
+        self.assertFalse(backend.contains("user:2"))
+        self.assertEqual(backend.count(), 2)
+        backend.flush()
+        backend.close()
+
+    def test_sqlite_backend(self):
+        path = os.path.join(self.tmpdir.name, "cache.db")
+        self.check_backend(SQLiteBackend(path))
+        reopened = SQLiteBackend(path)
+        self.assertEqual(bytes(reopened.get("user:1")), b"aa")
+        reopened.close()
+
+    def test_mmap_backend(self):
+        path = os.path.join(self.tmpdir.name, "cache.kv")
+        self.check_backend(MmapBackend(path))
+        reopened = MmapBackend(path)
+        self.assertEqual(bytes(reopened.get("user:1")), b"aa")
+        self.assertFalse(reopened.contains("user:2"))
+        reopened.compact()
+        self.assertEqual(bytes(reopened.get("video:1")), b"c")
+        reopened.clear()
+        self.assertEqual(reopened.count(), 0)
+        reopened.close()
+
+    def test_mmap_compact_while_reading(self):
+        backend = MmapBackend(os.path.join(self.tmpdir.name, "cache.kv"), compact_ratio=0.1)
+        backend.set_many([(f"k{i}", f"v{i}".encode() * 8) for i in range(50)])
+        errors = []
+        done = threading.Event()
+
+        def reader():
+            while not done.is_set():
+                for i in range(50):
+                    value = backend.get(f"k{i}")
+                    if value is None or bytes(value) != f"v{i}".encode() * 8:
+                        errors.append((i, value and bytes(value)))
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        try:
+            for _ in range(30):
+                backend.set_many([(f"k{i}", f"v{i}".encode() * 8) for i in range(50)])
+                backend.flush()  # more than 10% dead records: compacts
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(backend.count(), 50)
+        backend.close()
+
+    def test_cache_with_backend(self):
+        path = os.path.join(self.tmpdir.name, "cache.kv")
+        cache = CacheObject(backend=MmapBackend(path), hot_size=16)
+        try:
+            for i in range(100):
+                cache[f"k{i:03}"] = {"value": i}
+            self.assertEqual(cache["k000"], {"value": 0})
+            self.assertIsInstance(cache._stripes[cache._stripe_index("k000")]["k000"], dict)
+            self.assertEqual(len(cache), 100)
+            self.assertEqual([k for k, _ in cache.scan(prefix="k09")], [f"k09{i}" for i in range(10)])
+            self.assertEqual(cache.get_many(["k001", "k099"]), {"k001": {"value": 1}, "k099": {"value": 99}})
+        finally:
+            cache._backend.close()
+            CacheObject("cache.json")
+
+
+class TestSerializer(unittest.TestCase):
+    def test_pickle_out_of_band(self):
+        serializer = PickleSerializer(out_of_band_threshold=16)
+        large = bytearray(b"y" * 4096)
+        frames = serializer.dumps({"small": b"x", "large": pickle.PickleBuffer(large)})
+        self.assertTrue(any(isinstance(frame, memoryview) and frame.nbytes == 4096 for frame in frames))
+        value = serializer.loads(b"".join(frames))
+        self.assertEqual(value["small"], b"x")
+        self.assertEqual(bytes(value["large"]), bytes(large))
+
+    def test_numpy_zero_copy(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backend = MmapBackend(os.path.join(tmpdir, "frames.kv"))
+            serializer = PickleSerializer()
+            frame = np.arange(1080 * 1920 * 3, dtype=np.uint8).reshape(1080, 1920, 3)
+            backend.set("frame", serializer.dumps(frame))
+            loaded = serializer.loads(backend.get("frame"))
+            np.testing.assert_array_equal(loaded, frame)
+            self.assertFalse(loaded.flags.owndata)
+            self.assertFalse(loaded.flags.writeable)  # a read-only view of the mapping
+            self.assertEqual(loaded.ctypes.data % PickleSerializer.ALIGN, 0)
+            del loaded
+            backend.close()
@@ -0,0 +1,68 @@
+import threading
+import time
+import unittest
+from io_tools.capture import CaptureService, CaptureOverloaded
+
+
+class FakeScreen:
+    def __init__(self, number):
+        self.capture_screen_number = number
+
+
+class TestCaptureService(unittest.TestCase):
+    def setUp(self):
+        self.grabs = 0
+
+    def grab(self):
+        self.grabs += 1
+        time.sleep(0.05)
+        return [FakeScreen(0), FakeScreen(1)]
+
+    def test_coalesce(self):
+        service = CaptureService(self.grab, max_queue=16, freshness=1.0)
+        futures = [service.capture() for _ in range(10)]
+        frames = {future.result().frame_id for future in futures}
+        self.assertEqual(frames, {1})
+        self.assertEqual(self.grabs, 1)
+        # fresh enough, served without a grab
+        self.assertEqual(service.capture().result().frame_id, 1)
+        # a caller that wants a newer frame triggers a new grab
+        self.assertEqual(service.capture(max_age=0).result().frame_id, 2)
+        service.shutdown()
+
+    def test_listeners(self):
+        service = CaptureService(self.grab, freshness=1.0)
+        seen = []
+        service.add_listener(lambda frame: seen.append(frame.frame_id))
+        service.add_listener(lambda frame: 1 / 0)  # a failing listener doesn't fail the capture
+        service.capture().result()
+        service.capture().result()  # fresh, no new frame
+        self.assertEqual(seen, [1])
+        self.assertEqual(service.metrics()["listener_errors"], 1)
+        service.shutdown()
+
+    def test_shed(self):
+        service = CaptureService(self.grab, max_queue=2, freshness=0)
+        service.capture()
+        service.capture()
+        with self.assertRaises(CaptureOverloaded):
+            service.capture()
+        self.assertEqual(service.metrics()["shed"], 1)
+        service.shutdown()
+
+    def test_shared_encode(self):
+        service = CaptureService(self.grab)
+        frame = service.capture().result()
+        encodes = []
+        lock = threading.Lock()
+
+        def encoder(info):
+            with lock:
+                encodes.append(info.capture_screen_number)
+            return f"screen-{info.capture_screen_number}"
+
+        results = [service.encode(frame, 1, encoder).result() for _ in range(5)]
+        self.assertEqual(results, ["screen-1"] * 5)
+        self.assertEqual(encodes, [1])
+        self.assertIsNone(service.encode(frame, 7, encoder).result())
+        service.shutdown()
@@ -0,0 +1,131 @@
+import threading
+import time
+import unittest
+from io_tools import device_daemon
+from io_tools.device_daemon import DeviceClient, FrameOverwritten, FrameRing
+
+
+class FakePicture:
+    def __init__(self, width, height, value):
+        self.width, self.height = width, height
+        self.raw = bytearray([value]) * (width * height * 4)
+
+
+class FakeScreen:
+    def __init__(self, number, width, height, value):
+        self.capture_picture = FakePicture(width, height, value)
+        self.capture_screen_number = number
+        self.screen_left, self.screen_top = number * 10, 0
+
+
+class FakeDevice:
+    def __init__(self):
+        self.grabs = 0
+        self.clicks = []
+
+    def get_all_screen_info(self):
+        self.grabs += 1
+        time.sleep(0.02)
+        return [FakeScreen(0, 8, 4, self.grabs), FakeScreen(1, 4, 4, self.grabs)]
+
+    def mouse_click(self, x, y, button="left"):
+        self.clicks.append((x, y, button))
+
+    def get_mouse_position(self):
+        return self.clicks[-1][:2] if self.clicks else (0, 0)
+
+
+class FakeListener:
+    def get_recent_mouse_events(self):
+        return [(1, 2, "Button.left", True)]
+
+    def get_recent_keyboard_events(self):
+        return []
+
+    def stop(self):
+        pass
+
+
+def fake_devices():
+    return FakeDevice(), FakeListener()
+
+
+class TestFrameRing(unittest.TestCase):
+    def test_write_read_overwrite(self):
+        ring = FrameRing.create(slots=2, max_monitors=2, max_frame_bytes=64)
+        try:
+            ring.write(1, 1.5, [(0, 0, 0, 4, 2, b"\x01" * 32), (1, 4, 0, 2, 2, b"\x02" * 16)])
+            captured_at, screens = ring.read(1)
+            self.assertEqual(captured_at, 1.5)
+            self.assertEqual([info.capture_screen_number for info in screens], [0, 1])
+            self.assertEqual(bytes(screens[1].capture_picture.raw), b"\x02" * 16)
+            self.assertEqual(screens[0].capture_picture.size, (4, 2))
+            ring.write(2, 2.0, [(0, 0, 0, 4, 2, b"\x03" * 32)])
+            self.assertTrue(screens[0].capture_picture.valid())
+            ring.write(3, 3.0, [(0, 0, 0, 4, 2, b"\x04" * 32)])  # reuses the slot of frame 1
+            self.assertFalse(screens[0].capture_picture.valid())
+            with self.assertRaises(FrameOverwritten):
+                ring.read(1)
+            with self.assertRaises(ValueError):
+                ring.write(4, 4.0, [(0, 0, 0, 8, 8, b"\x00" * 256)])
+            del screens
+        finally:
+            ring.close()
+
+    def test_copied_read_survives_reuse(self):
+        ring = FrameRing.create(slots=2, max_monitors=1, max_frame_bytes=32)
+        try:
+            ring.write(1, 1.0, [(0, 0, 0, 4, 2, b"\x01" * 32)])
+            _, screens = ring.read(1, copy=True)
+            ring.write(2, 2.0, [(0, 0, 0, 4, 2, b"\x02" * 32)])
+            ring.write(3, 3.0, [(0, 0, 0, 4, 2, b"\x03" * 32)])  # reuses the slot of frame 1
+            self.assertTrue(screens[0].capture_picture.valid())
+            self.assertEqual(bytes(screens[0].capture_picture.raw), b"\x01" * 32)
+        finally:
+            ring.close()
+
+
+class TestDeviceDaemon(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.process = device_daemon.start_daemon(slots=4, factory=fake_devices)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        cls.process.join(5)
+
+    def test_client(self):
+        client = DeviceClient.from_env()
+        try:
+            # concurrent captures share the grab in flight
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(client.get_all_screen_info()))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            frame_ids = {screens[0].capture_picture.frame_id for screens in results}
+            self.assertLessEqual(len(frame_ids), 2)
+            screens = client.get_all_screen_info(max_age=10)
+            # a fresh enough frame is served without a grab
+            self.assertEqual(screens[0].capture_picture.frame_id, max(frame_ids))
+            self.assertEqual(screens[1].screen_left, 10)
+            self.assertEqual(screens[0].capture_picture.size, (8, 4))
+            grab = screens[0].capture_picture.frame_id  # the fake fills frame n with the byte n
+            self.assertEqual(bytes(screens[0].capture_picture.raw[:4]), bytes([grab]) * 4)
+            # the frame is the client's own, newer grabs going round the ring don't touch it
+            for _ in range(5):
+                client.get_all_screen_info()
+            self.assertTrue(screens[0].capture_picture.valid())
+            self.assertEqual(bytes(screens[0].capture_picture.raw[:4]), bytes([grab]) * 4)
+
+            client.mouse_click(3, 4, button="left")
+            self.assertEqual(tuple(client.get_mouse_position()), (3, 4))
+            with self.assertRaises(AttributeError):
+                client.get_all_processes
+            self.assertEqual(client.input_listener.get_recent_mouse_events(), [(1, 2, "Button.left", True)])
+            del screens, results
+        finally:
+            client.close()
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import unittest
+
+from fastapi import BackgroundTasks, Request
+
+from asgi import file_serve
+from asgi.file_store import FileMeta
+
+
+def request(**headers) -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/", "query_string": b"",
+                    "headers": [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]})
+
+
+def body(response) -> bytes:
+    async def collect():
+        return b"".join([chunk async for chunk in response.body_iterator])
+
+    return asyncio.run(collect())
+
+
+class TestRanges(unittest.TestCase):
+    def test_parse_range(self):
+        self.assertEqual(file_serve.parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(file_serve.parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(file_serve.parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(file_serve.parse_range("bytes=-500", 100), (0, 99))
+        self.assertEqual(file_serve.parse_range("bytes=50-500", 100), (50, 99))  # clamped to the end
+        self.assertIsNone(file_serve.parse_range("bytes=0-1,5-6", 100))  # multiple ranges: the whole file
+        self.assertIsNone(file_serve.parse_range("items=0-1", 100))
+        self.assertIsNone(file_serve.parse_range("bytes=-", 100))
+        for header in ("bytes=100-", "bytes=9-3", "bytes=-0"):
+            with self.assertRaises(ValueError):
+                file_serve.parse_range(header, 100)
+
+    def test_etag_matches(self):
+        self.assertTrue(file_serve._etag_matches('"abc"', '"abc"'))
+        self.assertTrue(file_serve._etag_matches('"x", W/"abc"', '"abc"'))  # weak comparison
+        self.assertTrue(file_serve._etag_matches('"abc"', 'W/"abc"'))
+        self.assertTrue(file_serve._etag_matches("*", '"abc"'))
+        self.assertFalse(file_serve._etag_matches('"abcd"', '"abc"'))
+
+    def test_if_range_is_strong(self):
+        self.assertTrue(file_serve._strong_match(' "abc" ', '"abc"'))
+        self.assertFalse(file_serve._strong_match('W/"abc"', '"abc"'))
+        self.assertFalse(file_serve._strong_match('W/"abc"', 'W/"abc"'))
+        self.assertFalse(file_serve._strong_match('"abc"', None))
+
+
+class TestServeFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.data = bytes(range(256)) * 4
+        sha256 = hashlib.sha256(self.data).hexdigest()
+        path = os.path.join(self.tmpdir.name, sha256)
+        with open(path, "wb") as f:
+            f.write(self.data)
+        self.meta = FileMeta(sha256, path, sha256, len(self.data), "a.png", "image/png")
+        self.etag = f'"{sha256}"'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def serve(self, variant=None, tasks=None, **headers):
+        return file_serve.serve_file(request(**headers), self.meta, tasks or BackgroundTasks(), variant)
+
+    def test_if_none_match(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["etag"], self.etag)
+        self.assertIn("immutable", response.headers["cache-control"])
+        response = self.serve(if_none_match=self.etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["etag"], self.etag)
+
+    def test_range(self):
+        response = self.serve(range="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers["content-range"], f"bytes 10-19/{len(self.data)}")
+        self.assertEqual(body(response), self.data[10:20])
+        # If-Range with another validator: the whole file
+        self.assertEqual(self.serve(range="bytes=10-19", if_range='"other"').status_code, 200)
+        self.assertEqual(self.serve(range="bytes=10-19", if_range=self.etag).status_code, 206)
+
+    def test_range_with_weak_etag(self):
+        # files stored before hashing have a weak ETag, If-Range can't match it: the whole file
+        weak = FileMeta("old", self.meta.path, "", self.meta.size, "a.png", "image/png")
+        etag = file_serve.etag_of(weak)
+        self.assertTrue(etag.startswith("W/"))
+        response = file_serve.serve_file(request(range="bytes=10-19", if_range=etag), weak, BackgroundTasks())
+        self.assertEqual(response.status_code, 200)
+        response = file_serve.serve_file(request(range="bytes=10-19"), weak, BackgroundTasks())
+        self.assertEqual(response.status_code, 206)
+
+    def test_range_not_satisfiable(self):
+        response = self.serve(range=f"bytes={len(self.data)}-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers["content-range"], f"bytes */{len(self.data)}")
+
+    def test_variant_fallback_is_not_cached(self):
+        tasks = BackgroundTasks()
+        target = file_serve.variant_path(self.meta, "thumb")
+        try:
+            response = self.serve("thumb", tasks)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["cache-control"], "no-cache")
+            self.assertNotIn("etag", response.headers)
+            self.assertEqual(body(response), self.data)  # the original meanwhile
+            self.assertEqual(len(tasks.tasks), 1)
+            self.serve("thumb", tasks)
+            self.assertEqual(len(tasks.tasks), 1)  # scheduled once
+            # a validator of the original doesn't revalidate the variant url
+            self.assertEqual(self.serve("thumb", if_none_match=self.etag).status_code, 200)
+        finally:
+            file_serve._pending.discard(target)
+
+    def test_variant(self):
+        with open(file_serve.variant_path(self.meta, "thumb"), "wb") as f:
+            f.write(b"RIFF....WEBP")
+        response = self.serve("thumb")
+        self.assertEqual(response.media_type, "image/webp")
+        self.assertEqual(response.headers["etag"], f'"{self.meta.sha256}-thumb"')
+        self.assertIn("immutable", response.headers["cache-control"])
+        self.assertEqual(self.serve("nope").status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,213 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from tortoise import Tortoise
+from tortoise.exceptions import IntegrityError
+
+from asgi import file_serve, file_store
+from asgi.asgi_events import FileDB, index_filedb, migrate_filedb
+from utils.local_io import a_write_hashed
+
+
+class Upload:
+    """The part of fastapi.UploadFile that store_upload uses."""
+
+    def __init__(self, data: bytes, filename: str = "upload.bin", fail_after: int = None):
+        self.filename = filename
+        self._data = data
+        self._offset = 0
+        self._fail_after = fail_after
+
+    async def read(self, size: int = -1) -> bytes:
+        if self._fail_after is not None and self._offset >= self._fail_after:
+            raise ConnectionError("the client went away")
+        end = len(self._data) if size < 0 else self._offset + size
+        chunk = self._data[self._offset:end]
+        self._offset += len(chunk)
+        return chunk
+
+
+class StoreTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for patcher in (mock.patch.object(file_store, "storage_root", lambda: self.tmpdir.name),
+                        mock.patch.object(file_store, "meta_cache", file_store.FileMetaCache())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        await Tortoise.init(db_url=f"sqlite://{os.path.join(self.tmpdir.name, 'db.sqlite3')}",
+                            modules={"models": ["asgi.asgi_events"]})
+        await Tortoise.generate_schemas()
+        await index_filedb()
+
+    async def asyncTearDown(self):
+        await Tortoise.close_connections()
+        self.tmpdir.cleanup()
+
+    def leftovers(self):
+        return [name for name in os.listdir(self.tmpdir.name) if name.startswith(".upload-")]
+
+
+class TestStoreUpload(StoreTestCase):
+    async def test_write_hashed(self):
+        path = os.path.join(self.tmpdir.name, "out.bin")
+        data = os.urandom(10000)
+        sha256, size = await a_write_hashed(path, Upload(data).read, chunk_size=1024)
+        self.assertEqual((sha256, size), (hashlib.sha256(data).hexdigest(), len(data)))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    async def test_duplicate_returns_existing(self):
+        data = os.urandom(5000)
+        row, duplicate = await file_store.store_upload(Upload(data, "a.png"))
+        self.assertFalse(duplicate)
+        self.assertEqual(row.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(row.size, len(data))
+        again, duplicate = await file_store.store_upload(Upload(data, "b.png"))
+        self.assertTrue(duplicate)
+        self.assertEqual(again.id, row.id)
+        self.assertEqual(await FileDB.all().count(), 1)
+        self.assertEqual(self.leftovers(), [])  # the second copy was not kept
+
+    async def test_concurrent_upload_in_another_worker(self):
+        data = os.urandom(3000)
+        create = FileDB.create
+
+        async def another_worker_first(**kwargs):
+            await create(**kwargs)  # the other worker inserts the row between our lookup and our insert
+            return await create(**kwargs)
+
+        with mock.patch.object(FileDB, "create", side_effect=another_worker_first):
+            row, duplicate = await file_store.store_upload(Upload(data))
+        self.assertTrue(duplicate)
+        self.assertEqual(row.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(await FileDB.all().count(), 1)
+        self.assertTrue(os.path.exists(row.path))
+        with self.assertRaises(IntegrityError):
+            await create(filename="x", path="p", sha256=row.sha256)
+
+    async def test_lost_file_is_restored(self):
+        data = b"content" * 100
+        row, _ = await file_store.store_upload(Upload(data))
+        os.remove(row.path)
+        again, duplicate = await file_store.store_upload(Upload(data))
+        self.assertFalse(duplicate)
+        self.assertEqual(again.id, row.id)
+        self.assertTrue(os.path.exists(file_store.content_path(row.sha256)))
+
+    async def test_failed_upload_removes_partial_file(self):
+        with mock.patch.object(file_store, "UPLOAD_CHUNK_SIZE", 4):
+            with self.assertRaises(ConnectionError):
+                await file_store.store_upload(Upload(b"x" * 64, fail_after=16))
+        self.assertEqual(self.leftovers(), [])
+        self.assertEqual(await FileDB.all().count(), 0)
+
+
+class TestListAndCache(StoreTestCase):
+    async def test_cursor_pagination(self):
+        for i in range(7):
+            await file_store.store_upload(Upload(f"file {i}".encode(), f"{i}.txt"))
+        names, cursor, pages = [], 0, 0
+        while cursor is not None:
+            page = await file_store.list_files(cursor, limit=3)
+            names.extend(row["origin_name"] for row in page["files"])
+            cursor = page["next_cursor"]
+            pages += 1
+        self.assertEqual(names, [f"{i}.txt" for i in range(7)])
+        self.assertEqual(pages, 3)
+        # a last page that is exactly full has no next page
+        page = await file_store.list_files(0, limit=7)
+        self.assertIsNone(page["next_cursor"])
+
+    async def test_fields(self):
+        await file_store.store_upload(Upload(b"data", "a.txt"))
+        page = await file_store.list_files(fields=["size", "origin_name"])
+        self.assertEqual(set(page["files"][0]), {"id", "size", "origin_name"})
+        self.assertEqual(page["files"][0]["size"], 4)
+        with self.assertRaises(ValueError):
+            await file_store.list_files(fields=["size", "password"])
+
+    async def test_cache_after_upload_and_delete(self):
+        row, _ = await file_store.store_upload(Upload(b"cached", "c.txt"))
+        self.assertIsNotNone(file_store.meta_cache.get(row.filename))  # the upload filled it
+        with mock.patch.object(FileDB, "filter", side_effect=AssertionError("no database lookup")):
+            meta = await file_store.resolve(row.filename)
+        self.assertEqual(meta.size, 6)
+        self.assertTrue(await file_store.delete_file(row.filename))
+        self.assertIsNone(file_store.meta_cache.get(row.filename))
+        self.assertIsNone(await file_store.resolve(row.filename))
+        self.assertFalse(os.path.exists(row.path))
+        self.assertFalse(await file_store.delete_file(row.filename))
+
+    async def test_delete_removes_variants(self):
+        row, _ = await file_store.store_upload(Upload(b"image", "i.png"))
+        meta = file_store.FileMeta.from_row(row)
+        variants = [file_serve.variant_path(meta, variant) for variant in file_serve.VARIANTS]
+        for path in variants:
+            with open(path, "wb") as f:
+                f.write(b"RIFF....WEBP")
+        self.assertTrue(await file_store.delete_file(row.filename))
+        self.assertEqual([path for path in [row.path] + variants if os.path.exists(path)], [])
+
+    async def test_delete_keeps_shared_content(self):
+        # rows stored before hashing may share a path, the content stays while one still refers to it
+        path = os.path.join(self.tmpdir.name, "old.png")
+        with open(path, "wb") as f:
+            f.write(b"old")
+        await FileDB.create(filename="a", path=path)
+        await FileDB.create(filename="b", path=path)
+        self.assertTrue(await file_store.delete_file("a"))
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(await file_store.delete_file("b"))
+        self.assertFalse(os.path.exists(path))
+
+    async def test_deleted_by_another_worker(self):
+        row, _ = await file_store.store_upload(Upload(b"shared", "s.txt"))
+        # another worker deleted it: the row and the content are gone, this worker's cache still has it
+        await FileDB.filter(filename=row.filename).delete()
+        os.remove(row.path)
+        self.assertIsNone(await file_store.resolve(row.filename))
+        self.assertEqual(len(file_store.meta_cache), 0)
+
+
+class TestMigrate(unittest.IsolatedAsyncioTestCase):
+    async def test_old_database(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "old.sqlite3")
+            # the table as the first versions created it
+            with sqlite3.connect(path) as conn:
+                conn.execute('CREATE TABLE "filedb" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, '
+                             '"filename" VARCHAR(255) NOT NULL, "path" VARCHAR(255) NOT NULL)')
+                conn.execute("INSERT INTO filedb (filename, path) VALUES ('old', 'storage/old.png')")
+                conn.execute("INSERT INTO filedb (filename, path) VALUES ('older', 'storage/older.png')")
+            conn.close()
+            await Tortoise.init(db_url=f"sqlite://{path}", modules={"models": ["asgi.asgi_events"]})
+            try:
+                for _ in range(2):  # every startup runs it
+                    await migrate_filedb()
+                    await Tortoise.generate_schemas()
+                    await index_filedb()
+                row = await FileDB.get(filename="old")
+                self.assertEqual((row.sha256, row.size, row.origin_name, row.content_type), ("", 0, "", ""))
+                await FileDB.create(filename="new", path="p", sha256="ab" * 32, size=1)
+                self.assertEqual(await FileDB.filter(sha256="ab" * 32).count(), 1)
+                # unique among hashed rows only, the unhashed old rows stay
+                with self.assertRaises(IntegrityError):
+                    await FileDB.create(filename="new", path="p", sha256="ab" * 32, size=1)
+                self.assertEqual(await FileDB.filter(sha256="").count(), 2)
+                db = Tortoise.get_connection("default")
+                _, indexes = await db.execute_query("PRAGMA index_list(filedb)")
+                indexed = set()
+                for index in indexes:
+                    _, columns = await db.execute_query(f"PRAGMA index_info({index['name']})")
+                    indexed.update(column["name"] for column in columns)
+                self.assertLessEqual({"filename", "sha256"}, indexed)
+            finally:
+                await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    unittest.main()
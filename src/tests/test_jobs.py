@@ -0,0 +1,121 @@
+import threading
+import time
+import unittest
+from utils.jobs import JobManager, JobQueueFull, JobStatus
+
+
+class TestJobManager(unittest.TestCase):
+    def wait(self, job, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not job.status.finished and time.monotonic() < deadline:
+            job.wait_change(job.version, 0.05)
+        return job
+
+    def test_result_and_error(self):
+        jobs = JobManager(workers=1)
+        self.assertEqual(self.wait(jobs.submit(lambda job: 42)).result, 42)
+        failed = self.wait(jobs.submit(lambda job: 1 / 0))
+        self.assertEqual(failed.status, JobStatus.FAILED)
+        self.assertIn("ZeroDivisionError", failed.error)
+        jobs.shutdown()
+
+    def test_priority(self):
+        jobs = JobManager(workers=1)
+        gate = threading.Event()
+        order = []
+        jobs.submit(lambda job: gate.wait(2))
+        low = jobs.submit(lambda job: order.append("low"), priority=0)
+        high = jobs.submit(lambda job: order.append("high"), priority=5)
+        gate.set()
+        self.wait(low)
+        self.wait(high)
+        self.assertEqual(order, ["high", "low"])
+        jobs.shutdown()
+
+    def test_cancel_and_timeout(self):
+        jobs = JobManager(workers=1)
+
+        def spin(job):
+            while True:
+                job.check()
+                time.sleep(0.01)
+
+        running = jobs.submit(spin)
+        queued = jobs.submit(lambda job: "never")
+        while running.status != JobStatus.RUNNING:
+            running.wait_change(running.version, 0.05)
+        self.assertTrue(jobs.cancel(queued.job_id))
+        self.assertTrue(jobs.cancel(running.job_id))
+        self.assertEqual(self.wait(running).status, JobStatus.CANCELLED)
+        self.assertEqual(self.wait(queued).status, JobStatus.CANCELLED)
+        self.assertIsNone(queued.started_at)
+        self.assertEqual(self.wait(jobs.submit(spin, timeout=0.05)).status, JobStatus.TIMEOUT)
+        jobs.shutdown()
+
+    def test_queue_full(self):
+        jobs = JobManager(workers=1, max_queue=1)
+        gate = threading.Event()
+        first = jobs.submit(lambda job: gate.wait(2))
+        while first.status != JobStatus.RUNNING:
+            first.wait_change(first.version, 0.05)
+        jobs.submit(lambda job: None)
+        with self.assertRaises(JobQueueFull):
+            jobs.submit(lambda job: None)
+        self.assertEqual(jobs.metrics()["queued"], 1)
+        self.assertEqual(jobs.metrics()["rejected"], 1)
+        gate.set()
+        jobs.shutdown()
+
+    def test_cancel_frees_queue_slot(self):
+        jobs = JobManager(workers=1, max_queue=1)
+        gate = threading.Event()
+        first = jobs.submit(lambda job: gate.wait(2))
+        while first.status != JobStatus.RUNNING:
+            first.wait_change(first.version, 0.05)
+        queued = jobs.submit(lambda job: "never")
+        self.assertTrue(jobs.cancel(queued.job_id))
+        self.assertEqual(queued.status, JobStatus.CANCELLED)  # right away, not when a worker dequeues it
+        self.assertEqual(jobs.metrics()["queued"], 0)
+        last = jobs.submit(lambda job: "ran")
+        self.assertFalse(jobs.cancel(queued.job_id))
+        gate.set()
+        self.assertEqual(self.wait(last).result, "ran")
+        self.assertEqual(jobs.metrics()["cancelled"], 1)
+        self.assertEqual(jobs.metrics()["queued"], 0)
+        jobs.shutdown()
+
+    def test_cancel_churn(self):
+        jobs = JobManager(workers=1, max_queue=4)
+        gate = threading.Event()
+        first = jobs.submit(lambda job: gate.wait(2))
+        while first.status != JobStatus.RUNNING:
+            first.wait_change(first.version, 0.05)
+        frames = bytearray(1 << 20)
+        for _ in range(100):
+            job = jobs.submit(lambda job: len(frames), priority=1)
+            self.assertTrue(jobs.cancel(job.job_id))
+            self.assertIsNone(job.func)  # the closure and its frames are released
+        self.assertEqual(jobs._queue.qsize(), 0)
+        last = jobs.submit(lambda job: "ran")
+        gate.set()
+        self.assertEqual(self.wait(last).result, "ran")
+        jobs.shutdown()
+
+    def test_watch(self):
+        jobs = JobManager(workers=1)
+        gate = threading.Event()
+        changes = []
+        job = jobs.submit(lambda job: gate.wait(2))
+
+        def watcher():
+            changes.append(job.status)
+
+        job.watch(watcher)
+        gate.set()
+        self.wait(job)
+        self.assertEqual(changes[-1], JobStatus.DONE)
+        job.unwatch(watcher)
+        count = len(changes)
+        job.report(again=True)
+        self.assertEqual(len(changes), count)
+        jobs.shutdown()
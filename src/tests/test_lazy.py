@@ -0,0 +1,36 @@
+import sys
+import threading
+import unittest
+from utils.lazy import LazyModule, is_loaded, lazy_import, lazy_property
+
+
+class TestLazy(unittest.TestCase):
+    def test_lazy_import(self):
+        sys.modules.pop("colorsys", None)
+        colorsys = lazy_import("colorsys")
+        self.assertIsInstance(colorsys, LazyModule)
+        self.assertNotIn("colorsys", sys.modules)
+        self.assertEqual(colorsys.rgb_to_hsv(1, 0, 0), (0.0, 1.0, 1.0))
+        self.assertIn("colorsys", sys.modules)
+        # already imported modules are returned as they are
+        self.assertIs(lazy_import("threading"), threading)
+
+    def test_lazy_property(self):
+        calls = []
+
+        class Context:
+            @lazy_property
+            def device(self):
+                calls.append(1)
+                return object()
+
+        context = Context()
+        self.assertFalse(is_loaded(context, "device"))
+        threads = [threading.Thread(target=lambda: context.device) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIs(context.device, context.device)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(is_loaded(context, "device"))
@@ -0,0 +1,110 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+import timeit
+import unittest
+from unittest import mock
+from utils import log
+
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def read_lines(self, name):
+        log.shutdown()  # drains the queue, the next Logger starts the listener again
+        with open(os.path.join(self.dir, name), encoding="utf-8") as f:
+            return f.read().splitlines()
+
+    def test_no_duplicate_handlers(self):
+        first = log.Logger("test.dup", os.path.join(self.dir, "dup.log")).get_logger()
+        second = log.Logger("test.dup", os.path.join(self.dir, "dup.log")).get_logger()
+        self.assertIs(first, second)
+        self.assertEqual(len(first.handlers), 1)
+        first.info("once")
+        self.assertEqual(len([line for line in self.read_lines("dup.log") if "once" in line]), 1)
+
+    def test_json_lines(self):
+        logger = log.Logger("test.json", os.path.join(self.dir, "json.log"), structured=True).get_logger()
+        logger.info("matched %s", "button", extra={"score": 0.93})
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("failed")
+        first, second = [json.loads(line) for line in self.read_lines("json.log")]
+        self.assertEqual(first["message"], "matched button")
+        self.assertEqual(first["score"], 0.93)
+        self.assertEqual(first["level"], "INFO")
+        self.assertIn("ValueError: boom", second["exc"])
+
+    def test_file_per_worker(self):
+        with mock.patch.object(log.config, "ASGI_APP_WORKERS", 4):
+            logger = log.Logger("test.workers", os.path.join(self.dir, "workers.log")).get_logger()
+        logger.info("from a worker")
+        self.assertIn("from a worker", self.read_lines(f"workers.{os.getpid()}.log")[0])
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "workers.log")))
+
+    def test_rotation_is_compressed(self):
+        path = os.path.join(self.dir, "rotate.log")
+        handler = log.GzipRotatingFileHandler(path, max_bytes=200, backups=2)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        for n in range(20):
+            handler.emit(logging.makeLogRecord({"msg": f"line {n:02d} " + "x" * 40}))
+        handler.close()
+        self.assertTrue(os.path.exists(path + ".1.gz"))
+        self.assertFalse(os.path.exists(path + ".3.gz"))
+        with gzip.open(path + ".1.gz", "rt") as f:
+            self.assertIn("line", f.read())
+
+    def test_rate_limit(self):
+        now = [0.0]
+        limit = log.RateLimitFilter(rate=2, per=1.0, clock=lambda: now[0])
+
+        def record(msg="frame %d"):
+            return logging.makeLogRecord({"msg": msg, "levelno": logging.DEBUG})
+
+        passed = [limit.filter(record()) for _ in range(5)]
+        self.assertEqual(passed, [True, True, False, False, False])
+        self.assertTrue(limit.filter(record("other")))
+        now[0] = 1.5
+        next_window = record()
+        self.assertTrue(limit.filter(next_window))
+        self.assertEqual(next_window.suppressed, 3)
+
+    def test_sample(self):
+        sample = log.SampleFilter(every=3)
+        passed = [sample.filter(logging.makeLogRecord({"msg": "frame"})) for _ in range(7)]
+        self.assertEqual(passed, [True, False, False, True, False, False, True])
+
+    def test_filtered_call_is_cheap(self):
+        logger = log.Logger("test.cheap", os.path.join(self.dir, "cheap.log"), level=logging.INFO).get_logger()
+        frame_log = log.throttled(logger, rate=1, per=1.0)
+        # the reference: a call that is let through, it builds and handles a record
+        unfiltered = logging.getLogger("test.cheap.unfiltered")
+        unfiltered.propagate = False
+        unfiltered.setLevel(logging.DEBUG)
+        unfiltered.addHandler(logging.NullHandler())
+        calls = 20000
+        filtered = min(timeit.repeat(lambda: frame_log.debug("frame %d", 1), number=calls, repeat=3))
+        handled = min(timeit.repeat(lambda: unfiltered.debug("frame %d", 1), number=calls, repeat=3))
+        self.assertLess(filtered, handled / 5)
+
+    def test_filter_state_is_bounded(self):
+        clock = [0.0]
+        limit = log.RateLimitFilter(rate=1, per=1.0, clock=lambda: clock[0], max_keys=8)
+        sample = log.SampleFilter(every=2, max_keys=8)
+        for n in range(100):
+            record = logging.makeLogRecord({"msg": f"message {n}"})  # formatted before logging: a new key each time
+            limit.filter(record)
+            sample.filter(record)
+            clock[0] += 0.1
+        self.assertLessEqual(len(limit._windows), 8)
+        self.assertLessEqual(len(sample._counts), 8)
+        # the latest message keeps its window
+        self.assertFalse(limit.filter(logging.makeLogRecord({"msg": "message 99"})))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from io_tools.memoize import cached, make_key
+
+
+class TestMemoize(unittest.TestCase):
+    def test_ttl(self):
+        calls = []
+
+        @cached(ttl=0.05)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(len(calls), 1)
+        time.sleep(0.06)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(len(calls), 2)
+
+    def test_single_flight(self):
+        calls = []
+        results = []
+
+        @cached(ttl=10)
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.1)
+            return x
+
+        threads = [threading.Thread(target=lambda: results.append(slow("same"))) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["same"] * 8)
+
+    def test_async_single_flight(self):
+        calls = []
+
+        @cached(ttl=10)
+        async def slow(x):
+            calls.append(x)
+            await asyncio.sleep(0.05)
+            return x
+
+        async def main():
+            return await asyncio.gather(*(slow(1) for _ in range(8)))
+
+        self.assertEqual(asyncio.run(main()), [1] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_exception_not_cached(self):
+        calls = []
+
+        @cached()
+        def fail():
+            calls.append(1)
+            raise ValueError("fail")
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                fail()
+        self.assertEqual(len(calls), 2)
+
+    def test_file_key(self):
+        def read(path): ...
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "template.png")
+            with open(path, "wb") as f:
+                f.write(b"1")
+            first = make_key(read, (path,), {}, paths=("path",))
+            self.assertEqual(first, make_key(read, (), {"path": path}, paths=("path",)))
+            unmarked = make_key(read, (path,), {})
+            with open(path, "wb") as f:
+                f.write(b"22")
+            self.assertNotEqual(first, make_key(read, (path,), {}, paths=("path",)))
+            # strings that are not marked as paths are not looked up on disk
+            self.assertEqual(unmarked, make_key(read, (path,), {}))
+
+    def test_max_size(self):
+        calls = []
+
+        @cached(max_size=2)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        for x in (1, 2, 3, 3, 2, 1):
+            square(x)
+        self.assertEqual(calls, [1, 2, 3, 1])  # 1 was dropped when 3 came in
+
+    def test_custom_key(self):
+        @cached(key=lambda x, y: str(x))
+        def add(x, y):
+            return x + y
+
+        self.assertEqual(add(1, 2), 3)
+        self.assertEqual(add(1, 5), 3)
@@ -35,3 +35,32 @@ class TestDevice(unittest.TestCase):
         self.assertGreaterEqual(r[2],THRESHOLD)
 
         
+    def test_matches_dont_overlap(self):
+        import numpy as np
+        rng = np.random.default_rng(2)
+        frame = rng.integers(0, 256, (120, 160), dtype=np.uint8)
+        template = frame[40:60, 50:80].copy()
+        h, w = template.shape
+        result = match.CV.match_template(frame, template, threshold=-1, max_matches=8)
+        self.assertEqual(len(result["matches"]), 8)
+        centers = [hit["center"] for hit in result["matches"]]
+        self.assertEqual(centers[0], (65, 50))
+        for n, (x, y) in enumerate(centers):
+            for other_x, other_y in centers[n + 1:]:
+                self.assertTrue(abs(x - other_x) >= w or abs(y - other_y) >= h, centers)
+
+    def test_match_many(self):
+        import numpy as np
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 256, (240, 320), dtype=np.uint8)
+        first = frame[40:60, 50:80].copy()
+        second = frame[150:170, 200:240].copy()
+        results = match.CV.match_many(frame, [
+            {"template": first},
+            {"template": second, "roi": (180, 140, 80, 50)},
+            {"template": second, "roi": (0, 0, 100, 100)},  # outside its roi
+        ])
+        self.assertEqual(results[0]["matches"][0]["center"], (65, 50))
+        self.assertEqual(results[1]["matches"][0]["center"], (220, 160))
+        self.assertGreater(results[1]["score"], 0.99)
+        self.assertFalse(results[2]["found"])
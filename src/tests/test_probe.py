@@ -0,0 +1,53 @@
+import unittest
+
+try:
+    import numpy as np
+    from image_tools.probe import Pixel, ProbeBook, Region
+except ImportError:  # numpy is not installed
+    np = None
+
+
+class FakeScreenShot:
+    """The part of a mss ScreenShot the probes read: a raw BGRA buffer."""
+
+    def __init__(self, frame):
+        self.raw = bytearray(frame.tobytes())
+        self.height, self.width = frame.shape[:2]
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestProbe(unittest.TestCase):
+    def setUp(self):
+        self.frame = np.zeros((120, 200, 4), dtype=np.uint8)
+        self.frame[10, 20, :3] = (48, 196, 255)
+        self.frame[50:60, 100:110, :3] = (30, 30, 30)
+        self.frame[50, 100, :3] = (60, 60, 60)  # the mean of the region stays within 8
+
+    def test_sets(self):
+        book = ProbeBook()
+        book.add("battle", [Pixel(20, 10, (50, 190, 250)), Region(100, 50, 10, 10, (30, 30, 30))])
+        book.add("lobby", [Pixel(20, 10, (255, 255, 255), tolerance=4)])
+        book.add("region only", [Region(100, 50, 10, 10, (0, 0, 0), tolerance=10)])
+        expected = {"battle": True, "lobby": False, "region only": False}
+        self.assertEqual(book.evaluate(self.frame), expected)
+        self.assertEqual(book.evaluate(FakeScreenShot(self.frame)), expected)
+        self.assertEqual(book.evaluate(self.frame[:, :, :3]), expected)  # BGR works as well
+
+        colors = book.colors(self.frame)
+        self.assertEqual(colors.shape, (4, 3))
+        self.assertAlmostEqual(float(colors[3][0]), 30.3, places=4)
+
+    def test_bounds(self):
+        book = ProbeBook().add("far", [Pixel(500, 10, (0, 0, 0))])
+        with self.assertRaises(ValueError):
+            book.evaluate(self.frame)
+        with self.assertRaises(ValueError):
+            book.add("negative", [Pixel(-1, 0, (0, 0, 0))])
+        with self.assertRaises(ValueError):
+            book.add("empty", [])
+        book.remove("far")
+        self.assertEqual(book.evaluate(self.frame), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
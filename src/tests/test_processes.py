@@ -0,0 +1,127 @@
+import unittest
+from io_tools.processes import (AppHandleCache, ProcessIndex, ProcessProvider, ProcessSnapshot, ProcessWatcher,
+                                WindowProvider)
+
+
+class FakeProvider(ProcessProvider):
+    def __init__(self, table):
+        self.table = dict(table)  # pid -> (ppid, name)
+        self.queried = []
+        self.vanish_on_query = set()
+        self.status = {}  # pid -> status, "running" by default
+
+    def pids(self):
+        return list(self.table)
+
+    def info(self, pids=None):
+        for pid in (list(self.table) if pids is None else pids):
+            self.queried.append(pid)
+            if pid in self.vanish_on_query or pid not in self.table:
+                continue  # exited between pids() and the query
+            ppid, name, *created = self.table[pid]
+            yield {"pid": pid, "ppid": ppid, "name": name, "status": self.status.get(pid, "running"), "exe": None,
+                   "create_time": created[0] if created else 1.0}
+
+    def statuses(self, pids):
+        return {pid: self.status.get(pid, "running") for pid in pids if pid in self.table}
+
+
+class FakeWindows(WindowProvider):
+    def __init__(self, windows):
+        self.table = windows
+        self.enumerations = 0
+
+    def windows(self):
+        self.enumerations += 1
+        return {pid: list(handles) for pid, handles in self.table.items()}
+
+
+class TestProcessSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.provider = FakeProvider({1: (0, "init"), 10: (1, "game.exe"), 11: (10, "helper.exe"),
+                                      12: (10, "helper.exe")})
+        self.snapshot = ProcessSnapshot(self.provider)
+
+    def test_full_refresh(self):
+        added, removed = self.snapshot.refresh()
+        self.assertEqual(sorted(added), [1, 10, 11, 12])
+        self.assertEqual(self.snapshot.children_of(10), [11, 12])
+        self.assertEqual(sorted(self.snapshot.children_of(1, recursive=True)), [10, 11, 12])
+        self.assertEqual([p.pid for p in self.snapshot.by_name("helper.exe")], [11, 12])
+        self.assertEqual(self.snapshot.get(1).exe, "")
+
+    def test_incremental_refresh(self):
+        self.snapshot.refresh()
+        self.provider.queried.clear()
+        del self.provider.table[11]
+        self.provider.table[20] = (10, "helper.exe")
+        self.provider.table[21] = (1, "short.exe")
+        self.provider.vanish_on_query.add(21)
+        generation = self.snapshot.generation
+        added, removed = self.snapshot.refresh()
+        # only new pids are queried, a process that exits mid-refresh is skipped
+        self.assertEqual(self.provider.queried, [20, 21])
+        self.assertEqual((added, removed), ([20], [11]))
+        self.assertEqual(self.snapshot.children_of(10), [12, 20])
+        self.assertEqual(self.snapshot.generation, generation + 1)
+        # nothing changed, nothing swapped
+        self.snapshot.refresh()
+        self.assertEqual(self.snapshot.generation, generation + 1)
+
+    def test_status_is_refreshed(self):
+        self.snapshot.refresh()
+        self.provider.queried.clear()
+        self.provider.status[10] = "stopped"
+        generation = self.snapshot.generation
+        self.assertEqual(self.snapshot.refresh(), ([], []))
+        self.assertEqual(self.snapshot.get(10).status, "stopped")
+        self.assertEqual(self.snapshot.get(11).status, "running")
+        self.assertEqual(self.snapshot.generation, generation + 1)
+        self.assertEqual(self.provider.queried, [])  # the other attributes are not read again
+
+
+class TestProcessIndex(unittest.TestCase):
+    def setUp(self):
+        self.provider = FakeProvider({1: (0, "init"), 10: (1, "game.exe"), 11: (1, "game.exe")})
+        self.window_provider = FakeWindows({10: [1001, 1002]})
+        self.index = ProcessIndex(ProcessSnapshot(self.provider), self.window_provider)
+
+    def test_lookup(self):
+        self.index.refresh()
+        self.assertEqual(self.index.pids("game.exe"), [10, 11])
+        self.assertEqual(self.index.windows_of_name("game.exe"), {10: [1001, 1002], 11: []})
+        # a window shown later is picked up without the process changing
+        self.window_provider.table[11] = [1101]
+        self.index.refresh()
+        self.assertEqual(self.index.windows(11), [1101])
+        self.assertEqual(self.index.windows_of_name("missing.exe"), {})
+
+    def test_watcher_diffs(self):
+        watcher = ProcessWatcher(self.index, interval=60)
+        events = []
+        watcher.add_listener(lambda added, removed: events.append((sorted(added), removed)))
+        watcher.poll()
+        watcher.poll()  # nothing changed, no event
+        del self.provider.table[11]
+        self.provider.table[12] = (1, "game.exe")
+        watcher.poll()
+        self.assertEqual(events, [([1, 10, 11], []), ([12], [11])])
+
+    def test_app_handles(self):
+        snapshot = self.index.snapshot
+        connects = []
+        apps = AppHandleCache(snapshot, lambda pid: connects.append(pid) or f"app-{pid}-{len(connects)}")
+        self.index.refresh()
+        self.assertEqual(apps.get(10), "app-10-1")
+        self.assertEqual(apps.get(10), "app-10-1")
+        self.assertEqual(connects, [10])
+        # the pid is reused by a new process: a new connection
+        self.provider.table[10] = (1, "game.exe", 2.0)
+        snapshot.refresh(full=True)
+        self.assertEqual(apps.get(10), "app-10-2")
+        # the process exited
+        del self.provider.table[10]
+        self.index.refresh()
+        with self.assertRaises(LookupError):
+            apps.get(10)
+        self.assertEqual(len(apps), 0)
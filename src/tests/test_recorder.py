@@ -0,0 +1,102 @@
+import os
+import tempfile
+import time
+import unittest
+
+try:
+    import numpy as np
+    from io_tools.recorder import FlightRecorder
+except ImportError:  # numpy is not installed
+    np = None
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestFlightRecorder(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        self.frames = []
+        frame = rng.integers(0, 256, (90, 150, 4), dtype=np.uint8)  # not a multiple of the tile size
+        for n in range(10):
+            frame = frame.copy()
+            frame[(n * 7) % 80:(n * 7) % 80 + 10, 20:40] = n * 20  # a small change per frame
+            self.frames.append(frame)
+
+    def recorder(self, **kwargs):
+        kwargs.setdefault("interval", 0)
+        kwargs.setdefault("cpu_budget", 1.0)
+        return FlightRecorder(self.dir, tile=16, **kwargs)
+
+    def test_nearest_frame_is_exact(self):
+        recorder = self.recorder(keyframe_every=4)
+        for n, frame in enumerate(self.frames):
+            recorder.record(frame, timestamp=1000.0 + n)
+        self.assertEqual(recorder.keyframes, 3)  # frames 0, 4 and 8
+        for asked, expected in ((1003.2, 3), (1006.6, 7), (990.0, 0), (2000.0, 9)):
+            timestamp, frame = recorder.frame_at(asked)
+            self.assertEqual(timestamp, 1000.0 + expected)
+            np.testing.assert_array_equal(frame, self.frames[expected][:, :, :3])
+        recorder.stop()
+
+        # segments written before are read back
+        reopened = self.recorder()
+        timestamp, frame = reopened.frame_at(1005.0)
+        np.testing.assert_array_equal(frame, self.frames[5][:, :, :3])
+        self.assertEqual(reopened.segments()[0]["frames"], 10)
+
+    def test_rotation_and_disk_budget(self):
+        recorder = self.recorder(segment_seconds=3)
+        for n, frame in enumerate(self.frames):
+            recorder.record(frame, timestamp=1000.0 + n)
+        self.assertEqual(len(recorder.segments()), 4)  # 0-2, 3-5, 6-8, 9
+        # the last two segments and room for one more delta, each segment starts with a 43 KB keyframe
+        recorder.max_bytes = sum(segment["bytes"] for segment in recorder.segments()[2:]) + 8192
+        recorder.record(self.frames[0], timestamp=1009.5)
+        segments = recorder.segments()
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(segments[0]["start"], 1006.0)
+        self.assertEqual(len(os.listdir(self.dir)), 4)
+        self.assertEqual(recorder.frame_at(1000.0)[0], 1006.0)  # the oldest frame left
+
+    def test_keyframe_then_rotation(self):
+        # keyframes at 0 and 4, the second segment starts at 6 with its own keyframe
+        recorder = self.recorder(keyframe_every=4, segment_seconds=6)
+        for n, frame in enumerate(self.frames):
+            recorder.record(frame, timestamp=1000.0 + n)
+        self.assertEqual(len(recorder.segments()), 2)
+        for segment in recorder._segments:
+            index = segment.index()
+            keyframes = index["kind"] == 0
+            # every keyframe is its own key, every delta points at a keyframe before it
+            self.assertEqual(list(index["key"][keyframes]), list(np.flatnonzero(keyframes)))
+            self.assertTrue(all(keyframes[key] and key <= n for n, key in enumerate(index["key"])))
+        for n in range(len(self.frames)):
+            timestamp, frame = recorder.frame_at(1000.0 + n)
+            self.assertEqual(timestamp, 1000.0 + n)
+            np.testing.assert_array_equal(frame, self.frames[n][:, :, :3])
+        recorder.stop()
+
+    def test_feed_drops_frames_over_budget(self):
+        class Frame:
+            def __init__(self, picture):
+                self.picture = picture
+                self.captured_at = time.monotonic()
+
+            def screen(self, number):
+                return type("Info", (), {"capture_picture": self.picture})()
+
+        # the interval
+        recorder = self.recorder(interval=10)
+        recorder.record(self.frames[0])
+        recorder.feed(Frame(self.frames[1]))
+        self.assertEqual(recorder.dropped, 1)
+        self.assertIsNone(recorder._pending)
+        # the cpu budget: an encode costs more than 1 ns of CPU, the next frame is far away
+        recorder = self.recorder(interval=0, cpu_budget=1e-9)
+        recorder.record(self.frames[0])
+        recorder.feed(Frame(self.frames[1]))
+        self.assertEqual(recorder.dropped, 1)
+        self.assertLess(recorder.metrics()["cpu_share"], 1e-8)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+try:
+    import numpy as np
+    from io_tools.sampler import ProcessGone, ResourceSampler, RingSeries, SampleProvider
+except ImportError:  # numpy is not installed
+    np = None
+    SampleProvider = object
+
+
+class FakeProvider(SampleProvider):
+    def __init__(self):
+        self.samples = {}  # pid -> list of (cpu, rss, read, write)
+
+    def sample(self, pid):
+        if not self.samples.get(pid):
+            raise ProcessGone(pid)
+        return self.samples[pid].pop(0)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestResourceSampler(unittest.TestCase):
+    def test_ring(self):
+        series = RingSeries(3)
+        for n in range(5):
+            series.append(float(n), (n, 0, 0, 0))
+        times, values = series.ordered()
+        self.assertEqual(times.tolist(), [2.0, 3.0, 4.0])
+        self.assertEqual(values[:, 0].tolist(), [2.0, 3.0, 4.0])
+        self.assertEqual(len(series), 3)
+
+    def test_stats(self):
+        provider = FakeProvider()
+        provider.samples[1] = [(10.0 * n, 100.0, 1000.0 * n, 0.0) for n in range(10)]
+        sampler = ResourceSampler(provider, interval=1.0, capacity=8)
+        sampler.watch(1)
+        sampler.watch(2)  # never seen
+        for n in range(11):
+            sampler.tick(now=float(n))
+        stats = sampler.stats(1)
+        self.assertFalse(stats["running"])  # the provider ran out of samples: the process exited
+        self.assertEqual(stats["samples"], 8)
+        self.assertAlmostEqual(stats["cpu_percent"]["avg"], 55.0)
+        self.assertAlmostEqual(stats["cpu_percent"]["trend_per_min"], 600.0)
+        self.assertAlmostEqual(stats["read_bytes_per_s"]["last"], 1000.0)
+        self.assertEqual(sampler.stats(1, seconds=2)["samples"], 3)
+        self.assertEqual(sampler.stats(2)["samples"], 0)
+        self.assertIsNone(sampler.stats(3))
+        self.assertEqual(sampler.overhead()["ticks"], 11)
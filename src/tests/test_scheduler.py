@@ -0,0 +1,152 @@
+import itertools
+import threading
+import time
+import unittest
+from mihoyo.scheduler import (Check, InputArbiter, Scheduler, Workflow, click_hit, gated, pixel_check, probe_check,
+                              template_check)
+
+try:
+    import numpy as np
+    from image_tools.probe import Pixel
+except ImportError:  # numpy is not installed
+    np = None
+
+
+try:
+    import cv2
+except ImportError:  # opencv is not installed
+    cv2 = None
+
+
+class FakeScreenShot:
+    """The part of a mss ScreenShot the checks read: a raw BGRA buffer, not an ndarray."""
+
+    def __init__(self, frame):
+        self.raw = bytearray(frame.tobytes())
+        self.height, self.width = frame.shape[:2]
+
+
+class FakeDevice:
+    def __init__(self):
+        self.clicks = []
+
+    def mouse_click(self, x, y):
+        self.clicks.append((x, y))
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        self.image = None
+        self.grabs = 0
+
+        def grab():
+            self.grabs += 1
+            return self.image, (100, 200), time.monotonic()
+
+        self.scheduler = Scheduler(grab, InputArbiter(self.device), interval=0.01)
+
+    def test_one_capture_per_tick_and_shared_checks(self):
+        calls = []
+        shared = Check("shared", lambda frame: calls.append(1) or False)
+        for name in ("a", "b", "c"):
+            self.scheduler.register(Workflow(name, "start").on("start", shared, goto="end"))
+        self.scheduler.tick()
+        self.assertEqual(self.grabs, 1)
+        self.assertEqual(len(calls), 1)  # evaluated once for the three tasks
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_transitions_and_stats(self):
+        frame = np.zeros((20, 20, 4), dtype=np.uint8)
+        frame[5, 10] = (0, 0, 255, 255)
+        self.image = FakeScreenShot(frame)  # as grabbed from mss
+        red = pixel_check("red", 10, 5, (0, 0, 250), tolerance=8)
+        flow = Workflow("daily", "lobby", cooldown_ms=0).on("lobby", red, click_hit, "done")
+        task = self.scheduler.register(flow)
+        self.assertEqual(self.scheduler.tick(), 1)
+        self.assertEqual(self.device.clicks, [(110, 205)])  # frame offset applied
+        self.assertEqual(task.status, "done")
+        stats = self.scheduler.stats()
+        self.assertEqual(stats["tasks"][0]["transitions"], 1)
+        self.assertEqual(stats["tasks"][0]["reaction_ms"]["count"], 1)
+        self.assertEqual(stats["input_calls"], 1)
+        # nothing running: no capture
+        self.scheduler.tick()
+        self.assertEqual(self.grabs, 1)
+
+    def test_cheap_likely_checks_first(self):
+        order = []
+        expensive = Check("expensive", lambda frame: order.append("expensive") or "hit", cost_ms=50)
+        cheap = Check("cheap", lambda frame: order.append("cheap") or "hit", cost_ms=0.01)
+        self.scheduler.register(Workflow("w", "s").on("s", expensive).on("s", cheap))
+        self.scheduler.tick()
+        self.assertEqual(order, ["cheap"])  # the first hit decides, the expensive check is not run
+
+    def test_cooldown_and_failure(self):
+        hits = Check("always", lambda frame: (1, 1))
+        task = self.scheduler.register(Workflow("w", "s", cooldown_ms=10000).on("s", hits, click_hit))
+        self.scheduler.tick()
+        self.scheduler.tick()
+        self.assertEqual(len(self.device.clicks), 1)  # the second frame is older than the cooldown end
+
+        def boom(frame):
+            raise ValueError("broken")
+
+        broken = self.scheduler.register(Workflow("broken", "s").on("s", Check("boom", boom)))
+        self.scheduler.tick()
+        self.assertEqual(broken.status, "failed")
+        self.assertIn("broken", broken.error)
+        self.assertEqual(task.status, "running")
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_probe_gate(self):
+        frame = np.zeros((20, 20, 4), dtype=np.uint8)
+        self.image = frame
+        matched = []
+        expensive = Check("expensive match", lambda f: matched.append(1) or (5, 5), cost_ms=20)
+        self.scheduler.probes.add("lobby", [Pixel(3, 3, (255, 255, 255))])
+        self.scheduler.probes.add("battle", [Pixel(4, 4, (0, 0, 0))])
+        lobby = probe_check("lobby", self.scheduler.probes)
+        self.scheduler.register(Workflow("w", "s").on("s", gated(lobby, expensive), goto="end"))
+        self.scheduler.register(Workflow("v", "s").on("s", probe_check("battle", self.scheduler.probes)))
+        self.scheduler.tick()
+        self.assertEqual(matched, [])  # the gate kept the match from running
+        frame[3, 3, :3] = 255
+        self.scheduler.tick()
+        self.assertEqual(matched, [1])
+
+    @unittest.skipIf(cv2 is None, "opencv is not installed")
+    def test_template_check_on_screenshot(self):
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 256, (60, 80, 4), dtype=np.uint8)
+        template = cv2.cvtColor(frame[20:36, 30:54], cv2.COLOR_BGRA2GRAY)
+        self.image = FakeScreenShot(frame)
+        check = template_check("button", template, threshold=0.95)
+        self.scheduler.register(Workflow("w", "s").on("s", check, click_hit, "end"))
+        self.scheduler.tick()
+        self.assertEqual(self.device.clicks, [(100 + 42, 200 + 28)])  # the center, on the desktop
+
+    def test_arbiter_serializes(self):
+        inside, overlaps = [0], []
+        counter = itertools.count()
+
+        class SlowDevice:
+            def press(self):
+                inside[0] += 1
+                overlaps.append(inside[0])
+                time.sleep(0.001)
+                next(counter)
+                inside[0] -= 1
+
+        arbiter = InputArbiter(SlowDevice())
+        threads = [threading.Thread(target=lambda: [arbiter.press() for _ in range(10)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max(overlaps), 1)
+        self.assertEqual(arbiter.calls, 40)
+
+
+if __name__ == "__main__":
+    unittest.main()
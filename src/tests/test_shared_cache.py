@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from io_tools import shared_cache
+from io_tools.memoize import cached
+
+
+class TestSharedCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.localdb = os.path.join(cls.tmpdir.name, "shared.json")
+        with open(cls.localdb, "w") as f:
+            json.dump({"existing": "loaded"}, f)  # keys the coordinator loads at startup
+        cls.process = shared_cache.start_coordinator(cls.localdb)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.process.terminate()
+        cls.process.join(5)
+        cls.tmpdir.cleanup()
+
+    def test_workers_share_keyspace(self):
+        worker1 = shared_cache.SharedCacheClient.from_env()
+        worker2 = shared_cache.SharedCacheClient.from_env()
+        try:
+            worker1["key"] = "value"
+            self.assertEqual(worker2["key"], "value")
+            worker2.set_many({"a": 1, "b": 2})
+            self.assertEqual(worker1.get_many(["a", "b"]), {"a": 1, "b": 2})
+            worker1.remove("a")
+            self.assertNotIn("a", worker2)
+            self.assertEqual(worker2.get("a", "gone"), "gone")
+            worker2.submit()
+            with open(self.localdb) as f:
+                self.assertIn('"key"', f.read())
+        finally:
+            worker1.close()
+            worker2.close()
+
+    def test_existing_keys(self):
+        worker = shared_cache.SharedCacheClient.from_env()
+        try:
+            self.assertEqual(worker.get("existing", None), "loaded")
+            worker["other"] = 1
+            self.assertEqual(worker.get("existing", None), "loaded")
+            self.assertIn(("existing", "loaded"), list(worker.scan()))
+        finally:
+            worker.close()
+
+    def test_ttl(self):
+        worker1 = shared_cache.SharedCacheClient.from_env()
+        worker2 = shared_cache.SharedCacheClient.from_env()
+        try:
+            worker1.set("volatile", "v", ttl=0.2)
+            self.assertEqual(worker2.get("volatile", None), "v")
+            self.assertNotIn("volatile", worker2.snapshot())  # never persisted
+            time.sleep(0.3)
+            self.assertNotIn("volatile", worker1)
+            self.assertEqual(worker2.get("volatile", "expired"), "expired")
+            worker3 = shared_cache.SharedCacheClient.from_env()  # a full sync leaves it out as well
+            self.assertNotIn("volatile", worker3)
+            worker3.close()
+        finally:
+            worker1.close()
+            worker2.close()
+
+    def test_memoize(self):
+        worker = shared_cache.SharedCacheClient.from_env()
+        calls = []
+
+        @cached(ttl=60, max_size=1, cache=worker)
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        try:
+            self.assertEqual(square(3), 9)
+            self.assertEqual(square(3), 9)
+            self.assertEqual(square(4), 16)
+            self.assertEqual(calls, [3, 4])
+            self.assertNotIn(square.cache_key((3,), {}), worker)  # evicted past max_size
+        finally:
+            worker.close()
@@ -0,0 +1,137 @@
+import asyncio
+import gc
+import sys
+import time
+import unittest
+from unittest import mock
+from io_tools.shell import ShellBusy, ShellRunner
+
+
+def python(code: str) -> str:
+    return f'"{sys.executable}" -c "{code}"'
+
+
+class TestShellRunner(unittest.TestCase):
+    def setUp(self):
+        # transports and processes left to their __del__ after the loop is closed end up here
+        self.unraisable = []
+        hook, sys.unraisablehook = sys.unraisablehook, self.unraisable.append
+        self.addCleanup(setattr, sys, "unraisablehook", hook)
+
+    def tearDown(self):
+        gc.collect()
+        self.assertEqual([str(item.exc_value) for item in self.unraisable], [])
+
+    def test_stream(self):
+        async def main():
+            runner = ShellRunner()
+            events = [event async for event in runner.stream(
+                python("import sys; print('out'); print('err', file=sys.stderr); sys.exit(3)"))]
+            return runner, events
+
+        runner, events = asyncio.run(main())
+        # chunks arrive as written, not line by line
+        output = {"stdout": "", "stderr": ""}
+        for event in events[:-1]:
+            output[event["stream"]] += event["data"]
+        self.assertEqual(output["stdout"].strip(), "out")
+        self.assertEqual(output["stderr"].strip(), "err")
+        self.assertEqual(events[-1]["stream"], "exit")
+        self.assertEqual(events[-1]["code"], 3)
+        self.assertEqual(runner.metrics()["completed"], 1)
+
+    def test_output_arrives_while_running(self):
+        async def main():
+            runner = ShellRunner()
+            stream = runner.stream(python("import time; print('first', flush=True); time.sleep(1); print('last')"))
+            started = time.monotonic()
+            first = await stream.__anext__()
+            elapsed = time.monotonic() - started
+            rest = [event async for event in stream]
+            return first, elapsed, rest
+
+        first, elapsed, rest = asyncio.run(main())
+        self.assertEqual(first["data"].strip(), "first")
+        self.assertLess(elapsed, 0.9)  # before the command ended
+        self.assertEqual(rest[-1]["code"], 0)
+
+    def test_timeout_and_cancel(self):
+        async def main():
+            runner = ShellRunner(timeout=0.3)
+            result = await runner.run(python("import time; time.sleep(30)"))
+            # closing the stream early kills the command
+            stream = runner.stream(python("import time; print('x', flush=True); time.sleep(30)"), timeout=30)
+            await stream.__anext__()
+            await stream.aclose()
+            return runner, result
+
+        started = time.monotonic()
+        runner, result = asyncio.run(main())
+        self.assertLess(time.monotonic() - started, 10)
+        self.assertTrue(result["timed_out"])
+        self.assertEqual(runner.metrics(), {"running": 0, "waiting": 0, "max_concurrent": 4,
+                                            "completed": 0, "timeouts": 1, "cancelled": 1})
+
+    @unittest.skipIf(sys.platform == "win32", "a POSIX shell command")
+    def test_deadline_after_pipes_close(self):
+        # the command closes its pipes and keeps running, the timeout still holds
+        started = time.monotonic()
+        result = asyncio.run(ShellRunner(timeout=1).run("exec >/dev/null 2>&1; sleep 8"))
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertTrue(result["timed_out"])
+
+    def test_without_subprocess_support(self):
+        # the selector loop on Windows raises NotImplementedError, threads read the pipes instead
+        async def main():
+            runner = ShellRunner(timeout=0.5)
+            events = [event async for event in runner.stream(
+                python("import sys; print('out'); print('err', file=sys.stderr); sys.exit(3)"))]
+            timed_out = await runner.run(python("import time; time.sleep(30)"))
+            stream = runner.stream(python("import time; print('x', flush=True); time.sleep(30)"), timeout=30)
+            await stream.__anext__()
+            await stream.aclose()
+            return runner, events, timed_out
+
+        with mock.patch("asyncio.create_subprocess_shell", side_effect=NotImplementedError):
+            started = time.monotonic()
+            runner, events, timed_out = asyncio.run(main())
+        self.assertLess(time.monotonic() - started, 10)
+        output = {"stdout": "", "stderr": ""}
+        for event in events[:-1]:
+            output[event["stream"]] += event["data"]
+        self.assertEqual((output["stdout"].strip(), output["stderr"].strip()), ("out", "err"))
+        self.assertEqual(events[-1]["code"], 3)
+        self.assertTrue(timed_out["timed_out"])
+        self.assertEqual(runner.metrics()["cancelled"], 1)
+        self.assertEqual(runner.running, 0)
+
+    def test_concurrency_limit(self):
+        async def main():
+            runner = ShellRunner(max_concurrent=2, max_waiting=2)
+            peak = []
+
+            async def one():
+                async for _ in runner.stream(python("import time; time.sleep(0.2)")):
+                    peak.append(runner.running)
+
+            await asyncio.gather(*[one() for _ in range(4)])  # 2 run, 2 wait
+
+            # a full pool with max_waiting commands waiting turns new ones away
+            blockers = [asyncio.ensure_future(one()) for _ in range(4)]
+            await asyncio.sleep(0.05)
+            self.assertTrue(runner.busy)
+            with self.assertRaises(ShellBusy):
+                runner.stream("echo")  # raised by the call, before any output could be sent
+            await asyncio.gather(*blockers)
+            return peak
+
+        self.assertEqual(max(asyncio.run(main())), 2)
+
+    def test_truncated(self):
+        result = asyncio.run(ShellRunner().run(python("print('x' * 5000)"), max_output=100))
+        self.assertEqual(len(result["stdout"]), 100)
+        self.assertTrue(result["truncated"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,18 +8,170 @@
     license: Apache License 2.0
 """
 
+import collections
+import dataclasses
 import os
-import glob
+import threading
 import time
+import uuid
 
 
-def monitor_directory(directory: os.PathLike):
-    while True:
-        files = glob.glob(os.path.join(directory, '*'))
-        if len(files) > 12:
-            # sort files by creation time
-            files.sort(key=os.path.getctime)
-            # delete oldest file
-            os.remove(files[0])
-            print(f"Removed: {files[0]}")
-        time.sleep(1)  # check every second
+@dataclasses.dataclass
+class TempArtifact:
+    path: str
+    created: float
+    size: int = 0
+    pins: int = 0
+    keep: bool = False
+
+
+class TempArtifactStore:
+    """
+    TempArtifactStore tracks the temporary files the server generates, without scanning the directory.
+
+    A file is pinned while it is written or streamed and is never deleted while pinned.
+    When the last pin is released the file is deleted, unless it was registered with keep=True,
+    kept files are deleted once they are older than max_age, or oldest first when the store
+    is over max_files or max_bytes. There is no timer: the limits are enforced when the store is called,
+    an idle store keeps its expired files until its next call, or until `close`.
+
+    Example:
+        >>> store = TempArtifactStore("tmp")
+        >>> path = store.allocate(".png")   # pinned
+        >>> write_png(path)
+        >>> store.commit(path)
+        >>> return FileResponse(path, background=BackgroundTask(store.release, path))
+
+    Methods:
+        allocate: Reserve a new file path, pinned.
+        commit: Record the size of a written file and enforce the limits.
+        acquire: Pin a file again, for one more reader.
+        release: Unpin a file, delete it if nobody uses it.
+        metrics: Counters and gauges of the store.
+        close: Delete every file.
+    """
+
+    def __init__(self,
+                 directory: os.PathLike,
+                 max_files: int = 12,
+                 max_bytes: int = 512 * 1024 * 1024,
+                 max_age: float = 300.0) -> None:
+        """
+        Args:
+            directory: The directory of the temporary files.
+            max_files: The maximum number of unpinned files kept.
+            max_bytes: The maximum total size of unpinned files kept.
+            max_age: Seconds after which an unpinned file is deleted, by the next call to the store.
+        """
+        self.directory = directory
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._artifacts: "collections.OrderedDict[str, TempArtifact]" = collections.OrderedDict()
+        self._bytes = 0
+        self._counters = collections.Counter()
+        os.makedirs(directory, exist_ok=True)
+
+    def allocate(self, suffix: str = "", keep: bool = False) -> str:
+        """
+        Reserve a new file path, the file is pinned until `release`.
+        Args:
+            suffix: The file name suffix, such as ".png".
+            keep: Keep the file after the last release, until it is evicted.
+        """
+        path = os.path.join(self.directory, f"{uuid.uuid4().hex}{suffix}")
+        with self._lock:
+            self._artifacts[path] = TempArtifact(path, time.monotonic(), pins=1, keep=keep)
+            self._counters["created"] += 1
+            self._counters["peak_files"] = max(self._counters["peak_files"], len(self._artifacts))
+        return path
+
+    def commit(self, path: str) -> None:
+        """
+        Record the size of a file after it is written.
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = 0
+        with self._lock:
+            artifact = self._artifacts.get(path)
+            if artifact is None:
+                return
+            self._bytes += size - artifact.size
+            artifact.size = size
+            self._counters["peak_bytes"] = max(self._counters["peak_bytes"], self._bytes)
+            self._enforce()
+
+    def acquire(self, path: str) -> bool:
+        """
+        Pin a file for one more reader.
+        Returns:
+            bool: False if the file is not in the store anymore.
+        """
+        with self._lock:
+            artifact = self._artifacts.get(path)
+            if artifact is None:
+                return False
+            artifact.pins += 1
+            return True
+
+    def release(self, path: str) -> None:
+        """
+        Unpin a file, meant to run as the background task of the response that streams it.
+        """
+        with self._lock:
+            artifact = self._artifacts.get(path)
+            if artifact is None:
+                return
+            artifact.pins -= 1
+            if artifact.pins <= 0 and not artifact.keep:
+                self._delete(artifact, "released")
+            self._enforce()
+
+    def _delete(self, artifact: TempArtifact, reason: str) -> None:
+        """
+        Forget and delete a file, the caller holds the lock.
+        """
+        del self._artifacts[artifact.path]
+        self._bytes -= artifact.size
+        self._counters[f"deleted_{reason}"] += 1
+        try:
+            os.remove(artifact.path)
+        except FileNotFoundError:
+            pass
+
+    def _enforce(self) -> None:
+        """
+        Delete expired files, then the oldest unpinned files while over the limits, the caller holds the lock.
+        """
+        deadline = time.monotonic() - self.max_age
+        unpinned = [artifact for artifact in self._artifacts.values() if artifact.pins <= 0]
+        kept_files = len(unpinned)
+        kept_bytes = sum(artifact.size for artifact in unpinned)
+        for artifact in unpinned:  # oldest first, the dict keeps allocation order
+            if artifact.created < deadline:
+                reason = "expired"
+            elif kept_files > self.max_files or kept_bytes > self.max_bytes:
+                reason = "evicted"
+            else:
+                break
+            kept_files -= 1
+            kept_bytes -= artifact.size
+            self._delete(artifact, reason)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            self._enforce()
+            return {
+                "files": len(self._artifacts),
+                "bytes": self._bytes,
+                "pinned": sum(1 for artifact in self._artifacts.values() if artifact.pins > 0),
+                **self._counters,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            for artifact in list(self._artifacts.values()):
+                self._delete(artifact, "closed")
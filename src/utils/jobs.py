@@ -0,0 +1,313 @@
+"""
+    filename: utils/jobs.py
+    ~~~~~~~~~~~~~~~~~~~~
+    A job queue for slow, CPU bound work submitted by requests.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import collections
+import dataclasses
+import enum
+import heapq
+import itertools
+import queue
+import threading
+import time
+import typing
+import uuid
+
+
+class JobQueueFull(RuntimeError):
+    """Raised when max_queue jobs are already waiting."""
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function to stop early, see Job.check."""
+
+
+class JobStatus(str, enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    TIMEOUT = "timeout"
+
+    @property
+    def finished(self) -> bool:
+        return self not in (JobStatus.QUEUED, JobStatus.RUNNING)
+
+
+@dataclasses.dataclass
+class Job:
+    """
+    Job is one unit of work and its outcome.
+
+    The job function gets the Job as its only argument, long loops call `check()` (or test `should_stop()`)
+    between steps so cancellation and timeouts take effect, and may `report(...)` progress for streaming clients.
+    """
+    job_id: str
+    kind: str
+    func: typing.Optional[typing.Callable[["Job"], typing.Any]] = dataclasses.field(repr=False)  # None once finished
+    priority: int = 0
+    timeout: typing.Optional[float] = None  # seconds of running time
+    status: JobStatus = JobStatus.QUEUED
+    result: typing.Any = None
+    error: typing.Optional[str] = None
+    progress: dict = dataclasses.field(default_factory=dict)
+    version: int = 0  # bumped on every status or progress change
+    submitted_at: float = dataclasses.field(default_factory=time.time)
+    started_at: typing.Optional[float] = None
+    finished_at: typing.Optional[float] = None
+    _deadline: typing.Optional[float] = dataclasses.field(default=None, repr=False)
+    _cancel: threading.Event = dataclasses.field(default_factory=threading.Event, repr=False)
+    _changed: threading.Condition = dataclasses.field(default_factory=threading.Condition, repr=False)
+    _watchers: typing.List[typing.Callable[[], None]] = dataclasses.field(default_factory=list, repr=False)
+
+    def should_stop(self) -> bool:
+        return self._cancel.is_set() or (self._deadline is not None and time.monotonic() > self._deadline)
+
+    def check(self) -> None:
+        """
+        Raises:
+            JobCancelled: If the job was cancelled or ran out of time.
+        """
+        if self.should_stop():
+            raise JobCancelled(self.job_id)
+
+    def report(self, **progress) -> None:
+        with self._changed:
+            self.progress.update(progress)
+            self._bump()
+
+    def _set_status(self, status: JobStatus, **fields) -> None:
+        with self._changed:
+            self.status = status
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self._bump()
+
+    def _bump(self) -> None:
+        # the caller holds _changed
+        self.version += 1
+        self._changed.notify_all()
+        for watcher in self._watchers:
+            watcher()
+
+    def watch(self, callback: typing.Callable[[], None]) -> None:
+        """
+        Call `callback` after every change, on the thread that changed the job. It must not block,
+        such as loop.call_soon_threadsafe to wake a coroutine.
+        """
+        with self._changed:
+            self._watchers.append(callback)
+
+    def unwatch(self, callback: typing.Callable[[], None]) -> None:
+        with self._changed:
+            self._watchers.remove(callback)
+
+    def wait_change(self, version: int, timeout: typing.Optional[float] = None) -> int:
+        """
+        Block until the job changes after `version`, or the job is finished, or the timeout.
+        Returns:
+            version: The current version.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version or self.status.finished, timeout)
+            return self.version
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "status": self.status.value,
+            "priority": self.priority,
+            "result": self.result,
+            "error": self.error,
+            "progress": dict(self.progress),
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    JobManager runs jobs on a fixed pool of worker threads, highest priority first, then in submission order.
+
+    OpenCV releases the GIL inside its kernels, so a few threads keep several cores busy
+    without pickling frames to worker processes.
+    Finished jobs are kept for polling, the oldest are forgotten after `keep_finished`.
+
+    Example:
+        >>> jobs = JobManager(workers=2)
+        >>> job = jobs.submit(lambda job: heavy_work(job.should_stop), kind="demo", timeout=30)
+        >>> jobs.get(job.job_id).to_dict()
+        {'job_id': ..., 'status': 'running', ...}
+        >>> jobs.cancel(job.job_id)
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 64, keep_finished: int = 256) -> None:
+        """
+        Args:
+            workers: Worker threads.
+            max_queue: The maximum number of queued jobs, submit raises JobQueueFull beyond it.
+            keep_finished: The number of finished jobs kept for polling.
+        """
+        self.max_queue = max_queue
+        self._keep_finished = keep_finished
+        self._queue: "queue.PriorityQueue" = queue.PriorityQueue()
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._jobs: typing.Dict[str, Job] = {}
+        self._finished: typing.Deque[str] = collections.deque()
+        self._queued = 0
+        self._running = 0
+        self._counters = collections.Counter()
+        self._dequeued = 0
+        self._wait_total = 0.0
+        self._ran = 0
+        self._run_total = 0.0
+        self._closed = False
+        self._threads = [threading.Thread(target=self._worker, name=f"job-{n}", daemon=True) for n in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self,
+               func: typing.Callable[[Job], typing.Any],
+               kind: str = "job",
+               priority: int = 0,
+               timeout: typing.Optional[float] = None) -> Job:
+        """
+        Queue a job.
+        Args:
+            func: Called with the Job on a worker thread, its return value is the job result.
+            kind: A label for the job, such as "find_scale".
+            priority: Higher runs first.
+            timeout: Seconds the job may run, None for no limit.
+        Raises:
+            JobQueueFull: If max_queue jobs are already waiting.
+        """
+        job = Job(uuid.uuid4().hex, kind, func, priority=priority, timeout=timeout)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("job manager is closed")
+            if self._queued >= self.max_queue:
+                self._counters["rejected"] += 1
+                raise JobQueueFull(f"{self._queued} jobs are queued")
+            self._jobs[job.job_id] = job
+            self._queued += 1
+            self._counters["submitted"] += 1
+        self._queue.put((-priority, next(self._order), job))
+        return job
+
+    def get(self, job_id: str) -> typing.Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a job, a queued job is cancelled right away and frees its queue slot,
+        a running job stops at its next check.
+        Returns:
+            bool: False if the job is unknown or already finished.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status.finished:
+                return False
+            job._cancel.set()
+            if job.status == JobStatus.QUEUED:
+                self._queued -= 1
+                self._dequeue(job)
+                self._finish(job, JobStatus.CANCELLED)
+        return True
+
+    def _dequeue(self, job: Job) -> None:
+        """
+        Remove the queue entry of a cancelled job, so submit/cancel churn doesn't grow the queue.
+        A worker may have taken it already, it skips finished jobs.
+        """
+        with self._queue.mutex:
+            entries = self._queue.queue
+            for index, entry in enumerate(entries):
+                if entry[2] is job:
+                    entries[index] = entries[-1]
+                    entries.pop()
+                    heapq.heapify(entries)
+                    return
+
+    def _worker(self) -> None:
+        while True:
+            _, _, job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.status.finished:  # cancelled while queued
+                    continue
+                self._queued -= 1
+                self._dequeued += 1
+                self._wait_total += time.time() - job.submitted_at
+                if job._cancel.is_set():
+                    self._finish(job, JobStatus.CANCELLED)
+                    continue
+                self._running += 1
+                # running from here on, under the lock so cancel can't take it for a queued job
+                started = time.monotonic()
+                if job.timeout is not None:
+                    job._deadline = started + job.timeout
+                job._set_status(JobStatus.RUNNING, started_at=time.time())
+            self._run(job, started)
+
+    def _run(self, job: Job, started: float) -> None:
+        status, fields = JobStatus.DONE, {}
+        try:
+            fields["result"] = job.func(job)
+            if job._cancel.is_set():
+                status = JobStatus.CANCELLED
+        except JobCancelled:
+            status = JobStatus.CANCELLED if job._cancel.is_set() else JobStatus.TIMEOUT
+        except Exception as e:
+            status, fields["error"] = JobStatus.FAILED, f"{type(e).__name__}: {e}"
+        with self._lock:
+            self._running -= 1
+            self._ran += 1
+            self._run_total += time.monotonic() - started
+            self._finish(job, status, **fields)
+
+    def _finish(self, job: Job, status: JobStatus, **fields) -> None:
+        """
+        Record the outcome and forget the oldest finished jobs, the caller holds the lock.
+        """
+        job._set_status(status, finished_at=time.time(), **fields)
+        job.func = None  # finished jobs are kept for polling, not the frames their closure holds
+        self._counters[status.value] += 1
+        self._finished.append(job.job_id)
+        while len(self._finished) > self._keep_finished:
+            self._jobs.pop(self._finished.popleft(), None)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "queued": self._queued,
+                "running": self._running,
+                "workers": len(self._threads),
+                "max_queue": self.max_queue,
+                "avg_wait_ms": self._wait_total / self._dequeued * 1000 if self._dequeued else 0.0,
+                "avg_run_ms": self._run_total / self._ran * 1000 if self._ran else 0.0,
+                **self._counters,
+            }
+
+    def shutdown(self) -> None:
+        """
+        Cancel every job and stop the workers.
+        """
+        with self._lock:
+            self._closed = True
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job._cancel.set()
+        for _ in self._threads:
+            self._queue.put((float("inf"), next(self._order), None))
@@ -0,0 +1,92 @@
+"""
+    filename: utils/lazy.py
+    ~~~~~~~~~~~~~~~~~~~~
+    Deferred imports and attributes, heavy modules and devices are loaded on first use.
+
+    author: phil616
+    date: 2023/11/28
+    license: Apache License 2.0
+"""
+
+import importlib
+import sys
+import threading
+import types
+import typing
+
+
+class LazyModule(types.ModuleType):
+    """
+    LazyModule stands for a module until one of its attributes is used, then imports it.
+
+    A plain proxy rather than importlib.util.LazyLoader: packages such as cv2 replace themselves
+    in sys.modules while they are imported, which LazyLoader doesn't survive.
+    """
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+        self.__dict__["_lazy_lock"] = threading.Lock()
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__["_lazy_module"]
+        if module is None:
+            with self.__dict__["_lazy_lock"]:
+                module = self.__dict__["_lazy_module"]
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_lazy_module"] = module
+        return module
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__["_lazy_module"] is not None else "not loaded"
+        return f"<lazy module {self.__name__!r} ({state})>"
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """
+    Import a module on first attribute access, an already imported module is returned as is.
+
+    Example:
+        >>> cv2 = lazy_import("cv2")   # nothing imported yet
+        >>> cv2.imread(path)           # cv2 is imported here
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
+
+
+class lazy_property:
+    """
+    A property computed once on first access, thread-safe, then stored on the instance.
+
+    Use `is_loaded(instance, name)` to tell whether it was ever created, such as before closing it.
+    """
+
+    def __init__(self, func: typing.Callable) -> None:
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+        self._lock = threading.RLock()
+
+    def __set_name__(self, owner, name: str) -> None:
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        with self._lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.func(instance)
+        return instance.__dict__[self.name]
+
+
+def is_loaded(instance, name: str) -> bool:
+    return name in instance.__dict__
@@ -9,6 +9,8 @@
 """
 
 
+import hashlib
+import typing
 import aiofiles
 
 async def a_write_file(path: str, content: bytes):
@@ -17,6 +19,53 @@ async def a_write_file(path: str, content: bytes):
         await f.flush()
         await f.close()  # not necessary if using async with
 
+async def a_write_hashed(path: str,
+                         read: typing.Callable[[int], typing.Awaitable[bytes]],
+                         chunk_size: int = 1 << 20) -> typing.Tuple[str, int]:
+    """
+    Stream chunks from `read` into a file while hashing them, at most one chunk is held in memory.
+    Args:
+        path: The file to write.
+        read: An async read function, such as UploadFile.read.
+        chunk_size: The number of bytes read at a time.
+    Returns:
+        (sha256, size): The hex sha256 digest and the number of bytes written.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    async with aiofiles.open(path, "wb") as f:
+        while True:
+            chunk = await read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+            await f.write(chunk)
+    return digest.hexdigest(), size
+
+async def a_iter_file(path: str,
+                     start: int = 0,
+                     length: typing.Optional[int] = None,
+                     chunk_size: int = 64 * 1024) -> typing.AsyncIterator[bytes]:
+    """
+    Read a byte range of a file in chunks.
+    Args:
+        path: The file to read.
+        start: The offset of the first byte.
+        length: The number of bytes, to the end of the file if None.
+        chunk_size: The number of bytes read at a time.
+    """
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            chunk = await f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
 async def a_read_file(path: str) -> bytes:
     async with aiofiles.open(path, "rb") as f:
         return await f.read()
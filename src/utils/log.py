@@ -3,50 +3,304 @@
     ~~~~~~~~~~~~~~~~~~~~
     logger class for logging
 
+    Log calls only put the record on a queue, one background listener thread formats it
+    and writes it to the log files and the console.
+    With several uvicorn workers, every process writes its own files (applog.<pid>.log),
+    processes rotating the same file would race on the rename.
+
     author: phil616
     date: 2023/11/28
     license: Apache License 2.0
 """
 
+import atexit
+import gzip
+import itertools
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import shutil
+import threading
+import time
+import typing
 from app_setting import config
+
+# attributes every LogRecord has, anything else was passed with `extra=`
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: ts, level, name, message, the `extra=` fields and the exception if any.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class GzipRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler that compresses the rotated files: applog.log.1.gz, applog.log.2.gz...
+    """
+
+    def __init__(self, filename: str, max_bytes: int, backups: int, encoding: str = "utf-8") -> None:
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding=encoding, delay=True)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = _gzip_rotate
+
+
+def _gzip_rotate(source: str, dest: str) -> None:
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def _process_file(log_file: str) -> str:
+    """
+    The file of the current process: applog.log, or applog.<pid>.log when there are several workers.
+    """
+    if config.ASGI_APP_WORKERS <= 1:
+        return log_file
+    root, ext = os.path.splitext(log_file)
+    return f"{root}.{os.getpid()}{ext}"
+
+
+def _drop_oldest(keys: dict, keep: int) -> None:
+    # dicts keep insertion order, the first keys are the oldest
+    for key in list(itertools.islice(keys, max(0, len(keys) - keep))):
+        del keys[key]
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through `rate` records per `per` seconds of each message, such as a per-frame message in a loop.
+
+    Records are told apart by their unformatted message, so "frame %d" is one message whatever the frame.
+    The next record let through carries the number of records dropped meanwhile, as `suppressed`.
+    At most `max_keys` messages are tracked, messages formatted before logging would otherwise grow it forever:
+    when it is full, expired windows are forgotten first, then the oldest.
+    """
+
+    def __init__(self,
+                 rate: int = 1,
+                 per: float = 1.0,
+                 clock: typing.Callable[[], float] = time.monotonic,
+                 max_keys: int = 1024) -> None:
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.max_keys = max_keys
+        self._clock = clock
+        self._windows: typing.Dict[typing.Tuple[int, str], typing.List] = {}  # key -> [window start, count, dropped]
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        # down to half, so a steady stream of new messages prunes once per max_keys / 2 of them
+        for key in [key for key, window in self._windows.items() if now - window[0] >= self.per]:
+            del self._windows[key]
+        _drop_oldest(self._windows, self.max_keys // 2)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.levelno, str(record.msg))
+        now = self._clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None and len(self._windows) >= self.max_keys:
+                self._prune(now)
+            if window is None or now - window[0] >= self.per:
+                dropped = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.rate:
+                window[1] += 1
+                dropped = window[2]
+                window[2] = 0
+            else:
+                window[2] += 1
+                return False
+        if dropped:
+            record.suppressed = dropped
+        return True
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets through one record in `every` of each message.
+    At most `max_keys` messages are counted, the oldest half is forgotten when it is full,
+    a forgotten message starts counting again.
+    """
+
+    def __init__(self, every: int, max_keys: int = 1024) -> None:
+        super().__init__()
+        self.every = every
+        self.max_keys = max_keys
+        self._counts: typing.Dict[typing.Tuple[int, str], int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.levelno, str(record.msg))
+        with self._lock:
+            count = self._counts.get(key)
+            if count is None:
+                count = 0
+                if len(self._counts) >= self.max_keys:
+                    _drop_oldest(self._counts, self.max_keys // 2)
+            self._counts[key] = count + 1
+        if count % self.every:
+            return False
+        if count:
+            record.sampled = self.every
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Tags records with the file they go to, the listener routes them."""
+
+    def __init__(self, log_file: str) -> None:
+        super().__init__(_queue)
+        self.log_file = log_file
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # what the listener thread needs: the message with its args applied, the traceback as text.
+        # the record is not formatted here, the formatting is the listener's job
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _TEXT.formatException(record.exc_info)
+            record.exc_info = None
+        record._log_file = self.log_file
+        return record
+
+
+class _Router(logging.Handler):
+    """Runs on the listener thread, writes each record to its file and to the console."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.files: typing.Dict[str, logging.Handler] = {}
+        self.console: typing.Optional[logging.Handler] = None
+
+    def emit(self, record: logging.LogRecord) -> None:
+        handler = self.files.get(getattr(record, "_log_file", None))
+        if handler is not None:
+            handler.handle(record)
+        if self.console is not None:
+            self.console.handle(record)
+
+    def flush(self) -> None:
+        for handler in list(self.files.values()):
+            handler.flush()
+
+    def close(self) -> None:
+        for handler in list(self.files.values()):
+            handler.close()
+        super().close()
+
+
+_TEXT = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_router = _Router()
+_listener: typing.Optional[logging.handlers.QueueListener] = None
+_lock = threading.Lock()
+
+
+def _start() -> None:
+    global _listener
+    if _listener is None:
+        if config.LOG_CONSOLE:
+            _router.console = logging.StreamHandler()
+            _router.console.setFormatter(_TEXT)
+        _listener = logging.handlers.QueueListener(_queue, _router)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def shutdown() -> None:
+    """
+    Write what is still queued and stop the listener thread, registered with atexit.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+            _router.flush()
+
+
 class Logger:
-    def __init__(self, log_name, log_file:os.PathLike=None,level=logging.DEBUG):
+    def __init__(self, log_name, log_file:os.PathLike=None,level=logging.DEBUG, structured: bool = None):
         """
-        Constructor for logger class
+        Constructor for logger class, the same name twice returns the same logger without adding handlers again
         Args:
             log_name (str): Name of the logger
-            log_file (str): Path to the log file
+            log_file (str): Path to the log file, relative to the LOG_PATH directory, suffixed with the pid
+                when ASGI_APP_WORKERS > 1
             level (int): Logging level
+            structured (bool): Write the file as JSON lines, config.LOG_JSON by default
         """
         self.logger = logging.getLogger(log_name)
-        self.logger.setLevel(level) 
-        
+        self.logger.setLevel(level)
+        self.logger.propagate = False  # the root logger would print the records a second time
+
         dir_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),config.LOG_PATH)
+        log_file = os.path.join(dir_path, log_file or 'applog.log')
+        log_file = _process_file(os.path.abspath(log_file))
+        structured = config.LOG_JSON if structured is None else structured
+
+        with _lock:
+            if any(isinstance(handler, _QueueHandler) for handler in self.logger.handlers):
+                return
+            if log_file not in _router.files:
+                os.makedirs(os.path.dirname(log_file), exist_ok=True)
+                file_handler = GzipRotatingFileHandler(log_file, config.LOG_MAX_BYTES, config.LOG_BACKUPS)
+                file_handler.setFormatter(JsonFormatter() if structured else _TEXT)
+                _router.files[log_file] = file_handler
+            self.logger.addHandler(_QueueHandler(log_file))
+            _start()
+
+    def get_logger(self):
+        return self.logger
 
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-        if log_file is None:
-            log_file = os.path.join(dir_path, 'applog.log')
-        else:
-            log_file = os.path.join(dir_path, log_file)
-        
-        file_handler = logging.FileHandler(log_file)
-        file_handler.setLevel(level)
 
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(level)
+def throttled(logger: logging.Logger, rate: int = 1, per: float = 1.0) -> logging.Logger:
+    """
+    A child logger that lets through `rate` records per `per` seconds of each message.
 
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        file_handler.setFormatter(formatter)
-        console_handler.setFormatter(formatter)
-        
+    Example:
+        >>> frame_log = throttled(logger, rate=1, per=5.0)
+        >>> for frame in frames:
+        ...     frame_log.debug("matched %s in %.1f ms", name, ms)   # at most once per 5 s
+    """
+    child = logger.getChild(f"throttled.{rate}.{per:g}")
+    if not child.filters:
+        child.addFilter(RateLimitFilter(rate, per))
+    return child
+
+
+def sampled(logger: logging.Logger, every: int) -> logging.Logger:
+    """
+    A child logger that lets through one record in `every` of each message.
+    """
+    child = logger.getChild(f"sampled.{every}")
+    if not child.filters:
+        child.addFilter(SampleFilter(every))
+    return child
 
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(console_handler)
 
-    def get_logger(self):
-        return self.logger
-    
 logger = Logger('syslog').get_logger()